@@ -0,0 +1,116 @@
+# /////////////////////////////////////////////////////////////////////////
+# //                                                                     //
+# //            Book 2 CBZ Converter by KenWeTech                        //
+# //            Benchmark: CBZ compression policies                      //
+# //                                                                     //
+# /////////////////////////////////////////////////////////////////////////
+
+# Compares archive build time and size for different CBZ compression policies.
+# Usage:
+#   python bench_cbz_compression.py                     (synthetic 200 page book, see fixtures.py)
+#   python bench_cbz_compression.py --fixture doorstop  (one of the bench_pipeline.py fixtures)
+#   python bench_cbz_compression.py --pdf "My Book.pdf" (pages rendered from a real book)
+#   python bench_cbz_compression.py --json results.json
+
+import os
+import sys
+import time
+import json
+import argparse
+import tempfile
+import zipfile
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.dirname(BENCH_DIR))
+sys.path.insert(0, BENCH_DIR)
+
+import fitz  # PyMuPDF
+import fixtures
+import p2_create_cbz as p2
+
+# name -> (image compress_type, image compresslevel, comicinfo compresslevel)
+POLICIES = {
+    'stored images, deflated ComicInfo (default)': (zipfile.ZIP_STORED, None, 6),
+    'deflate everything, level 1': (zipfile.ZIP_DEFLATED, 1, 1),
+    'deflate everything, level 6': (zipfile.ZIP_DEFLATED, 6, 6),
+    'deflate everything, level 9': (zipfile.ZIP_DEFLATED, 9, 9),
+}
+
+# --- Function: Render Sample Pages ---
+def render_sample_pages(pdf_path, high_res=False, max_pages=None):
+    """Renders the pages once up front so every policy archives identical bytes."""
+    doc = fitz.open(pdf_path)
+    try:
+        zoom = p2.get_render_zoom(high_res)
+        count = doc.page_count if max_pages is None else min(max_pages, doc.page_count)
+        return [p2.encode_page(p2.render_page(doc, index, zoom)) for index in range(count)]
+    finally:
+        doc.close()
+
+# --- Function: Build Archive ---
+def build_archive(path, pages, comicinfo, image_compression, image_level, comicinfo_level):
+    with zipfile.ZipFile(path, 'w', zipfile.ZIP_STORED) as cbz:
+        for index, data in enumerate(pages):
+            cbz.writestr(f"image-{index:04d}.webp", data, compress_type=image_compression, compresslevel=image_level)
+        cbz.writestr("ComicInfo.xml", comicinfo, compress_type=zipfile.ZIP_DEFLATED, compresslevel=comicinfo_level)
+
+# --- Function: Run Benchmark ---
+def run_benchmark(pages, repeat=3):
+    comicinfo_dir = tempfile.mkdtemp()
+    comicinfo_path = p2.create_comicinfo({'title': 'Benchmark', 'summary': 'x' * 500}, 1, comicinfo_dir)
+    with open(comicinfo_path, 'r', encoding='utf-8') as f:
+        comicinfo = f.read()
+
+    results = []
+    with tempfile.TemporaryDirectory() as tmp:
+        archive_path = os.path.join(tmp, "bench.cbz")
+        for name, (image_compression, image_level, comicinfo_level) in POLICIES.items():
+            timings = []
+            for _ in range(repeat):
+                start = time.perf_counter()
+                build_archive(archive_path, pages, comicinfo, image_compression, image_level, comicinfo_level)
+                timings.append(time.perf_counter() - start)
+            results.append({
+                'policy': name,
+                'seconds': min(timings),
+                'bytes': os.path.getsize(archive_path),
+            })
+    os.remove(comicinfo_path)
+    os.rmdir(comicinfo_dir)
+    return results
+
+def main():
+    parser = argparse.ArgumentParser(description="Compare CBZ compression policies.")
+    parser.add_argument('--pdf', help="Sample book to render. A synthetic book is generated when omitted.")
+    parser.add_argument('--fixture', choices=list(fixtures.FIXTURES), help="Generate this bench_pipeline.py fixture instead of a text-only book.")
+    parser.add_argument('--pages', type=int, default=200, help="Pages in the text-only synthetic book, or maximum pages taken from --pdf.")
+    parser.add_argument('--high-res', action='store_true', help="Render pages like HighRes = True.")
+    parser.add_argument('--repeat', type=int, default=3, help="Builds per policy; the fastest is reported.")
+    parser.add_argument('--json', help="Also write the results to this JSON file.")
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp:
+        pdf_path = args.pdf
+        if not pdf_path:
+            pdf_path = os.path.join(tmp, "synthetic.pdf")
+            if args.fixture:
+                fixtures.make_pdf_fixture(pdf_path, **fixtures.FIXTURES[args.fixture])
+            else:
+                fixtures.make_pdf_fixture(pdf_path, args.pages)
+        pages = render_sample_pages(pdf_path, high_res=args.high_res, max_pages=args.pages if args.pdf else None)
+
+    payload_bytes = sum(len(data) for data in pages)
+    print(f"{len(pages)} pages, {payload_bytes / 1024 / 1024:.2f} MiB of encoded images\n")
+    results = run_benchmark(pages, repeat=args.repeat)
+    baseline = results[0]
+    print(f"{'policy':<46} {'time (ms)':>10} {'size (KiB)':>11} {'size vs default':>16}")
+    for result in results:
+        print(f"{result['policy']:<46} {result['seconds'] * 1000:>10.1f} {result['bytes'] / 1024:>11.1f} "
+              f"{(result['bytes'] / baseline['bytes'] - 1) * 100:>+15.2f}%")
+
+    if args.json:
+        with open(args.json, 'w', encoding='utf-8') as f:
+            json.dump({'pages': len(pages), 'payload_bytes': payload_bytes, 'results': results}, f, indent=4)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,318 @@
+# /////////////////////////////////////////////////////////////////////////
+# //                                                                     //
+# //            Book 2 CBZ Converter by KenWeTech                        //
+# //            Benchmark: conversion pipeline stages                    //
+# //                                                                     //
+# /////////////////////////////////////////////////////////////////////////
+
+# Times each conversion stage on synthetic books (see fixtures.py) and reports wall time, CPU time,
+# peak memory and output size. Every stage runs in a fresh process so its peak memory is its own.
+# Calibre is only needed for the optional 'ebook_convert' stage; everything else runs offline.
+# Usage:
+#   python bench_pipeline.py                                  (every fixture and stage)
+#   python bench_pipeline.py --fixtures novella --stages rasterize,archive --repeat 5
+#   python bench_pipeline.py --set p2.render_workers=4 --json after.json
+#   python bench_pipeline.py --compare before.json after.json
+
+import os
+import sys
+import ast
+import json
+import time
+import shutil
+import argparse
+import warnings
+import platform
+import tempfile
+import multiprocessing
+import concurrent.futures
+
+try:
+    import resource
+except ImportError:  # Windows: no peak memory or child CPU time
+    resource = None
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.dirname(BENCH_DIR))
+sys.path.insert(0, BENCH_DIR)
+
+import fixtures
+
+# --- Function: Load Pipeline Modules ---
+def load_modules(work_dir, overrides):
+    """Imports p1/p2 inside the stage process, points them at work_dir and applies --set overrides."""
+    import p1_process_books as p1
+    import p2_create_cbz as p2
+    modules = {'p1': p1, 'p2': p2}
+    for module in modules.values():
+        module.input_dir = work_dir
+        module.use_result_cache = False
+    p2.delete_pdf = False
+    p2.delete_json = False
+    for name, value in overrides.items():
+        module_name, flag = name.split('.', 1)
+        setattr(modules[module_name], flag, value)
+    return p1, p2
+
+def render_images(p2, pdf_path, work_dir):
+    """Renders the whole book into one image directory through p2.render_chapters, the code process_pdf uses."""
+    images_dir = os.path.join(work_dir, 'images')
+    chapter = {'number': 1, 'start_page': 0, 'end_page': 9999, 'images_dir': images_dir, 'label': "whole PDF",
+               'output_cbz': os.path.join(work_dir, 'book.cbz'), 'stream': False}
+    os.makedirs(images_dir, exist_ok=True)
+    doc = p2.open_pdf_document(pdf_path)
+    try:
+        p2.render_chapters(pdf_path, [chapter], high_res=p2.HighRes, doc=doc)
+    finally:
+        p2.close_pdf_document(doc)
+    return images_dir
+
+def dir_size(path):
+    return sum(os.path.getsize(os.path.join(folder, name)) for folder, _, names in os.walk(path) for name in names)
+
+# --- Stages ---
+# Each stage gets (book paths, work_dir, overrides) and returns (timed function, size function).
+# Setup done before the timed function is returned is not timed.
+
+def stage_epub_patch(book, work_dir, overrides):
+    p1, _ = load_modules(work_dir, overrides)
+    output = os.path.join(work_dir, 'book_modified.epub')
+    return lambda: p1.patch_epub_font(book['epub'], output), lambda: os.path.getsize(output)
+
+def stage_epub_rebuild(book, work_dir, overrides):
+    p1, _ = load_modules(work_dir, overrides)
+    epub_path = shutil.copy(book['epub'], os.path.join(work_dir, 'book.epub'))
+    return lambda: p1.rebuild_epub_font(epub_path), lambda: os.path.getsize(epub_path.replace('.epub', '_modified.epub'))
+
+def stage_ebook_convert(book, work_dir, overrides):
+    p1, _ = load_modules(work_dir, overrides)
+    if not shutil.which('ebook-convert'):
+        raise RuntimeError("ebook-convert is not installed")
+    output = os.path.join(work_dir, 'book.pdf')
+    return lambda: p1.convert_epub_to_pdf(book['epub'], output), lambda: os.path.getsize(output)
+
+def stage_toc_extract(book, work_dir, overrides):
+    p1, _ = load_modules(work_dir, overrides)
+    pdf_path = shutil.copy(book['pdf'], os.path.join(work_dir, 'book.pdf'))
+    json_path = os.path.join(work_dir, 'book chapters.json')
+    return lambda: p1.extract_toc_from_pdf(pdf_path), lambda: os.path.getsize(json_path)
+
+def stage_rasterize(book, work_dir, overrides):
+    _, p2 = load_modules(work_dir, overrides)
+    images_dir = os.path.join(work_dir, 'images')
+    return lambda: render_images(p2, book['pdf'], work_dir), lambda: dir_size(images_dir)
+
+def stage_crop(book, work_dir, overrides):
+    _, p2 = load_modules(work_dir, overrides)
+    # Render uncropped pages first, then time cropping the files the way the ImageMagick path does.
+    p2.crop_white_margins_enabled = False
+    images_dir = render_images(p2, book['pdf'], work_dir)
+    p2.crop_white_margins_enabled = True
+    image_paths = [os.path.join(images_dir, name) for name in sorted(os.listdir(images_dir))]
+    def crop():
+        for image_path in image_paths:
+            p2.crop_white_margins(image_path)
+    return crop, lambda: dir_size(images_dir)
+
+def stage_archive(book, work_dir, overrides):
+    _, p2 = load_modules(work_dir, overrides)
+    images_dir = render_images(p2, book['pdf'], work_dir)
+    output = os.path.join(work_dir, 'book.cbz')
+    return lambda: p2.create_cbz(images_dir, output, None), lambda: os.path.getsize(output)
+
+def stage_process_pdf(book, work_dir, overrides):
+    _, p2 = load_modules(work_dir, overrides)
+    book_dir = os.path.join(work_dir, 'book')
+    os.makedirs(book_dir)
+    pdf_path = shutil.copy(book['pdf'], os.path.join(book_dir, 'book.pdf'))
+    shutil.copy(book['chapters_json'], os.path.join(book_dir, 'book chapters.json'))
+    def cbz_size():
+        return sum(os.path.getsize(os.path.join(book_dir, name)) for name in os.listdir(book_dir) if name.endswith('.cbz'))
+    return lambda: p2.process_pdf(pdf_path), cbz_size
+
+STAGES = {
+    'epub_patch': stage_epub_patch,
+    'epub_rebuild': stage_epub_rebuild,
+    'ebook_convert': stage_ebook_convert,
+    'toc_extract': stage_toc_extract,
+    'rasterize': stage_rasterize,
+    'crop': stage_crop,
+    'archive': stage_archive,
+    'process_pdf': stage_process_pdf,
+}
+DEFAULT_STAGES = [stage for stage in STAGES if stage != 'ebook_convert']
+
+# --- Function: Peak Memory ---
+def get_peak_rss_kib():
+    """Peak resident memory of this process in KiB, or None when the platform does not report it.
+
+    On Linux VmHWM is used: unlike ru_maxrss it starts from zero in a freshly started process instead of
+    inheriting the peak of the process that launched it.
+    """
+    try:
+        with open('/proc/self/status', 'r') as f:
+            for line in f:
+                if line.startswith('VmHWM:'):
+                    return int(line.split()[1])
+    except OSError:
+        pass
+    if resource is None:
+        return None
+    peak_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak_rss // 1024 if sys.platform == 'darwin' else peak_rss  # bytes on macOS, KiB elsewhere
+
+# --- Function: Run One Stage ---
+def run_stage(stage, book, overrides):
+    """Runs in a fresh process. Returns wall/CPU seconds, peak RSS (KiB) and output bytes for one stage run.
+
+    Peak RSS covers the whole stage process, including the untimed setup (crop and archive render pages first).
+    """
+    work_dir = tempfile.mkdtemp(prefix='book2cbz_bench_')
+    try:
+        # Quiet the pipeline's own status output and library warnings so they do not distort the timing.
+        sys.stdout = open(os.devnull, 'w')
+        warnings.simplefilter('ignore')
+        timed, output_size = STAGES[stage](book, work_dir, overrides)
+        children_before = resource.getrusage(resource.RUSAGE_CHILDREN) if resource else None
+        cpu_start = time.process_time()
+        wall_start = time.perf_counter()
+        timed()
+        wall = time.perf_counter() - wall_start
+        cpu = time.process_time() - cpu_start
+        if resource:
+            # Render workers and ImageMagick run as child processes; their CPU time counts too.
+            children = resource.getrusage(resource.RUSAGE_CHILDREN)
+            cpu += (children.ru_utime - children_before.ru_utime) + (children.ru_stime - children_before.ru_stime)
+        return {'wall_s': wall, 'cpu_s': cpu, 'peak_rss_kib': get_peak_rss_kib(), 'output_bytes': output_size()}
+    finally:
+        shutil.rmtree(work_dir, ignore_errors=True)
+
+def run_stage_isolated(stage, book, overrides):
+    context = multiprocessing.get_context('spawn')
+    with concurrent.futures.ProcessPoolExecutor(max_workers=1, mp_context=context) as executor:
+        return executor.submit(run_stage, stage, book, overrides).result()
+
+# --- Function: Prepare Fixtures ---
+def prepare_fixture(name, fixture_dir):
+    """Generates the PDF, EPUB and chapters JSON for one fixture."""
+    params = fixtures.FIXTURES[name]
+    book = {
+        'pdf': fixtures.make_pdf_fixture(os.path.join(fixture_dir, f'{name}.pdf'), **params),
+        'epub': fixtures.make_epub_fixture(os.path.join(fixture_dir, f'{name}.epub'), **params),
+    }
+    # p2 splits on the chapters JSON p1 writes, so the p2 stages get the same input as in a real run.
+    import p1_process_books as p1
+    p1.input_dir = fixture_dir
+    p1.use_result_cache = False
+    book['chapters_json'] = p1.extract_toc_from_pdf(book['pdf'])
+    return book
+
+# --- Function: Run Benchmark ---
+def run_benchmark(fixture_names, stage_names, repeat, overrides):
+    results = []
+    with tempfile.TemporaryDirectory(prefix='book2cbz_fixtures_') as fixture_dir:
+        for name in fixture_names:
+            print(f"Generating fixture '{name}' {fixtures.FIXTURES[name]}...")
+            stdout = sys.stdout
+            sys.stdout = open(os.devnull, 'w')
+            try:
+                book = prepare_fixture(name, fixture_dir)
+            finally:
+                sys.stdout = stdout
+            for stage in stage_names:
+                runs = []
+                error = None
+                for _ in range(repeat):
+                    try:
+                        runs.append(run_stage_isolated(stage, book, overrides))
+                    except Exception as e:
+                        error = str(e)
+                        break
+                # The fastest run is the least disturbed by the rest of the machine.
+                best = min(runs, key=lambda run: run['wall_s']) if runs else {}
+                results.append(dict({'fixture': name, 'stage': stage, 'runs': len(runs), 'error': error}, **best))
+                print_result(results[-1])
+    return results
+
+# --- Function: Report ---
+def format_kib(value):
+    return f"{value / 1024:.1f}" if value is not None else "-"
+
+def print_header():
+    print(f"{'fixture':<12} {'stage':<14} {'wall (ms)':>10} {'cpu (ms)':>10} {'peak RSS (MiB)':>15} {'output (KiB)':>13}")
+
+def print_result(result):
+    if result['error']:
+        print(f"{result['fixture']:<12} {result['stage']:<14} skipped: {result['error']}")
+        return
+    print(f"{result['fixture']:<12} {result['stage']:<14} {result['wall_s'] * 1000:>10.1f} {result['cpu_s'] * 1000:>10.1f} "
+          f"{format_kib(result['peak_rss_kib']):>15} {result['output_bytes'] / 1024:>13.1f}")
+
+def compare(before_path, after_path):
+    """Prints the change in wall time, CPU time, peak RSS and output size between two --json results."""
+    with open(before_path, 'r', encoding='utf-8') as f:
+        before = {(r['fixture'], r['stage']): r for r in json.load(f)['results'] if not r['error']}
+    with open(after_path, 'r', encoding='utf-8') as f:
+        after = {(r['fixture'], r['stage']): r for r in json.load(f)['results'] if not r['error']}
+
+    def change(key, old, new):
+        if old.get(key) in (None, 0) or new.get(key) is None:
+            return "-"
+        return f"{(new[key] / old[key] - 1) * 100:+.1f}%"
+
+    print(f"{'fixture':<12} {'stage':<14} {'wall':>9} {'cpu':>9} {'peak RSS':>9} {'output':>9}")
+    for key in [key for key in before if key in after]:
+        old, new = before[key], after[key]
+        print(f"{key[0]:<12} {key[1]:<14} {change('wall_s', old, new):>9} {change('cpu_s', old, new):>9} "
+              f"{change('peak_rss_kib', old, new):>9} {change('output_bytes', old, new):>9}")
+
+def parse_overrides(values):
+    """Turns --set p2.render_workers=4 style arguments into {'p2.render_workers': 4}."""
+    overrides = {}
+    for value in values:
+        name, _, raw = value.partition('=')
+        if not name.startswith(('p1.', 'p2.')) or not raw:
+            raise argparse.ArgumentTypeError(f"expected p1.FLAG=VALUE or p2.FLAG=VALUE, got '{value}'")
+        try:
+            overrides[name] = ast.literal_eval(raw)
+        except (ValueError, SyntaxError):
+            overrides[name] = raw
+    return overrides
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the conversion stages on synthetic books.")
+    parser.add_argument('--fixtures', default=','.join(fixtures.FIXTURES), help=f"Comma separated, from: {', '.join(fixtures.FIXTURES)}.")
+    parser.add_argument('--stages', default=','.join(DEFAULT_STAGES), help=f"Comma separated, from: {', '.join(STAGES)}.")
+    parser.add_argument('--repeat', type=int, default=3, help="Runs per stage; the fastest is reported.")
+    parser.add_argument('--set', action='append', default=[], metavar='pN.FLAG=VALUE', help="Override a p1/p2 flag, e.g. p2.render_workers=4.")
+    parser.add_argument('--json', help="Also write the results to this JSON file.")
+    parser.add_argument('--compare', nargs=2, metavar=('BEFORE', 'AFTER'), help="Compare two --json files instead of running.")
+    args = parser.parse_args()
+
+    if args.compare:
+        compare(*args.compare)
+        return
+
+    fixture_names = [name for name in args.fixtures.split(',') if name]
+    stage_names = [name for name in args.stages.split(',') if name]
+    unknown = [name for name in fixture_names if name not in fixtures.FIXTURES] + [name for name in stage_names if name not in STAGES]
+    if unknown:
+        parser.error(f"unknown fixture or stage: {', '.join(unknown)}")
+    overrides = parse_overrides(args.set)
+
+    print_header()
+    results = run_benchmark(fixture_names, stage_names, max(1, args.repeat), overrides)
+
+    if args.json:
+        with open(args.json, 'w', encoding='utf-8') as f:
+            json.dump({
+                'python': platform.python_version(),
+                'platform': platform.platform(),
+                'cpu_count': os.cpu_count(),
+                'overrides': overrides,
+                'fixtures': {name: fixtures.FIXTURES[name] for name in fixture_names},
+                'results': results,
+            }, f, indent=4)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,144 @@
+# /////////////////////////////////////////////////////////////////////////
+# //                                                                     //
+# //            Book 2 CBZ Converter by KenWeTech                        //
+# //            Benchmark fixtures: synthetic books                      //
+# //                                                                     //
+# /////////////////////////////////////////////////////////////////////////
+
+# Generates deterministic synthetic books for the benchmarks, entirely offline.
+# The same name and parameters always produce the same content, so runs on different machines or commits
+# measure the same work.
+
+import io
+import random
+import zipfile
+
+import numpy as np
+from PIL import Image
+import fitz  # PyMuPDF
+
+# name -> parameters for make_pdf_fixture / make_epub_fixture
+FIXTURES = {
+    'novella': {'pages': 60, 'image_density': 0.0, 'toc_depth': 1},
+    'illustrated': {'pages': 150, 'image_density': 0.3, 'toc_depth': 2},
+    'doorstop': {'pages': 800, 'image_density': 0.02, 'toc_depth': 3},
+}
+
+WORDS = ("the quick brown fox jumps over lazy dog while narrator keeps talking about "
+         "rivers mountains letters kings ships storms lanterns harbour evening").split()
+PAGES_PER_CHAPTER = 12
+
+# --- Function: Text ---
+def make_paragraphs(rng, count, words_per_paragraph=60):
+    return [" ".join(rng.choice(WORDS) for _ in range(words_per_paragraph)).capitalize() + "." for _ in range(count)]
+
+# --- Function: Illustration ---
+def make_illustration(seed, width=600, height=800):
+    """A smooth gradient with noise: compresses like a scanned illustration rather than flat colour."""
+    rng = np.random.default_rng(seed)
+    y, x = np.mgrid[0:height, 0:width]
+    base = (np.sin(x / 37.0 + seed) + np.cos(y / 53.0 - seed)) * 60 + 128
+    pixels = np.clip(base[..., None] + rng.normal(0, 18, (height, width, 3)), 0, 255).astype(np.uint8)
+    buffer = io.BytesIO()
+    Image.fromarray(pixels).save(buffer, 'JPEG', quality=85)
+    return buffer.getvalue()
+
+# --- Function: Outline ---
+def make_outline(chapter_count, toc_depth):
+    """Returns (level, title) for each chapter start. Depth 2 groups chapters into parts, depth 3 adds scenes."""
+    outline = []
+    for chapter in range(chapter_count):
+        if toc_depth >= 2 and chapter % 5 == 0:
+            outline.append([(1, f"Part {chapter // 5 + 1}")])
+        else:
+            outline.append([])
+        level = 2 if toc_depth >= 2 else 1
+        outline[-1].append((level, f"Chapter {chapter + 1}"))
+        if toc_depth >= 3:
+            outline[-1].append((level + 1, f"Scene {chapter + 1}.1"))
+    return outline
+
+# --- Function: PDF Fixture ---
+def make_pdf_fixture(path, pages, image_density=0.0, toc_depth=1, seed=0):
+    """Writes a PDF that looks like a Calibre conversion: text pages, some illustrations and a nested outline."""
+    rng = random.Random(seed)
+    doc = fitz.open()
+    toc = []
+    chapter_outline = make_outline((pages + PAGES_PER_CHAPTER - 1) // PAGES_PER_CHAPTER, toc_depth)
+    for page_num in range(pages):
+        page = doc.new_page(width=420, height=595)
+        if page_num % PAGES_PER_CHAPTER == 0:
+            for level, title in chapter_outline[page_num // PAGES_PER_CHAPTER]:
+                toc.append([level, title, page_num + 1])
+        if rng.random() < image_density:
+            page.insert_image(fitz.Rect(30, 30, 390, 565), stream=make_illustration(seed * 100003 + page_num))
+        else:
+            page.insert_textbox(fitz.Rect(30, 30, 390, 565), "\n\n".join(make_paragraphs(rng, 3, 40)), fontsize=11)
+    doc.set_toc(toc)
+    doc.save(path, garbage=1, deflate=True)
+    doc.close()
+    return path
+
+# --- Function: EPUB Fixture ---
+def make_epub_fixture(path, pages, image_density=0.0, toc_depth=1, seed=0):
+    """Writes an EPUB 2 book with roughly the same amount of text and images as the PDF fixture of the same size."""
+    rng = random.Random(seed)
+    chapter_count = (pages + PAGES_PER_CHAPTER - 1) // PAGES_PER_CHAPTER
+    chapter_outline = make_outline(chapter_count, toc_depth)
+    manifest = []
+    spine = []
+    nav_points = []
+
+    with zipfile.ZipFile(path, 'w') as epub_zip:
+        epub_zip.writestr('mimetype', 'application/epub+zip', compress_type=zipfile.ZIP_STORED)
+        epub_zip.writestr('META-INF/container.xml',
+                          '<?xml version="1.0"?><container version="1.0" xmlns="urn:oasis:names:tc:opendocument:xmlns:container">'
+                          '<rootfiles><rootfile full-path="OEBPS/content.opf" media-type="application/oebps-package+xml"/></rootfiles></container>',
+                          compress_type=zipfile.ZIP_DEFLATED)
+        for chapter in range(chapter_count):
+            body = []
+            for level, title in chapter_outline[chapter]:
+                body.append(f'<h{level}>{title}</h{level}>')
+            for page_num in range(PAGES_PER_CHAPTER):
+                if rng.random() < image_density:
+                    image_name = f'Images/image_{chapter}_{page_num}.jpg'
+                    epub_zip.writestr(f'OEBPS/{image_name}', make_illustration(seed * 100003 + chapter * 1000 + page_num),
+                                      compress_type=zipfile.ZIP_DEFLATED)
+                    manifest.append(f'<item id="img{chapter}_{page_num}" href="{image_name}" media-type="image/jpeg"/>')
+                    body.append(f'<p><img src="../{image_name}" alt=""/></p>')
+                body.extend(f'<p>{paragraph}</p>' for paragraph in make_paragraphs(rng, 3, 40))
+            epub_zip.writestr(f'OEBPS/Text/chapter_{chapter + 1}.xhtml',
+                              '<?xml version="1.0" encoding="utf-8"?>\n<html xmlns="http://www.w3.org/1999/xhtml">'
+                              f'<head><title>Chapter {chapter + 1}</title></head><body>{"".join(body)}</body></html>',
+                              compress_type=zipfile.ZIP_DEFLATED)
+            manifest.append(f'<item id="chapter{chapter + 1}" href="Text/chapter_{chapter + 1}.xhtml" media-type="application/xhtml+xml"/>')
+            spine.append(f'<itemref idref="chapter{chapter + 1}"/>')
+            nav_points.append((chapter_outline[chapter], f'Text/chapter_{chapter + 1}.xhtml'))
+
+        epub_zip.writestr('OEBPS/toc.ncx', make_ncx(nav_points), compress_type=zipfile.ZIP_DEFLATED)
+        epub_zip.writestr('OEBPS/content.opf',
+                          '<?xml version="1.0" encoding="utf-8"?>\n<package xmlns="http://www.idpf.org/2007/opf" version="2.0" unique-identifier="uid">'
+                          '<metadata xmlns:dc="http://purl.org/dc/elements/1.1/"><dc:title>Benchmark Book</dc:title>'
+                          f'<dc:identifier id="uid">benchmark-{seed}</dc:identifier><dc:language>en</dc:language><dc:creator>Benchmark</dc:creator></metadata>'
+                          f'<manifest><item id="ncx" href="toc.ncx" media-type="application/x-dtbncx+xml"/>{"".join(manifest)}</manifest>'
+                          f'<spine toc="ncx">{"".join(spine)}</spine></package>',
+                          compress_type=zipfile.ZIP_DEFLATED)
+    return path
+
+def make_ncx(nav_points):
+    """Builds a nested NCX navMap from the (outline entries, href) of each chapter file."""
+    xml = []
+    open_levels = []
+    play_order = 0
+    for entries, href in nav_points:
+        for level, title in entries:
+            while open_levels and open_levels[-1] >= level:
+                xml.append('</navPoint>')
+                open_levels.pop()
+            play_order += 1
+            xml.append(f'<navPoint id="nav{play_order}" playOrder="{play_order}"><navLabel><text>{title}</text></navLabel><content src="{href}"/>')
+            open_levels.append(level)
+    xml.extend('</navPoint>' for _ in open_levels)
+    return ('<?xml version="1.0" encoding="utf-8"?>\n<ncx xmlns="http://www.daisy.org/z3986/2005/ncx/" version="2005-1">'
+            '<head><meta name="dtb:uid" content="benchmark"/></head><docTitle><text>Benchmark Book</text></docTitle>'
+            f'<navMap>{"".join(xml)}</navMap></ncx>')
@@ -0,0 +1,47 @@
+# /////////////////////////////////////////////////////////////////////////
+# //                                                                     //
+# //            Book 2 CBZ Converter by KenWeTech                        //
+# //                 Calibre conversion worker                           //
+# //                                                                     //
+# /////////////////////////////////////////////////////////////////////////
+
+# =============================================================
+# =             Don't Make Any Changes Here                   =
+# =============================================================
+
+# Runs inside Calibre's own Python (started by p1_process_books.py as `calibre-debug -e calibre_worker.py`)
+# so Calibre's startup cost (Qt, plugins) is paid once instead of once per book.
+# Protocol: one JSON job per line on stdin, {"id": ..., "args": [input, output, options...]}.
+# Everything Calibre prints is passed through; each finished job is reported on a line of its own
+# starting with RESULT_MARKER followed by {"id": ..., "returncode": ..., "error": ...}. The line is written
+# after a line break, so output Calibre left without one cannot hide the marker.
+
+import sys
+import json
+import traceback
+
+RESULT_MARKER = '@@BOOK2CBZ_RESULT@@ '
+
+def run_job(ebook_convert, job):
+    try:
+        returncode = ebook_convert(['ebook-convert'] + job['args'])
+        return (returncode or 0), None
+    except SystemExit as e:
+        return (e.code if isinstance(e.code, int) else 1), None
+    except Exception:
+        return 1, traceback.format_exc()
+
+def main():
+    from calibre.ebooks.conversion.cli import main as ebook_convert
+
+    for line in sys.stdin:
+        if not line.strip():
+            continue
+        job = json.loads(line)
+        returncode, error = run_job(ebook_convert, job)
+        sys.stdout.flush()
+        sys.stdout.write('\n' + RESULT_MARKER + json.dumps({'id': job['id'], 'returncode': returncode, 'error': error}) + '\n')
+        sys.stdout.flush()
+
+if __name__ == '__main__':
+    main()
@@ -20,22 +20,65 @@ CONFIG_FLAGS = {
         'add_first_page': (bool, "Add 'First Page' to TOC? (neccessary for chapter splitting when keeping cover page) (True/False)", True),
         'run_organize_epub': (bool, "Organize root files into subfolders? (neccessary for chapter splitting) (True/False)", True),
         'run_extract_toc': (bool, "Extract TOC from files that are available? (neccessary for chapter splitting) (True/False)", True),
+        'toc_split_level': (int, "Table of contents level to split chapters at? (1 = top-level entries, 2 = entries inside them, e.g. chapters inside parts) (integer)", 1),
         'font_size': (int, "Font size of text in the converted book(default size is great for small screens) (integer)", 30),
+        'book_workers': (int, "Number of book folders processed at the same time? (1 = one at a time) (integer)", 1),
+        'convert_workers': (int, "Maximum number of Calibre conversions running at the same time? (each one is memory hungry) (integer)", 1),
+        'use_result_cache': (bool, "Skip EPUBs that are unchanged since their CBZ was made? (keeps a cache file in the book directory) (True/False)", True),
+        'use_calibre_worker': (bool, "Keep Calibre running between books instead of starting it for every EPUB? (much faster for many short books, needs calibre-debug) (True/False)", False),
+        'calibre_job_timeout': (int, "Seconds one EPUB conversion may take before it is stopped? (0 = no limit) (integer)", 1800),
+        'calibre_memory_limit_mb': (int, "Memory in MB one EPUB conversion may use before it is stopped? (0 = no limit) (integer)", 0),
+        'use_pymupdf_reader': (bool, "Read PDF chapters and metadata with PyMuPDF when it is installed? (faster on large books, False uses PyPDF2) (True/False)", True),
+        'pass_css_to_calibre': (bool, "Give the font size to Calibre as extra CSS instead of writing a modified copy of each EPUB? (saves one EPUB read/write per book) (True/False)", True),
+        'fast_epub_patch': (bool, "Add the font size to EPUBs by patching their files directly? (much faster than rebuilding the EPUB, False uses ebooklib) (True/False)", True),
+        'repack_image_epubs': (bool, "Put the page images of image-only EPUBs (manga, comics) straight into a CBZ, without Calibre? (much faster, images are kept as they are) (True/False)", True),
+        'render_epub_directly': (bool, "Render EPUBs straight to CBZ without Calibre? (much faster, but layout differs from Calibre's and p2 settings apply from p2_create_cbz.py) (True/False)", False),
+        'log_stage_timings': (bool, "Log how long each book and step took to .book2cbz_timings.jsonl in the book directory? (summarized at the end of convert_books.py) (True/False)", True),
     },
     'p2_create_cbz.py': {
         'delete_pdf': (bool, "Delete PDF files after processing? (set to false if this is in your calibre library and you want to keep this format) (True/False)", True),
         'delete_json': (bool, "Delete JSON files after processing? (chapters and metadata files that were created for conversion) (True/False)", True),
         'crop_white_margins_enabled': (bool, "Crop white margins from pages? (reduces the empty white space thats not text, optional but True is recommended) (True/False)", False),
+        'crop_white_threshold': (int, "Crop tolerance: pixels darker than this (0-255) count as content, 255 = only pure white is cropped (integer)", 250),
+        'crop_per_chapter': (bool, "Crop every page of a chapter with the same box so page sizes stay consistent? (True/False)", False),
         'create_comicinfo_enabled': (bool, "Create ComicInfo.xml file for keeping metadata? (Set FALSE for file structure naming convention in Kavita for example) (True/False)", True),
-        'chapter_page_filter_threshold': (int, "Chapter page filter threshold: (number of pages to still be considered chapter 1) (integer)", 8),
+        'chapter_page_filter_threshold': (int, "Chapter page filter threshold: (number of pages to still be considered chapter 1; only for chapter lists from older versions) (integer)", 8),
         'min_chapters_for_split': (int, "Minimum chapters needed to split CBZ Book into chapters, set to 9999 to make a single CBZ for book. (integer)", 3),
         'overwrite_existing_cbz': (bool, "Overwrite existing CBZ files? (True/False)", True),
+        'use_result_cache': (bool, "Skip PDFs that are unchanged since their CBZ was made? (keeps a cache file in the book directory) (True/False)", True),
+        'use_page_cache': (bool, "Keep rendered pages on disk so reruns with other chapter, crop or image settings skip rendering? (needs delete_pdf False) (True/False)", False),
+        'page_cache_size_mb': (int, "Maximum size of the page cache in MB? (least recently used pages are removed beyond it) (integer)", 2048),
         'remove_prefix_cbz': (bool, "Remove 'V ' prefix from CBZ files? (neccessary clean up for file structure naming convention setting) (True/False)", True),
         'HighRes': (bool, "Turn on high resolution for images?. False for standard. (recommended for images with text, increases file size) (True/False)", False),
+        'target_dpi': (int, "Render pages at this DPI? (72 = standard, 150 = sharp text, 0 = use the HighRes setting) (integer)", 0),
+        'target_width': (int, "Render every page this many pixels wide, e.g. your e-reader's screen width? (0 = use the DPI setting) (integer)", 0),
+        'image_format': (str, "Page image format? (webp, jpeg, png or avif; avif needs a recent Pillow) (text)", 'webp'),
+        'image_quality': (int, "Image quality for webp, jpeg and avif pages (1-100, lower = smaller files) (integer)", 75),
+        'image_effort': (int, "Encoder effort (0 = fastest, 6 = smallest files) (integer)", 4),
+        'grayscale_pages': (str, "Store pages in grayscale? (off, auto = only pages without colour, always) (text)", 'off'),
+        'grayscale_bits': (int, "Gray levels for grayscale pages as bits (4 = 16 levels, enough for e-ink; 8 = full) (integer)", 4),
+        'cbz_compress_images': (bool, "Deflate page images inside the CBZ? (False stores them as-is, they are already compressed so this only costs time) (True/False)", False),
+        'cbz_compresslevel': (int, "Compression level for ComicInfo.xml and other compressed CBZ entries (1 = fastest, 9 = smallest) (integer)", 6),
+        'stream_to_cbz': (bool, "Write rendered pages straight into the CBZ without temporary image files? (faster on slow disks) (True/False)", True),
+        'use_pymupdf_renderer': (bool, "Render pages in-process with PyMuPDF? (much faster, False falls back to ImageMagick) (True/False)", True),
+        'skip_blank_pages': (bool, "Leave blank pages (e.g. Calibre's empty separator pages) out of the CBZ? (True/False)", False),
+        'passthrough_scanned_pages': (bool, "Copy the page image of scanned PDFs into the CBZ unchanged instead of rendering it? (faster, exact scan quality, not resized; not used when cropping white margins or forcing grayscale) (True/False)", True),
+        'magick_timeout': (int, "Seconds one ImageMagick run may take before it is stopped? (0 = no limit) (integer)", 600),
+        'magick_memory_limit_mb': (int, "Memory in MB one ImageMagick run may use before it is stopped? (0 = no limit) (integer)", 0),
+        'render_workers': (int, "Number of processes rendering the pages of a book in parallel? (1 = single core, set to your CPU core count for large books) (integer)", 1),
+        'render_window_pages': (int, "Pages rendered and written out at a time? (keeps memory use flat for long books, 0 = a whole chapter at once) (integer)", 32),
+        'book_workers': (int, "Number of books converted at the same time? (1 = one at a time) (integer)", 1),
+        'log_stage_timings': (bool, "Log how long each book, chapter and step took to .book2cbz_timings.jsonl in the book directory? (True/False)", True),
 
+    },
+    'convert_books.py': {
+        'run_as_pipeline': (bool, "Create each book's CBZ while the next book is being prepared? (faster, False runs p1 for all books and then p2) (True/False)", True),
+        'pipeline_queue_size': (int, "Maximum number of prepared books waiting for CBZ creation? (limits disk space used by intermediate PDFs) (integer)", 2),
     }
 }
 
+FLAG_VALUE_PATTERN = r"(True|False|\d+|'[^'\n]*'|\"[^\"\n]*\")"  # Values the flags can have: booleans, integers and quoted text
+
 def parse_input(prompt, expected_type, current_value, default_value):
     while True:
         suffix = f" [current: {current_value}, default: {default_value}]"
@@ -50,6 +93,8 @@ def parse_input(prompt, expected_type, current_value, default_value):
         elif expected_type is int:
             if raw.isdigit():
                 return int(raw)
+        elif expected_type is str:
+            return raw.strip('\'"').lower()
         print("Invalid input. Try again. Acceptable: True/False, T/F, Yes/No, Y/N for booleans, or an integer.")
 
 def read_current_flags(script_path, flag_defs):
@@ -58,11 +103,13 @@ def read_current_flags(script_path, flag_defs):
         with open(script_path, 'r', encoding='utf-8') as f:
             content = f.read()
         for flag_name in flag_defs:  # Iterate through flag names in flag_defs
-            match = re.search(rf"{flag_name}\s*=\s*(True|False|\d+)", content)
+            match = re.search(rf"{flag_name}\s*=\s*{FLAG_VALUE_PATTERN}", content)
             if match:
                 value = match.group(1)
                 if value in ['True', 'False']:
                     current_flags[flag_name] = value == 'True'
+                elif value[0] in '\'"':
+                    current_flags[flag_name] = value[1:-1]
                 else:
                     current_flags[flag_name] = int(value)
             else:
@@ -122,11 +169,11 @@ def update_flags_in_script(script_path, flags):
 
     for flag, value in flags.items():
         escaped_flag = re.escape(flag)
-        pattern_str = r"({}\s*=\s*)(True|False|\d+)".format(escaped_flag)
+        pattern_str = r"({}\s*=\s*){}".format(escaped_flag, FLAG_VALUE_PATTERN)
         pattern = re.compile(pattern_str)
         match = pattern.search(updated_content)
         if match:
-            replacement = f"{match.group(1)}{value}"
+            replacement = f"{match.group(1)}{value!r}" if isinstance(value, str) else f"{match.group(1)}{value}"
             updated_content = updated_content.replace(match.group(0), replacement, 1)
             update_summary[flag] = 1
         else:
@@ -148,24 +195,28 @@ def verify_changes(script_path, intended_flags, original_flag_defs):
 def main():
     print("\n🔧 Convert Books Configuration Console by KenWeTech\n")
 
-    update_choice = input("Which script(s) do you want to configure? (p1, p2, or leave blank for both): ").strip().lower()
+    update_choice = input("Which script(s) do you want to configure? (p1, p2, convert, or leave blank for all): ").strip().lower()
 
     scripts_to_configure = []
-    if not update_choice or update_choice == 'both':
-        scripts_to_configure = ['p1_process_books.py', 'p2_create_cbz.py']
+    if not update_choice or update_choice in ['both', 'all']:
+        scripts_to_configure = ['p1_process_books.py', 'p2_create_cbz.py', 'convert_books.py']
     elif update_choice == 'p1':
         scripts_to_configure = ['p1_process_books.py']
     elif update_choice == 'p2':
         scripts_to_configure = ['p2_create_cbz.py']
+    elif update_choice == 'convert':
+        scripts_to_configure = ['convert_books.py']
     else:
-        print("Invalid choice. Configuring both scripts.")
-        scripts_to_configure = ['p1_process_books.py', 'p2_create_cbz.py']
+        print("Invalid choice. Configuring all scripts.")
+        scripts_to_configure = ['p1_process_books.py', 'p2_create_cbz.py', 'convert_books.py']
 
     updated_directories = {}
     update_directories_choice = input(f"Do you want to update the book directory in the selected script(s)? (yes/no, default: no): ").strip().lower()
 
     if update_directories_choice in ['yes', 'y']:
         for script in scripts_to_configure:
+            if script == 'convert_books.py':
+                continue  # convert_books.py works on the directory it is started in
             current_dir = get_current_directory(script)
             default_dir_meaning = "sets scanning to the directory of the scripts location"
             print(f"\n--- Configure '{script}' Directory ---")
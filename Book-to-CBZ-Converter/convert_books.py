@@ -4,16 +4,26 @@
 # //                                                                     //
 # /////////////////////////////////////////////////////////////////////////
 
+# --- Configuration Flags ---
+run_as_pipeline = True  # Set to True to create each book's CBZ as soon as p1 has finished it, while p1 goes on with the next book. False runs p1 for every book, then p2.
+pipeline_queue_size = 2  # Maximum number of finished book folders waiting for p2. p1 pauses when this many are waiting, which limits the space taken by intermediate PDFs.
+
 # =============================================================
 # =           Don't Make Any Changes Here                     =
 # =============================================================
 
 import os
 import sys
-import subprocess
 import datetime
 import time
 import shutil
+import queue
+import threading
+import traceback
+import multiprocessing
+import concurrent.futures
+import instrumentation
+import process_runner
 
 try:
     from colorama import Fore, Style, init as colorama_init
@@ -35,51 +45,128 @@ def print_status(message, status="info"):
     elif status == "warn":
         print(Fore.YELLOW + message + Style.RESET_ALL)
 
-print_status("Starting book conversion...", "info")
-print()
-
-def run_python_script(script_name, target_folder):
+def save_error_log(target_folder, lines):
     log_file_name = f"error_log_{datetime.datetime.now().strftime('%Y%m%d_%H%M%S')}.txt"
     log_file_path = os.path.join(target_folder, log_file_name)
-    try:
-        print_status(f"Running {script_name} in {target_folder}...", "info")
-        process = subprocess.run(
-            [sys.executable, script_name, target_folder],
-            check=True,  # Raise an exception for non-zero exit codes
-            capture_output=True,
-            text=True
-        )
-        print_status(f"{script_name} completed successfully.", "success")
-    except subprocess.CalledProcessError as e:
-        print_status(f"Error occurred during {script_name}:", "error")
-        print(f"Return Code: {e.returncode}")
-        print(f"Stdout:\n{e.stdout}")
-        print(f"Stderr:\n{e.stderr}")
-        with open(log_file_path, "w") as f:
-            f.write(f"Error during {script_name} at {datetime.datetime.now()}\n")
-            f.write(f"Return Code: {e.returncode}\n")
-            f.write(f"Stdout:\n{e.stdout}\n")
-            f.write(f"Stderr:\n{e.stderr}\n")
-        print_status(f"Error details saved to: {log_file_path}", "warn")
-        sys.exit(1)
-    except FileNotFoundError:
+    with open(log_file_path, "w") as f:
+        f.writelines(line + "\n" for line in lines)
+    print_status(f"Error details saved to: {log_file_path}", "warn")
+
+def run_python_script(script_name, target_folder):
+    if not os.path.exists(script_name):
         print_status(f"Error: Python script '{script_name}' not found in the current directory.", "error")
         sys.exit(1)
+    try:
+        print_status(f"Running {script_name} in {target_folder}...", "info")
+        # Unbuffered, so the script's output shows up line by line instead of in blocks.
+        job = process_runner.run_command([sys.executable, script_name, target_folder], label=script_name,
+                                         env=dict(os.environ, PYTHONUNBUFFERED='1'))
     except Exception as e:
         print_status(f"An unexpected error occurred: {e}", "error")
         sys.exit(1)
+    if job['status'] != process_runner.STATUS_OK:
+        print_status(f"Error occurred during {script_name}: it {process_runner.describe_failure(job)}", "error")
+        save_error_log(target_folder, [
+            f"Error during {script_name} at {datetime.datetime.now()}",
+            f"Return Code: {job['returncode']}",
+            f"Output (last {process_runner.OUTPUT_TAIL_LINES} lines):\n{job['output']}",
+        ])
+        sys.exit(1)
+    print_status(f"{script_name} completed successfully.", "success")
+
+def run_pipeline(target_folder):
+    """Runs p1 and p2 side by side in this process: every book folder p1 finishes is queued for p2 right away.
+
+    p2 converts in its own worker process(es) so rendering never competes with p1 for this interpreter. They are
+    spawned, not forked: p1's threads are already running when they start, and a forked child would inherit any lock
+    one of them holds (stdout, the timing log, the result cache) with nobody left to release it.
+    p1 waits while pipeline_queue_size folders are queued, so only a few intermediate PDFs exist at a time.
+    """
+    import p1_process_books as p1
+    import p2_create_cbz as p2
+
+    print_status(f"Running p1_process_books.py and p2_create_cbz.py as a pipeline in {target_folder}...", "info")
+    pending = queue.Queue(maxsize=max(1, pipeline_queue_size))
+    handed_over = set()
+    p2_workers = max(1, p2.book_workers)
+
+    def convert_folder(executor, job):
+        try:
+            failures = executor.submit(p2.process_pdf_folder, job).result()
+        except Exception as e:
+            failures = len(job[1])
+            print_status(f"Error creating CBZ files in {job[0]}: {e}", "error")
+        if failures:
+            print_status(f"CBZ files for {job[0]} finished with {failures} error(s)", "warn")
+        else:
+            print_status(f"Created CBZ files for {job[0]}", "success")
+
+    def create_cbz_files(executor):
+        while True:
+            folder_path = pending.get()
+            if folder_path is None:
+                return
+            job = p2.get_pdf_job(folder_path)
+            if job:
+                convert_folder(executor, job)
+
+    def folder_done(folder_path, failures):
+        handed_over.add(folder_path)
+        pending.put(folder_path)  # Blocks p1 while the queue is full
+
+    with concurrent.futures.ProcessPoolExecutor(max_workers=p2_workers, mp_context=multiprocessing.get_context('spawn')) as executor:
+        consumers = [threading.Thread(target=create_cbz_files, args=(executor,)) for _ in range(p2_workers)]
+        for consumer in consumers:
+            consumer.start()
+        try:
+            p1.process_books_in_directory(p1.input_dir, on_folder_done=folder_done)
+        finally:
+            for _ in consumers:
+                pending.put(None)
+            for consumer in consumers:
+                consumer.join()
+
+        # p2 on its own converts every PDF in the library, so PDFs p1 never handed over are converted last.
+        for job in p2.find_pdf_jobs(p2.input_dir):
+            if job[0] not in handed_over:
+                convert_folder(executor, job)
+
+    if p2.remove_prefix_cbz:
+        p2.remove_cbz_prefixes(p2.input_dir)
+    print_status("p1_process_books.py and p2_create_cbz.py completed.", "success")
 
 if __name__ == "__main__":
+    print_status("Starting book conversion...", "info")
+    print()
+
     target_folder = os.getcwd()
     print_status(f"Target folder set to current directory: {target_folder}", "info")
 
-    run_python_script("p1_process_books.py", target_folder)
-    run_python_script("p2_create_cbz.py", target_folder)
+    # p1 and p2 log their timings under this run's id, so both parts are summarized together.
+    instrumentation.export_run_id()
+    if run_as_pipeline:
+        try:
+            run_pipeline(target_folder)
+        except Exception:
+            print_status("An error occurred in the conversion pipeline:", "error")
+            print(traceback.format_exc())
+            save_error_log(target_folder, [f"Error during the conversion pipeline at {datetime.datetime.now()}", traceback.format_exc()])
+            sys.exit(1)
+    else:
+        run_python_script("p1_process_books.py", target_folder)
+        run_python_script("p2_create_cbz.py", target_folder)
 
     print_status("All tasks completed!", "success")
 
-if os.path.exists("__pycache__"):
-    shutil.rmtree("__pycache__")
+    timing_summary = instrumentation.summarize(target_folder)
+    if timing_summary:
+        print()
+        print_status(f"Timings (details in {instrumentation.LOG_FILE_NAME}):", "info")
+        for line in timing_summary:
+            print(line)
+
+    if os.path.exists("__pycache__"):
+        shutil.rmtree("__pycache__")
 
-    time.sleep(5)
+        time.sleep(5)
 
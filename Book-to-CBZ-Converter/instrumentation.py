@@ -0,0 +1,211 @@
+# /////////////////////////////////////////////////////////////////////////
+# //                                                                     //
+# //            Book 2 CBZ Converter by KenWeTech                        //
+# //                 Timing log (shared by p1, p2 and convert_books)     //
+# //                                                                     //
+# /////////////////////////////////////////////////////////////////////////
+
+# =============================================================
+# =             Don't Make Any Changes Here                   =
+# =============================================================
+
+# Records how long every book, chapter and stage took as JSON lines in the library root, so a slow run can be
+# traced to Calibre, rendering, cropping or zipping. One line per record:
+#   {"run", "script", "pid", "kind": "book"|"chapter"|"stage"|"job", "name", "book", "time", "duration_s", "calls",
+#    "pages", "bytes", "error"}
+# 'job' records come from process_runner.py and carry the external program's "status" and "returncode".
+# Stage times are added up per book and written when the book finishes, so a 500 page book gives one
+# 'rasterize' line, not 500. convert_books.py sets BOOK2CBZ_RUN_ID so p1 and p2 lines of one run can be
+# summarized together. The log only grows; it is safe to delete at any time.
+
+import os
+import json
+import time
+import uuid
+import threading
+import contextlib
+
+LOG_FILE_NAME = '.book2cbz_timings.jsonl'
+RUN_ID_ENV = 'BOOK2CBZ_RUN_ID'
+
+_log_path = None
+_run_id = os.environ.get(RUN_ID_ENV) or uuid.uuid4().hex[:12]
+_write_lock = threading.Lock()
+_local = threading.local()  # Per thread: stack of open book records
+
+# --- Function: Configure ---
+def configure(library_dir, enabled=True):
+    """Starts (or with enabled=False stops) logging to the timing log in library_dir."""
+    global _log_path
+    _log_path = os.path.join(library_dir, LOG_FILE_NAME) if enabled else None
+
+# --- Function: Share Run ID ---
+def export_run_id():
+    """Makes scripts started from this process log under this process's run id. Returns the id."""
+    os.environ[RUN_ID_ENV] = _run_id
+    return _run_id
+
+def _books():
+    if not hasattr(_local, 'books'):
+        _local.books = []
+    return _local.books
+
+def _write(record):
+    if not _log_path:
+        return
+    line = json.dumps(record, ensure_ascii=False) + '\n'
+    try:
+        # One append per line keeps lines from parallel workers and processes whole.
+        with _write_lock, open(_log_path, 'a', encoding='utf-8') as f:
+            f.write(line)
+    except OSError:
+        pass
+
+def _new_record(kind, name, **fields):
+    books = _books()
+    record = {'run': _run_id, 'script': books[-1]['script'] if books else None, 'pid': os.getpid(), 'kind': kind,
+              'name': name, 'book': books[-1]['name'] if books else None, 'time': time.time()}
+    record.update(fields)
+    return record
+
+# --- Function: Record ---
+def record(kind, name, duration_s, **fields):
+    """Writes one finished record, e.g. a chapter with its pages and bytes."""
+    _write(_new_record(kind, name, duration_s=duration_s, **fields))
+
+# --- Function: Book Span ---
+@contextlib.contextmanager
+def book(name, script=None, nested=False):
+    """Times one book. Stage times added while it is open are written with it. Yields the record for extra fields.
+
+    script ('p1' or 'p2') labels the book and everything logged inside it. A book opened inside another (p1 handing an EPUB to p2's process_pdf) is marked 'nested' and takes the stages
+    added while it is open; the summary counts only the outer one as a book. nested=True marks a book as nested when
+    its outer book is open in another process.
+    """
+    entry = _new_record('book', name)
+    books = _books()
+    if books or nested:
+        entry['nested'] = True
+    entry['book'] = name
+    entry['script'] = script
+    entry['stages'] = {}
+    books.append(entry)
+    start = time.perf_counter()
+    try:
+        yield entry
+    except BaseException as e:
+        entry['error'] = repr(e)
+        raise
+    finally:
+        entry['duration_s'] = time.perf_counter() - start
+        books.remove(entry)
+        for stage_name, totals in entry.pop('stages').items():
+            _write(dict(_new_record('stage', stage_name, book=name, script=script), **totals))
+        _write(entry)
+
+# --- Function: Add Stage Time ---
+def add_stage(name, seconds, pages=0, bytes_written=0, calls=1):
+    """Adds time spent in a stage to the open book (or writes it straight away outside a book)."""
+    books = _books()
+    if not books:
+        _write(_new_record('stage', name, duration_s=seconds, calls=calls, pages=pages, bytes=bytes_written))
+        return
+    totals = books[-1]['stages'].setdefault(name, {'duration_s': 0.0, 'calls': 0, 'pages': 0, 'bytes': 0})
+    totals['duration_s'] += seconds
+    totals['calls'] += calls
+    totals['pages'] += pages
+    totals['bytes'] += bytes_written
+
+def add_stages(timings, pages=0):
+    """Adds a {stage: seconds} dict, as filled by timer() in a render worker."""
+    for name, seconds in timings.items():
+        add_stage(name, seconds, pages=pages)
+
+# --- Function: Stage Span ---
+@contextlib.contextmanager
+def stage(name, pages=0, output_path=None):
+    """Times a block as part of a stage. Yields a dict; set 'bytes' or 'pages' in it to count output.
+
+    With output_path, the size of that file when the block ends is counted as the bytes written.
+    """
+    counters = {'pages': pages, 'bytes': 0}
+    start = time.perf_counter()
+    try:
+        yield counters
+    finally:
+        if output_path:
+            counters['bytes'] += file_size(output_path)
+        add_stage(name, time.perf_counter() - start, pages=counters['pages'], bytes_written=counters['bytes'])
+
+@contextlib.contextmanager
+def timer(timings, name):
+    """Adds the time spent in a block to timings[name]. Does nothing when timings is None. Safe in any process."""
+    if timings is None:
+        yield
+        return
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        timings[name] = timings.get(name, 0.0) + time.perf_counter() - start
+
+# --- Function: File Size ---
+def file_size(path):
+    try:
+        return os.path.getsize(path)
+    except (OSError, TypeError):
+        return 0
+
+# --- Function: Summarize Run ---
+def summarize(library_dir, run_id=None):
+    """Returns report lines for one run (default: this process's run) from the timing log."""
+    run_id = run_id or _run_id
+    records = []
+    try:
+        with open(os.path.join(library_dir, LOG_FILE_NAME), 'r', encoding='utf-8') as f:
+            for line in f:
+                try:
+                    entry = json.loads(line)
+                except ValueError:
+                    continue
+                if entry.get('run') == run_id:
+                    records.append(entry)
+    except OSError:
+        return []
+    if not records:
+        return []
+
+    stages = {}
+    for entry in records:
+        if entry['kind'] != 'stage':
+            continue
+        totals = stages.setdefault((entry.get('script'), entry['name']), {'duration_s': 0.0, 'calls': 0, 'pages': 0, 'bytes': 0, 'books': set(), 'max_s': 0.0})
+        totals['duration_s'] += entry['duration_s']
+        totals['calls'] += entry.get('calls', 1)
+        totals['pages'] += entry.get('pages', 0)
+        totals['bytes'] += entry.get('bytes', 0)
+        totals['books'].add(entry.get('book'))
+        totals['max_s'] = max(totals['max_s'], entry['duration_s'])
+
+    books = [entry for entry in records if entry['kind'] == 'book' and not entry.get('nested')]
+    chapters = [entry for entry in records if entry['kind'] == 'chapter']
+    # A pipelined book is logged by both p1 and p2, so books are counted by name.
+    book_names = {entry['name'] for entry in books}
+    failed_names = {entry['name'] for entry in books if entry.get('error')}
+    per_script = ", ".join(f"{script}: {len({entry['name'] for entry in books if (entry.get('script') or '-') == script})}"
+                           for script in sorted({entry.get('script') or '-' for entry in books}))
+    lines = [f"Books: {len(book_names)} timed ({per_script}), {len(failed_names)} failed; chapters written: {len(chapters)}"]
+    lines.append(f"{'script':<7} {'stage':<14} {'books':>6} {'total s':>9} {'per book s':>11} {'max s':>8} {'pages':>7} {'MiB':>9}")
+    for (script, name), totals in sorted(stages.items(), key=lambda item: -item[1]['duration_s']):
+        book_count = len(totals['books'])
+        lines.append(f"{script or '-':<7} {name:<14} {book_count:>6} {totals['duration_s']:>9.1f} {totals['duration_s'] / max(1, book_count):>11.2f} "
+                     f"{totals['max_s']:>8.1f} {totals['pages']:>7} {totals['bytes'] / 1024 / 1024:>9.1f}")
+    slowest = sorted(books, key=lambda entry: -entry['duration_s'])[:5]
+    if slowest:
+        lines.append("Slowest books:")
+        lines.extend(f"  {entry['duration_s']:>8.1f} s  {entry.get('script') or '-'}  {entry['name']}" for entry in slowest)
+    failed_jobs = [entry for entry in records if entry['kind'] == 'job' and entry.get('status') != 'ok']
+    if failed_jobs:
+        lines.append("Failed external jobs (converted again on the next run):")
+        lines.extend(f"  {entry['status']:<9} {entry['name']:<14} {entry.get('book') or '-'}" for entry in failed_jobs)
+    return lines
@@ -6,15 +6,36 @@
 # /////////////////////////////////////////////////////////////////////////
 
 import os
+import time
 import subprocess
 import json
-import time
 import shutil
+import tempfile
 import re
+import copy
+import contextlib
+import struct
+import zipfile
+import posixpath
+import urllib.parse
+import threading
+import queue
+import atexit
+import collections
+import multiprocessing
+import concurrent.futures
 from PyPDF2 import PdfReader
+try:
+    import fitz  # PyMuPDF, optional here: reads outlines much faster than PyPDF2
+except ImportError:
+    fitz = None
 from ebooklib import epub
 from bs4 import BeautifulSoup
 import xml.etree.ElementTree as ET
+import result_cache
+import toc_model
+import instrumentation
+import process_runner
 
 # --- Input Directory Setup ---
 # Define input directory.
@@ -31,7 +52,20 @@ delete_opf = True    # Set to True to delete the OPF metadata file after process
 add_first_page = True  # Set to True to add "First Page" to the PDF's table of contents. False skips it.
 run_organize_epub = True  # Set to True to organize the files into subfolders based on book titles. False skips it.
 run_extract_toc = True    # Set to True to extract the table of contents from PDF files. False skips it.
+toc_split_level = 1  # Table of contents level to split chapters at. 1 = top-level entries, 2 = entries inside them (e.g. chapters inside parts).
 font_size = 30  # Default font size for the converted PDF.
+book_workers = 1  # Number of book folders processed at the same time. 1 processes one folder at a time.
+convert_workers = 1  # Maximum number of Calibre ebook-convert jobs running at the same time.
+use_result_cache = True  # Set to True to skip EPUBs whose content and settings are unchanged since the last run.
+use_calibre_worker = False  # Set to True to keep Calibre running between books (calibre-debug) instead of starting ebook-convert for every EPUB.
+calibre_job_timeout = 1800  # Seconds one EPUB conversion may take before it is stopped and counted as failed. 0 disables the limit.
+calibre_memory_limit_mb = 0  # Memory (MB) one EPUB conversion may use, Calibre's helper processes included, before it is stopped. 0 disables the limit.
+pass_css_to_calibre = True  # Set to True to hand the font CSS to ebook-convert (--extra-css) so no modified EPUB is written. False writes a modified copy first.
+use_pymupdf_reader = True  # Set to True to read PDF outlines and metadata with PyMuPDF when it is installed (faster). False uses PyPDF2.
+fast_epub_patch = True  # Set to True to add the font CSS by patching the EPUB's files directly (fast). False rebuilds the whole EPUB with ebooklib.
+repack_image_epubs = True  # Set to True to put the page images of image-only EPUBs (manga, comics, picture books) straight into a CBZ, without Calibre or a PDF. False converts them like any other EPUB.
+render_epub_directly = False  # Set to True to render EPUBs straight to CBZ with PyMuPDF (no Calibre, no intermediate PDF). False converts with Calibre first.
+log_stage_timings = True  # Set to True to append book and stage timings to .book2cbz_timings.jsonl in input_dir. False logs nothing.
 REMOVE_KEYWORDS = ['About the Author', 'Prologue', 'Epilogue', 'Contents', 'Notes', 'Dedication', 'Acknowledgments', 'About the Publisher', 'Copyright'] # Keywords to Remove from TOC
 
 
@@ -60,13 +94,93 @@ def print_status(message, status="info"):
     elif status == "warn":
         print(Fore.YELLOW + message + Style.RESET_ALL)
 
+# --- Function: Font CSS ---
+def get_font_css():
+    """Returns the CSS that sets the font size and font family of the converted book."""
+    return f"""body {{ font-size: {font_size}px !important; font-family: "Times New Roman", serif !important; }}"""
+
 # --- Function: Modify EPUB Font Size and Family ---
 def modify_epub_font(epub_path):
     """Modifies the font size and font family of the EPUB before conversion."""
+    if fast_epub_patch:
+        modified_epub_path = epub_path.replace('.epub', '_modified.epub')
+        try:
+            patch_epub_font(epub_path, modified_epub_path)
+            print_status(f"Modified EPUB saved as {modified_epub_path}", "success")
+            return modified_epub_path
+        except Exception as e:
+            print_status(f"Could not patch {epub_path} directly ({e}), rebuilding it with ebooklib.", "warn")
+            if os.path.exists(modified_epub_path):
+                os.remove(modified_epub_path)
+    return rebuild_epub_font(epub_path)
+
+# --- Function: Patch EPUB Font Size and Family ---
+FONT_CSS_NAME = 'styles/font-size.css'
+FONT_CSS_ID = 'book2cbz-font-size'
+HEAD_END_PATTERN = re.compile(rb'</head\s*>', re.IGNORECASE)
+MANIFEST_END_PATTERN = re.compile(rb'</(?:[\w-]+:)?manifest\s*>')
+
+def copy_zip_entry_raw(source_file, zout, info):
+    """Copies one entry's compressed bytes into zout without decompressing and recompressing them."""
+    source_file.seek(info.header_offset)
+    name_length, extra_length = struct.unpack('<HH', source_file.read(30)[26:30])
+    source_file.seek(info.header_offset + 30 + name_length + extra_length)
+    data = source_file.read(info.compress_size)
+
+    new_info = copy.copy(info)
+    new_info.flag_bits &= ~0x08  # Sizes are written up front, so no data descriptor follows the data
+    new_info.header_offset = zout.fp.tell()
+    zout.fp.write(new_info.FileHeader())
+    zout.fp.write(data)
+    zout.filelist.append(new_info)
+    zout.NameToInfo[new_info.filename] = new_info
+    zout.start_dir = zout.fp.tell()
+
+def patch_epub_font(epub_path, modified_epub_path):
+    """Writes a copy of the EPUB with the font CSS linked from every XHTML page.
+
+    Only the OPF manifest and the XHTML pages are rewritten, and only at the byte level (a <link> before </head>).
+    Images, fonts and everything else are copied still compressed.
+    """
+    with zipfile.ZipFile(epub_path) as zin, open(epub_path, 'rb') as source_file:
+        container = ET.fromstring(zin.read('META-INF/container.xml'))
+        rootfile = container.find('.//{urn:oasis:names:tc:opendocument:xmlns:container}rootfile')
+        opf_name = rootfile.get('full-path')
+        opf_dir = posixpath.dirname(opf_name)
+        opf_data = zin.read(opf_name)
+
+        html_names = set()
+        for item in ET.fromstring(opf_data).iter('{http://www.idpf.org/2007/opf}item'):
+            if item.get('media-type') == 'application/xhtml+xml' and item.get('href'):
+                html_names.add(posixpath.normpath(posixpath.join(opf_dir, urllib.parse.unquote(item.get('href')))))
+
+        css_name = posixpath.join(opf_dir, FONT_CSS_NAME)
+        manifest_item = f'<item id="{FONT_CSS_ID}" href="{FONT_CSS_NAME}" media-type="text/css"/>'.encode('utf-8')
+        opf_data, count = MANIFEST_END_PATTERN.subn(lambda match: manifest_item + match.group(0), opf_data, count=1)
+        if not count:
+            raise ValueError("no manifest in the OPF file")
+
+        with zipfile.ZipFile(modified_epub_path, 'w') as zout:
+            for info in zin.infolist():
+                if info.filename == opf_name:
+                    zout.writestr(copy.copy(info), opf_data)
+                elif info.filename in html_names:
+                    css_href = posixpath.relpath(css_name, posixpath.dirname(info.filename))
+                    link_tag = f'<link rel="stylesheet" type="text/css" href="{css_href}"/>'.encode('utf-8')
+                    page = HEAD_END_PATTERN.sub(lambda match: link_tag + match.group(0), zin.read(info), count=1)
+                    zout.writestr(copy.copy(info), page)
+                else:
+                    copy_zip_entry_raw(source_file, zout, info)
+            zout.writestr(css_name, get_font_css(), compress_type=zipfile.ZIP_DEFLATED)
+    return modified_epub_path
+
+# --- Function: Rebuild EPUB with Font Size and Family ---
+def rebuild_epub_font(epub_path):
+    """Reads the whole EPUB with ebooklib, adds the font CSS to every page and writes it back out."""
     book = epub.read_epub(epub_path)
 
     # Define the CSS style for font size and font family
-    css_style = f"""body {{ font-size: {font_size}px !important; font-family: "Times New Roman", serif !important; }}"""
+    css_style = get_font_css()
 
     # Create a new style file
     css_item = epub.EpubItem(
@@ -93,8 +207,86 @@ def modify_epub_font(epub_path):
     print_status(f"Modified EPUB saved as {modified_epub_path}", "success")
     return modified_epub_path
 
+# --- Function: PDF Session ---
+_fitz_lock = threading.Lock()  # PyMuPDF is not thread-safe, and books run on several threads (book_workers)
+
+class PdfSession:
+    """Reads one PDF for every step of a book: outline, page count and document info share a single parse.
+
+    The file is opened on first use, with PyMuPDF when available (use_pymupdf_reader) and PyPDF2 otherwise.
+    Every PyMuPDF call holds _fitz_lock, so books on other threads only wait for each other while they use it.
+    """
+
+    def __init__(self, pdf_path):
+        self.pdf_path = pdf_path
+        self.doc = None
+        self.reader = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def _open(self):
+        if self.doc is not None or self.reader is not None:
+            return
+        if use_pymupdf_reader and fitz is not None:
+            try:
+                with _fitz_lock:
+                    self.doc = fitz.open(self.pdf_path)
+                return
+            except Exception as e:
+                print_status(f"PyMuPDF could not open {self.pdf_path}: {e}. Using PyPDF2.", "warn")
+        self.reader = PdfReader(self.pdf_path)
+
+    @property
+    def page_count(self):
+        self._open()
+        if self.doc is not None:
+            with _fitz_lock:
+                return self.doc.page_count
+        return len(self.reader.pages)
+
+    def get_outline(self):
+        """Returns the outline as (level, title, page) in document order; level 1 is top level, pages are 1-based."""
+        self._open()
+        if self.doc is not None:
+            # Unresolvable entries are page -1 here and -1 + 1 with PyPDF2; both become 0.
+            with _fitz_lock:
+                toc = self.doc.get_toc(simple=True)
+            return [(level, title, max(page, 0)) for level, title, page in toc]
+
+        outline = []
+        def walk(entries, level):
+            for entry in entries:
+                if isinstance(entry, list):
+                    walk(entry, level + 1)  # Children of the entry before this list
+                else:
+                    outline.append((level, entry.title, self.reader.get_destination_page_number(entry) + 1))
+        walk(self.reader.outline or [], 1)
+        return outline
+
+    def get_info(self):
+        """Returns the document info as a dict with 'title', 'author', 'subject' and 'producer' ('' when missing)."""
+        self._open()
+        keys = ('title', 'author', 'subject', 'producer')
+        if self.doc is not None:
+            with _fitz_lock:
+                info = self.doc.metadata or {}
+            return {key: info.get(key) or '' for key in keys}
+        info = self.reader.metadata
+        return {key: (getattr(info, key, None) or '') if info else '' for key in keys}
+
+    def close(self):
+        if self.doc is not None:
+            with _fitz_lock:
+                self.doc.close()
+        self.doc = None
+        self.reader = None
+
 # --- Function: Extract Table of Contents from PDF ---
-def extract_toc_from_pdf(pdf_path):
+def extract_toc_from_pdf(pdf_path, session=None):
     """Extracts TOC from the PDF, ignoring specific words only for the first chapter, and adds the last page as a chapter."""
     if not run_extract_toc:
         print_status(f"Skipping TOC extraction for {pdf_path} as 'run_extract_toc' is False.", "info")
@@ -108,64 +300,267 @@ def extract_toc_from_pdf(pdf_path):
         return toc_json_path  # Return the existing TOC JSON path
 
     try:
-        reader = PdfReader(pdf_path)
-        toc = reader.outline if reader.outline else []
-        chapter_list = []
-        ignore_keywords = ['title', 'cover', 'dedication', 'title page', 'contents']
-        end_keywords = ['epilogue']
-        first_chapter_skipped = False
-        remove_after = False  # Flag to stop adding chapters after 'epilogue' or any additional end_keyword added
-
-        if add_first_page:
-            chapter_list.append({"title": "First Page", "page": 1})
-
-        for entry in toc:
-            if isinstance(entry, list):
-                continue  # Skip nested TOC entries
-
-            title = entry.title.strip().lower()
-            page_num = reader.get_destination_page_number(entry) + 1
-
-            if not first_chapter_skipped:
-                if any(title.startswith(keyword) for keyword in ignore_keywords):
-                    continue  # Skip unwanted sections for the first chapter
-                first_chapter_skipped = True
-
-            # Check if the title matches 'epilogue' or any additional end_keyword added
-            if any(keyword in title for keyword in end_keywords):
-                remove_after = True  # Set the flag to remove this chapter and subsequent ones
-
-            if not remove_after:
-                chapter_list.append({"title": entry.title, "page": page_num})
-
-        # Add last page as a chapter entry
-        last_page = len(reader.pages)
-        chapter_list.append({"title": "Last Page", "page": last_page + 1})
-
-        if chapter_list:
-            # Sort chapter_list by page number
-            chapter_list.sort(key=lambda x: x['page'])
-
-            # --- Remove Entries Based on Keywords ---
-            chapter_list = [
-                entry
-                for entry in chapter_list
-                if not any(keyword.lower() in entry['title'].lower() for keyword in REMOVE_KEYWORDS)
-            ]
-            #---------------------------------------
-
-            json_path = pdf_path.replace('.pdf', ' chapters.json')
-            with open(json_path, 'w', encoding='utf-8') as f:
-                json.dump(chapter_list, f, ensure_ascii=False, indent=4)
-            print_status(f"Saved sorted TOC data with last page entry for {pdf_path} -> {json_path}", "success")
-            return json_path
-        else:
-            print_status(f"No chapters found to save for {pdf_path}", "warn")
+        with PdfSession(pdf_path) if session is None else contextlib.nullcontext(session) as session:
+            toc_tree = toc_model.build_toc_tree(session.get_outline(), session.page_count)
+            toc_entries = [(entry['title'], entry['page']) for entry in toc_model.get_split_entries(toc_tree, toc_split_level)]
+            return save_chapter_list(pdf_path, toc_json_path, toc_entries, session.page_count)
 
     except Exception as e:
         print_status(f"Error extracting TOC from {pdf_path}: {e}", "error")
         return None
 
+# --- Function: Save Chapter List ---
+def save_chapter_list(book_path, json_path, toc_entries, last_page):
+    """Filters the (title, page) TOC entries chapters are split at into the chapter list p2 splits on, adds the last page and saves it as JSON.
+
+    Every entry records the TOC level it was split at ('split_level'), which tells p2 the boundaries need no guessing.
+    """
+    chapter_list = []
+    ignore_keywords = ['title', 'cover', 'dedication', 'title page', 'contents']
+    end_keywords = ['epilogue']
+    first_chapter_skipped = False
+    remove_after = False  # Flag to stop adding chapters after 'epilogue' or any additional end_keyword added
+
+    if add_first_page:
+        chapter_list.append({"title": "First Page", "page": 1})
+
+    for entry_title, page_num in toc_entries:
+        title = entry_title.strip().lower()
+
+        if not first_chapter_skipped:
+            if any(title.startswith(keyword) for keyword in ignore_keywords):
+                continue  # Skip unwanted sections for the first chapter
+            first_chapter_skipped = True
+
+        # Check if the title matches 'epilogue' or any additional end_keyword added
+        if any(keyword in title for keyword in end_keywords):
+            remove_after = True  # Set the flag to remove this chapter and subsequent ones
+
+        if not remove_after:
+            chapter_list.append({"title": entry_title, "page": page_num})
+
+    # Add last page as a chapter entry
+    chapter_list.append({"title": "Last Page", "page": last_page + 1})
+
+    if chapter_list:
+        # Sort chapter_list by page number
+        chapter_list.sort(key=lambda x: x['page'])
+
+        # --- Remove Entries Based on Keywords ---
+        chapter_list = [
+            entry
+            for entry in chapter_list
+            if not any(keyword.lower() in entry['title'].lower() for keyword in REMOVE_KEYWORDS)
+        ]
+        #---------------------------------------
+
+        for entry in chapter_list:
+            entry['split_level'] = toc_split_level
+
+        with open(json_path, 'w', encoding='utf-8') as f:
+            json.dump(chapter_list, f, ensure_ascii=False, indent=4)
+        print_status(f"Saved sorted TOC data with last page entry for {book_path} -> {json_path}", "success")
+        return json_path
+    else:
+        print_status(f"No chapters found to save for {book_path}", "warn")
+        return None
+
+# --- Function: Extract Table of Contents from EPUB ---
+def extract_toc_from_epub(epub_path, doc):
+    """Builds the chapter list from the EPUB's own navigation, with page numbers from the laid-out document."""
+    if not run_extract_toc:
+        print_status(f"Skipping TOC extraction for {epub_path} as 'run_extract_toc' is False.", "info")
+        return None
+
+    toc_json_path = os.path.splitext(epub_path)[0] + ' chapters.json'
+    try:
+        # get_toc() is [level, title, page] with 1-based pages, the same outline format as PdfSession.get_outline().
+        outline = [(level, title, page) for level, title, page in doc.get_toc() if page > 0]
+        toc_tree = toc_model.build_toc_tree(outline, doc.page_count)
+        toc_entries = [(entry['title'], entry['page']) for entry in toc_model.get_split_entries(toc_tree, toc_split_level)]
+        return save_chapter_list(epub_path, toc_json_path, toc_entries, doc.page_count)
+    except Exception as e:
+        print_status(f"Error extracting TOC from {epub_path}: {e}", "error")
+        return None
+
+# --- Function: Calibre Job Slots ---
+_convert_slots = None
+_convert_slots_lock = threading.Lock()
+
+def get_convert_slots():
+    """Returns the semaphore that limits how many ebook-convert processes run at once."""
+    global _convert_slots
+    with _convert_slots_lock:
+        if _convert_slots is None:
+            _convert_slots = threading.BoundedSemaphore(max(1, convert_workers))
+        return _convert_slots
+
+# --- Function: Persistent Calibre Worker ---
+CALIBRE_WORKER_SCRIPT = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'calibre_worker.py')
+CALIBRE_RESULT_MARKER = '@@BOOK2CBZ_RESULT@@ '  # Must match RESULT_MARKER in calibre_worker.py
+
+class CalibreWorker:
+    """A long-running `calibre-debug -e calibre_worker.py` process that converts one EPUB at a time."""
+
+    def __init__(self, calibre_debug):
+        self.process = subprocess.Popen(
+            [calibre_debug, '-e', CALIBRE_WORKER_SCRIPT],
+            stdin=subprocess.PIPE, stdout=subprocess.PIPE, stderr=subprocess.STDOUT,
+            text=True, encoding='utf-8', errors='replace', bufsize=1, **process_runner.get_group_kwargs()
+        )
+        self.lines = queue.Queue()
+        self.job_id = 0
+        threading.Thread(target=self._read_output, daemon=True).start()
+
+    def _read_output(self):
+        for line in self.process.stdout:
+            self.lines.put(line)
+        self.lines.put(None)  # End of output: the worker exited
+
+    def is_alive(self):
+        return self.process.poll() is None
+
+    def run(self, args, timeout, memory_limit_mb=0, prefix=''):
+        """Runs one conversion, printing its output as it arrives.
+
+        Returns (status, returncode, output) where status is 'done', 'timeout', 'memory' or 'crashed'.
+        """
+        self.job_id += 1
+        try:
+            self.process.stdin.write(json.dumps({'id': self.job_id, 'args': args}) + '\n')
+            self.process.stdin.flush()
+        except OSError:
+            return 'crashed', None, ''
+
+        output = collections.deque(maxlen=process_runner.OUTPUT_TAIL_LINES)
+        deadline = time.monotonic() + timeout if timeout else None
+        next_check = 0
+        while True:
+            if time.monotonic() >= next_check:
+                next_check = time.monotonic() + process_runner.WATCH_INTERVAL
+                if deadline and time.monotonic() > deadline:
+                    self.kill()
+                    return 'timeout', None, ''.join(output)
+                if memory_limit_mb and (process_runner.get_tree_memory(self.process) or 0) > memory_limit_mb * 1024 * 1024:
+                    self.kill()
+                    return 'memory', None, ''.join(output)
+            try:
+                line = self.lines.get(timeout=process_runner.WATCH_INTERVAL)
+            except queue.Empty:
+                continue
+            if line is None:
+                return 'crashed', None, ''.join(output)
+            marker_at = line.find(CALIBRE_RESULT_MARKER)
+            if marker_at < 0:
+                output.append(line)
+                print(prefix + line.rstrip('\r\n'), flush=True)
+                continue
+            if marker_at > 0:  # Calibre's last output had no line break of its own
+                output.append(line[:marker_at] + '\n')
+                print(prefix + line[:marker_at], flush=True)
+            result = json.loads(line[marker_at + len(CALIBRE_RESULT_MARKER):])
+            if result.get('id') != self.job_id:
+                continue  # Late answer from a job that already timed out
+            if result.get('error'):
+                output.append(result['error'])
+                print(prefix + result['error'], flush=True)
+            return 'done', result.get('returncode', 1), ''.join(output)
+
+    def kill(self):
+        process_runner.kill_process_tree(self.process)
+
+    def stop(self):
+        """Lets the worker finish after its current job; kills it if it does not exit in time."""
+        try:
+            self.process.stdin.close()
+            self.process.wait(timeout=30)
+        except (OSError, subprocess.TimeoutExpired):
+            self.kill()
+
+_idle_calibre_workers = []
+_calibre_workers = []
+_calibre_workers_lock = threading.Lock()
+
+def acquire_calibre_worker():
+    """Returns an idle Calibre worker, starting a new one if needed. Returns None when calibre-debug is not available."""
+    with _calibre_workers_lock:
+        while _idle_calibre_workers:
+            worker = _idle_calibre_workers.pop()
+            if worker.is_alive():
+                return worker
+            _calibre_workers.remove(worker)
+
+    calibre_debug = shutil.which('calibre-debug')
+    if not calibre_debug:
+        return None
+    try:
+        worker = CalibreWorker(calibre_debug)
+    except OSError as e:
+        print_status(f"Could not start the Calibre worker: {e}", "warn")
+        return None
+    with _calibre_workers_lock:
+        _calibre_workers.append(worker)
+    return worker
+
+def release_calibre_worker(worker):
+    """Puts a worker back for the next book, or forgets it if it has exited."""
+    with _calibre_workers_lock:
+        if worker.is_alive():
+            _idle_calibre_workers.append(worker)
+        elif worker in _calibre_workers:
+            _calibre_workers.remove(worker)
+
+def stop_calibre_workers():
+    """Shuts down every Calibre worker. Safe to call more than once."""
+    with _calibre_workers_lock:
+        workers = list(_calibre_workers)
+        _calibre_workers.clear()
+        _idle_calibre_workers.clear()
+    for worker in workers:
+        worker.stop()
+
+atexit.register(stop_calibre_workers)
+
+# --- Function: Convert EPUB to PDF in the Calibre Worker ---
+def convert_in_calibre_worker(args, epub_path, pdf_path):
+    """Converts with a persistent Calibre worker. Returns False when the book should be converted with a fresh ebook-convert instead."""
+    worker = acquire_calibre_worker()
+    if worker is None:
+        return False
+    start = time.perf_counter()
+    try:
+        status, returncode, output = worker.run(args, calibre_job_timeout, calibre_memory_limit_mb, prefix=get_output_prefix(epub_path))
+    finally:
+        release_calibre_worker(worker)
+
+    if status == 'crashed':
+        # Only this book is retried; the next book starts a new worker.
+        print_status(f"Calibre worker exited while converting {epub_path}, retrying with ebook-convert.", "warn")
+        return False
+    job = {'status': {'done': process_runner.STATUS_OK if returncode == 0 else process_runner.STATUS_FAILED}.get(status, status),
+           'returncode': returncode, 'output': output, 'duration_s': time.perf_counter() - start, 'peak_memory_mb': 0}
+    process_runner.record_job(job, 'calibre-worker')
+    finish_conversion(job, epub_path, pdf_path)
+    return True
+
+# --- Function: Finish Conversion ---
+def get_output_prefix(epub_path):
+    """Marks the lines Calibre prints with the book's name, since several books may convert at once."""
+    return f"[{os.path.splitext(os.path.basename(epub_path))[0]}] "
+
+def finish_conversion(job, epub_path, pdf_path):
+    """Reports how a conversion ended. A failed conversion's PDF is removed, so the book is converted again next run."""
+    if job['status'] == process_runner.STATUS_OK:
+        print_status(f"Converted {epub_path} to {pdf_path}", "success")
+        return
+    print_status(f"Conversion of {epub_path} {process_runner.describe_failure(job, calibre_job_timeout, calibre_memory_limit_mb)}.", "error")
+    if os.path.exists(pdf_path):
+        try:
+            os.remove(pdf_path)
+            print_status(f"Removed incomplete PDF: {pdf_path}", "warn")
+        except OSError as e:
+            print_status(f"Error removing incomplete PDF {pdf_path}: {e}", "error")
+
 # --- Function: Convert EPUB to PDF using Calibre CLI ---
 def convert_epub_to_pdf(epub_path, pdf_path):
     """Converts an EPUB file to PDF using Calibre's CLI tool."""
@@ -177,50 +572,54 @@ def convert_epub_to_pdf(epub_path, pdf_path):
         "--margin-left", "0.1",
         "--margin-right", "0.1"
     ]
+    if pass_css_to_calibre:
+        # Calibre appends extra CSS after the book's own styles, like the stylesheet modify_epub_font links in.
+        command.extend(["--extra-css", get_font_css()])
     print_status(f"Running command: {' '.join(command)}", "info")
-    try:
-        # Capture the output with explicit encoding
-        result = subprocess.run(command, check=True, capture_output=True, text=True, encoding='utf-8')
-        print_status(f"Converted {epub_path} to {pdf_path}", "success")
-        if result.stdout:
-            print("Stdout:", result.stdout)
-        if result.stderr:
-            print("Stderr:", result.stderr)
-    except subprocess.CalledProcessError as e:
-        print_status(f"Error during conversion of {epub_path}: {e}", "error")
-        if e.stdout:
-            print("Stdout:", e.stdout.decode('utf-8', errors='ignore'))  # Attempt to decode error output
-        if e.stderr:
-            print("Stderr:", e.stderr.decode('utf-8', errors='ignore'))  # Attempt to decode error output
-
-# --- Function: Organize EPUB and Related Files ---
-def organize_epub_files(input_dir):
-    """Organizes EPUB, PDF, OPF, and JSON files into subfolders based on book titles."""
-    if not run_organize_epub:
-        print_status("Skipping organize_epub_files as 'run_organize_epub' is False.", "info")
+    with get_convert_slots(), instrumentation.stage('ebook_convert', output_path=pdf_path):
+        if use_calibre_worker and convert_in_calibre_worker(command[1:], epub_path, pdf_path):
+            return
+        # Output is streamed as Calibre prints it; the runner stops the whole process tree when a limit is hit.
+        job = process_runner.run_command(command, label='ebook-convert', timeout=calibre_job_timeout or None,
+                                         memory_limit_mb=calibre_memory_limit_mb, prefix=get_output_prefix(epub_path))
+        finish_conversion(job, epub_path, pdf_path)
+
+# --- Function: Book Folder Name ---
+def get_book_folder_name(file_name):
+    """Returns the subfolder name for a book file: no 'V ' prefix, no extension and no 'metadata'/'chapters' suffix."""
+    cleaned_name = file_name[2:] if file_name.startswith('V ') else file_name
+    folder_name = os.path.splitext(cleaned_name)[0]  # Remove extension
+    return re.sub(r'\s?(metadata|chapters)\s?\d*', '', folder_name, flags=re.IGNORECASE).strip()
+
+# --- Function: Organize Book Files ---
+def organize_book(book, input_dir):
+    """Moves the files of a book in the root of input_dir into a subfolder named after the book and updates the manifest."""
+    if os.path.abspath(book['folder']) != os.path.abspath(input_dir):
         return
 
-    for file_name in os.listdir(input_dir):
-        if file_name.lower().endswith(('.epub', '.opf', '.pdf', '.json')):
-            file_path = os.path.join(input_dir, file_name)
+    for kind in BOOK_FILE_KINDS:
+        file_path = book.get(kind)
+        if not file_path:
+            continue
+        file_name = os.path.basename(file_path)
 
-            # Remove 'V ' from file name
-            cleaned_name = file_name[2:] if file_name.startswith('V ') else file_name
+        # Remove 'V ' from file name
+        cleaned_name = file_name[2:] if file_name.startswith('V ') else file_name
 
-            # Folder name should ignore 'Chapters'
-            folder_name = os.path.splitext(cleaned_name)[0]  # Remove extension
-            folder_name = re.sub(r'\s?(metadata|chapters)\s?\d*', '', folder_name, flags=re.IGNORECASE).strip()
+        destination_folder = os.path.join(input_dir, get_book_folder_name(file_name))
+        os.makedirs(destination_folder, exist_ok=True)
 
-            destination_folder = os.path.join(input_dir, folder_name)
-            os.makedirs(destination_folder, exist_ok=True)
+        new_file_path = os.path.join(destination_folder, cleaned_name)  # Keep original filename
 
-            new_file_path = os.path.join(destination_folder, cleaned_name)  # Keep original filename
+        if os.path.abspath(file_path) != os.path.abspath(new_file_path):
+            shutil.move(file_path, new_file_path)
+            print_status(f"Moved '{file_name}' to '{new_file_path}'", "info")
+        else:
+            print_status(f"Skipping move: '{file_name}' is already in the correct folder", "info")
+        book[kind] = new_file_path
+        book['folder'] = destination_folder
 
-            if os.path.abspath(file_path) != os.path.abspath(new_file_path):
-                shutil.move(file_path, new_file_path)
-                print_status(f"Moved '{file_name}' to '{new_file_path}'", "info")
-            else:
-                print_status(f"Skipping move: '{file_name}' is already in the correct folder", "info")
+    book['name'] = book['name'][2:] if book['name'].startswith('V ') else book['name']
 
 # --- Function: Extract Metadata from OPF ---
 def extract_metadata(opf_path):
@@ -277,25 +676,29 @@ def extract_metadata(opf_path):
         return None
 
 # --- Function: Extract Metadata from PDF ---
-def extract_metadata_from_pdf(pdf_path):
+def extract_metadata_from_pdf(pdf_path, session=None):
     """Extracts metadata from a PDF file."""
     try:
-        reader = PdfReader(pdf_path)
-        metadata = reader.metadata
-        extracted_metadata = {
-            'title': metadata.title if metadata.title else '',
-            'author': metadata.author if metadata.author else '',
-            'subject': metadata.subject if metadata.subject else '',
-            'producer': metadata.producer if metadata.producer else '',
-            'page_count': len(reader.pages)
-        }
+        with PdfSession(pdf_path) if session is None else contextlib.nullcontext(session) as session:
+            extracted_metadata = session.get_info()
+            extracted_metadata['page_count'] = session.page_count
         return extracted_metadata
     except Exception as e:
         print_status(f"Error extracting metadata from {pdf_path}: {e}", "error")
         return None
 
+# --- Function: Extract Metadata from EPUB ---
+def extract_metadata_from_epub(epub_path):
+    """Extracts metadata from the OPF inside an EPUB, for books without a Calibre OPF next to them."""
+    try:
+        with zipfile.ZipFile(epub_path) as zin, zin.open(get_opf_name(zin)) as opf_file:
+            return extract_metadata(opf_file)
+    except (zipfile.BadZipFile, KeyError, AttributeError, ET.ParseError) as e:
+        print_status(f"Error extracting metadata from {epub_path}: {e}", "error")
+        return None
+
 # --- Function: Create Metadata JSON ---
-def create_metadata_json(file_path):
+def create_metadata_json(file_path, session=None):
     base_name = os.path.splitext(file_path)[0]
     opf_path = base_name + '.opf'
     pdf_path = base_name + '.pdf'
@@ -308,87 +711,422 @@ def create_metadata_json(file_path):
     metadata = None
     if os.path.exists(opf_path):
         metadata = extract_metadata(opf_path)
+    elif file_path.lower().endswith('.epub'):
+        metadata = extract_metadata_from_epub(file_path)
     elif os.path.exists(pdf_path):
-        metadata = extract_metadata_from_pdf(pdf_path)
+        metadata = extract_metadata_from_pdf(pdf_path, session)
 
     if metadata:
         with open(json_path, 'w', encoding='utf-8') as f:
             json.dump(metadata, f, ensure_ascii=False, indent=4)
         print_status(f"Metadata saved to {json_path}", "success")
 
-# --- Function: Process Books in Directory ---
-def process_books_in_directory(input_dir):
-    """Processes all EPUB and PDF files in the specified directory."""
-    for folder_path, _, file_names in os.walk(input_dir):
-        for file_name in file_names:
-            file_path = os.path.join(folder_path, file_name)
-            pdf_path = os.path.join(folder_path, os.path.splitext(file_name)[0] + '.pdf')
-            opf_path = os.path.join(folder_path, os.path.splitext(file_name)[0] + '.opf')
-
-            # Process EPUB files
-            if file_name.lower().endswith('.epub'):
-                print_status(f"Processing EPUB file: {file_path}", "info")
-                modified_epub_path = modify_epub_font(file_path)
-                convert_epub_to_pdf(modified_epub_path, pdf_path)
-
-                if os.path.exists(pdf_path) and delete_epub:
-                    try:
-                        os.remove(file_path)
-                        print_status(f"Removed original EPUB: {file_path}", "info")
-                    except Exception as e:
-                        print_status(f"Error removing original EPUB file: {e}", "error")
-
-                if os.path.exists(modified_epub_path):
-                    try:
-                        os.remove(modified_epub_path)
-                        print_status(f"Removed modified EPUB: {modified_epub_path}", "info")
-                    except Exception as e:
-                        print_status(f"Error removing modified EPUB file: {e}", "error")
-
-                create_metadata_json(file_path)
-
-            # Process PDF files
-            elif file_name.lower().endswith('.pdf'):
-                print_status(f"Processing PDF file: {file_path}", "info")
-                extract_toc_from_pdf(file_path)
-                create_metadata_json(file_path)
-
-            # Delete OPF files if configured
-            elif file_name.lower().endswith('.opf') and delete_opf:
-                try:
-                    os.remove(file_path)
-                    print_status(f"Removed OPF file: {file_path}", "info")
-                except Exception as e:
-                    print_status(f"Error removing OPF file: {e}", "error")
+# --- Function: Result Cache Settings ---
+def get_result_cache_settings():
+    """Returns the p1 settings that change the PDF or chapter list handed to p2."""
+    settings = {
+        'font_size': font_size,
+        'add_first_page': add_first_page,
+        'run_extract_toc': run_extract_toc,
+        'toc_split_level': toc_split_level,
+        'REMOVE_KEYWORDS': REMOVE_KEYWORDS,
+    }
+    if pass_css_to_calibre:
+        settings['pass_css_to_calibre'] = True
+    if render_epub_directly:
+        settings['epub_layout'] = get_epub_layout()
+    if repack_image_epubs:
+        settings['repack_image_epubs'] = True
+    return settings
 
-# --- Main Script Execution ---
-if __name__ == "__main__":
-    process_books_in_directory(input_dir)  # First run
-    print_status("Waiting 5 seconds before re-running...", "info")
-    time.sleep(5)  # Wait for 5 seconds
-    print_status("Re-running the process...", "info")
-    process_books_in_directory(input_dir)  # Re-run the process
+# --- Function: Book Cache Settings ---
+def get_book_cache_settings():
+    """Returns the p1 and p2 settings that together decide a book's CBZ files, or None if p2 cannot be loaded."""
+    try:
+        import p2_create_cbz
+    except ImportError:
+        return None
+    return {'p1': get_result_cache_settings(), 'p2': p2_create_cbz.get_result_cache_settings()}
+
+# --- Function: Discover Books ---
+BOOK_FILE_KINDS = ('epub', 'opf', 'pdf', 'chapters_json', 'metadata_json')
 
-    # Process files with OPF or PDF, but only if the JSON is missing.
+def discover_books(input_dir):
+    """Walks input_dir once and builds a manifest: one dict per book with its EPUB, OPF, PDF and JSON siblings."""
+    books = {}
     for folder_path, _, file_names in os.walk(input_dir):
         for file_name in file_names:
-            file_path = os.path.join(folder_path, file_name)
-            base_name = os.path.splitext(file_name)[0]
-            opf_path = os.path.join(folder_path, base_name + '.opf')
-            pdf_path = os.path.join(folder_path, base_name + '.pdf')
-            json_path = os.path.join(folder_path, base_name + ' metadata.json')
-
-            if os.path.exists(json_path):
-                print_status(f"Skipping {file_name} as metadata JSON already exists.", "info")
+            stem, extension = os.path.splitext(file_name)
+            extension = extension.lower()
+            if extension == '.json' and stem.endswith((' chapters', ' metadata')):
+                stem, suffix = stem.rsplit(' ', 1)
+                kind = f"{suffix}_json"
+            elif extension in ('.epub', '.opf', '.pdf'):
+                if extension == '.epub' and stem.endswith('_modified'):
+                    continue  # Leftover from an interrupted run, not a book
+                kind = extension[1:]
+            else:
                 continue
+            book = books.setdefault((folder_path, stem), {'folder': folder_path, 'name': stem})
+            book[kind] = os.path.join(folder_path, file_name)
+    return [book for book in books.values() if any(book.get(kind) for kind in ('epub', 'opf', 'pdf'))]
+
+# --- Function: Find Image-Only EPUB Pages ---
+REPACK_IMAGE_EXTENSIONS = {'.jpg': '.jpg', '.jpeg': '.jpg', '.png': '.png', '.gif': '.gif', '.webp': '.webp'}  # Formats CBZ readers show -> CBZ extension
+OPF_NS = '{http://www.idpf.org/2007/opf}'
+
+def get_opf_name(zin):
+    container = ET.fromstring(zin.read('META-INF/container.xml'))
+    return container.find('.//{urn:oasis:names:tc:opendocument:xmlns:container}rootfile').get('full-path')
+
+def get_page_image(zin, page_name):
+    """Returns the zip name of the one image an XHTML page shows, or None when it has text or not exactly one image."""
+    soup = BeautifulSoup(zin.read(page_name), 'html.parser')
+    body = soup.body or soup
+    if body.get_text(strip=True):
+        return None
+    sources = [tag.get('src') for tag in body.find_all('img')]
+    sources += [tag.get('xlink:href') or tag.get('href') for tag in body.find_all('image')]  # <svg><image>, used by fixed-layout books
+    if len(sources) != 1 or not sources[0]:
+        return None
+    return posixpath.normpath(posixpath.join(posixpath.dirname(page_name), urllib.parse.unquote(sources[0].split('#')[0])))
+
+def get_image_epub_pages(zin):
+    """Returns (OPF name, page image names in reading order) when every page in the spine is a single image, else None.
+
+    This covers fixed-layout (pre-paginated) comics and manga as well as reflowable picture books with one image per page.
+    Fixed-layout books with real text on their pages do not qualify; they need to be rendered.
+    """
+    opf_name = get_opf_name(zin)
+    opf = ET.fromstring(zin.read(opf_name))
+    opf_dir = posixpath.dirname(opf_name)
+    manifest = {item.get('id'): item for item in opf.iter(OPF_NS + 'item')}
+    zip_names = set(zin.namelist())
+
+    page_images = []
+    for itemref in opf.iter(OPF_NS + 'itemref'):
+        if itemref.get('linear') == 'no':
+            continue
+        item = manifest.get(itemref.get('idref'))
+        if item is None or not item.get('href'):
+            return None
+        item_name = posixpath.normpath(posixpath.join(opf_dir, urllib.parse.unquote(item.get('href'))))
+        if (item.get('media-type') or '').startswith('image/'):
+            image_name = item_name
+        elif item_name in zip_names:
+            image_name = get_page_image(zin, item_name)
+        else:
+            return None
+        if image_name not in zip_names or posixpath.splitext(image_name)[1].lower() not in REPACK_IMAGE_EXTENSIONS:
+            return None
+        page_images.append(image_name)
+    return (opf_name, page_images) if page_images else None
+
+# --- Function: Repack Image-Only EPUB ---
+def get_repack_metadata(epub_path, zin, opf_name):
+    """Metadata for the CBZ: Calibre's OPF next to the EPUB when there is one, else the OPF inside the EPUB."""
+    calibre_opf_path = os.path.splitext(epub_path)[0] + '.opf'
+    if os.path.exists(calibre_opf_path):
+        return extract_metadata(calibre_opf_path) or {}
+    with zin.open(opf_name) as opf_file:
+        return extract_metadata(opf_file) or {}
+
+def repack_image_epub(epub_path):
+    """Writes the page images of an image-only EPUB straight into one CBZ, with ComicInfo from the book's OPF.
+
+    The images are copied byte for byte in reading order. Returns False, without changing anything, when the EPUB
+    has pages that are not a single image; those books are converted as usual.
+    """
+    try:
+        with zipfile.ZipFile(epub_path) as zin:
+            found = get_image_epub_pages(zin)
+    except (zipfile.BadZipFile, KeyError, AttributeError, ET.ParseError) as e:
+        print_status(f"Could not read the pages of {epub_path} ({e}); converting it as usual.", "warn")
+        return False
+    if not found:
+        return False
+    opf_name, page_images = found
+
+    epub_hash = result_cache.file_hash(input_dir, epub_path) if use_result_cache else None
+    book_settings = get_book_cache_settings()
+    if epub_hash and book_settings:
+        cached_book = result_cache.lookup(input_dir, 'book', epub_hash, book_settings, os.path.dirname(epub_path))
+        if cached_book:
+            print_status(f"Skipping {epub_path}: unchanged since its {len(cached_book[0])} CBZ file(s) were created.", "info")
+            return True
 
-            if os.path.exists(opf_path):
-                print_status(f"Processing OPF file: {opf_path}", "info")
-                create_metadata_json(opf_path)
+    import p2_create_cbz
+    folder_path = os.path.dirname(epub_path)
+    output_cbz = os.path.join(folder_path, os.path.splitext(os.path.basename(epub_path))[0] + '.cbz')
+    if os.path.exists(output_cbz) and not p2_create_cbz.overwrite_existing_cbz:
+        print_status(f"CBZ file already exists: {output_cbz}. Skipping creation.", "warn")
+        return True
 
-            elif os.path.exists(pdf_path):
-                print_status(f"Processing PDF file: {pdf_path}", "info")
-                create_metadata_json(pdf_path)
+    print_status(f"Repacking the {len(page_images)} page images of {epub_path} into a CBZ...", "info")
+    with zipfile.ZipFile(epub_path) as zin, tempfile.TemporaryDirectory(dir=folder_path) as work_dir:
+        with instrumentation.stage('metadata'):
+            metadata = get_repack_metadata(epub_path, zin, opf_name)
+            metadata['page_count'] = str(len(page_images))
+        comicinfo_path = p2_create_cbz.create_comicinfo(metadata, 1, work_dir) if p2_create_cbz.create_comicinfo_enabled else None
+        cbz = p2_create_cbz.open_cbz_stream(output_cbz)
+        try:
+            with instrumentation.stage('repack', pages=len(page_images)) as counters:
+                for image_num, image_name in enumerate(page_images):
+                    image_bytes = zin.read(image_name)
+                    extension = REPACK_IMAGE_EXTENSIONS[posixpath.splitext(image_name)[1].lower()]
+                    p2_create_cbz.write_cbz_entry(cbz, f"image-{image_num:04d}{extension}", data=image_bytes)
+                    counters['bytes'] += len(image_bytes)
+        except BaseException:
+            p2_create_cbz.abort_cbz_stream(cbz, output_cbz)
+            raise
+        p2_create_cbz.finish_cbz_stream(cbz, output_cbz, comicinfo_path)
 
-    organize_epub_files(input_dir)  # Organize files into subfolders.
+    if epub_hash and book_settings:
+        result_cache.record(input_dir, 'book', epub_hash, book_settings, [output_cbz])
+    if delete_epub:
+        try:
+            os.remove(epub_path)
+            print_status(f"Removed original EPUB: {epub_path}", "info")
+        except Exception as e:
+            print_status(f"Error removing original EPUB file: {e}", "error")
+    return True
 
+# --- Function: Convert EPUB Book ---
+def convert_epub_book(epub_path, pdf_path):
+    """Converts a book's EPUB to PDF. Returns False when the result cache shows the book's CBZs are already up to date."""
+    print_status(f"Processing EPUB file: {epub_path}", "info")
+    epub_hash = result_cache.file_hash(input_dir, epub_path) if use_result_cache else None
+    if epub_hash:
+        book_settings = get_book_cache_settings()
+        cached_book = result_cache.lookup(input_dir, 'book', epub_hash, book_settings, os.path.dirname(epub_path)) if book_settings else None
+        if cached_book:
+            print_status(f"Skipping {epub_path}: unchanged since its {len(cached_book[0])} CBZ file(s) were created.", "info")
+            return False
+
+    conversion_settings = {'font_size': font_size}
+    if pass_css_to_calibre:
+        conversion_settings['pass_css_to_calibre'] = True
+    if result_cache.lookup(input_dir, 'epub_to_pdf', epub_hash, conversion_settings, os.path.dirname(pdf_path)) and os.path.exists(pdf_path):
+        print_status(f"Skipping conversion of {epub_path}: {pdf_path} is up to date.", "info")
+        modified_epub_path = None
+    else:
+        modified_epub_path = None
+        if not pass_css_to_calibre:
+            with instrumentation.stage('epub_patch') as counters:
+                modified_epub_path = modify_epub_font(epub_path)
+                counters['bytes'] = instrumentation.file_size(modified_epub_path)
+        convert_epub_to_pdf(modified_epub_path or epub_path, pdf_path)
+
+    if epub_hash and os.path.exists(pdf_path):
+        result_cache.record(input_dir, 'epub_to_pdf', epub_hash, conversion_settings, [pdf_path],
+                            output_hash=result_cache.file_hash(input_dir, pdf_path),
+                            extra={'p1_settings': get_result_cache_settings()})
+
+    if os.path.exists(pdf_path) and delete_epub:
+        try:
+            os.remove(epub_path)
+            print_status(f"Removed original EPUB: {epub_path}", "info")
+        except Exception as e:
+            print_status(f"Error removing original EPUB file: {e}", "error")
+
+    if modified_epub_path and os.path.exists(modified_epub_path):
+        try:
+            os.remove(modified_epub_path)
+            print_status(f"Removed modified EPUB: {modified_epub_path}", "info")
+        except Exception as e:
+            print_status(f"Error removing modified EPUB file: {e}", "error")
+    return True
+
+# --- Function: EPUB Page Layout ---
+EPUB_PAGE_SIZE = (612, 792)  # Letter in points, the paper size ebook-convert uses for PDF output
+
+def get_epub_layout():
+    """Returns how EPUBs are paginated when they are rendered directly (see p2_create_cbz.open_reflowable_document)."""
+    return {
+        'width': EPUB_PAGE_SIZE[0],
+        'height': EPUB_PAGE_SIZE[1],
+        'font_size': font_size,
+        'css': "@page { margin: 0.1pt; } " + get_font_css(),
+    }
+
+# --- Function: EPUB Render Processes ---
+_epub_render_pool = None
+_epub_render_pool_lock = threading.Lock()
+
+def get_epub_render_pool():
+    """Returns the spawned processes EPUBs are rendered in: started on first use, one per book worker, shared by every book."""
+    global _epub_render_pool
+    with _epub_render_pool_lock:
+        if _epub_render_pool is None:
+            _epub_render_pool = concurrent.futures.ProcessPoolExecutor(max_workers=max(1, book_workers), mp_context=multiprocessing.get_context('spawn'))
+        return _epub_render_pool
+
+def stop_epub_render_pool(pool=None):
+    """Shuts down the EPUB render processes (only if they are still pool, when given). Safe to call more than once."""
+    global _epub_render_pool
+    with _epub_render_pool_lock:
+        if pool is not None and pool is not _epub_render_pool:
+            return
+        pool, _epub_render_pool = _epub_render_pool, None
+    if pool is not None:
+        pool.shutdown()
+
+atexit.register(stop_epub_render_pool)
+
+# --- Function: Render EPUB in Child Process ---
+def render_epub_in_process(epub_path):
+    """Lays out an EPUB and renders it to CBZ files. Runs in a process of its own, started by render_epub_book.
+
+    Returns (CBZ paths, or None when the EPUB could not be laid out; {stage: seconds} of the p1 steps).
+    """
+    import p2_create_cbz
+    instrumentation.configure(input_dir, log_stage_timings)
+    timings = {}
+    layout = get_epub_layout()
+    doc = p2_create_cbz.open_pdf_document(epub_path, layout)
+    if doc is None:
+        return None, timings
+    try:
+        with instrumentation.timer(timings, 'toc_extract'):
+            extract_toc_from_epub(epub_path, doc)
+        with instrumentation.timer(timings, 'metadata'):
+            create_metadata_json(epub_path)
+        return p2_create_cbz.process_pdf(epub_path, layout=layout, doc=doc), timings
+    finally:
+        p2_create_cbz.close_pdf_document(doc)
+
+# --- Function: Render EPUB Book Directly ---
+def render_epub_book(epub_path):
+    """Renders an EPUB straight to CBZ with PyMuPDF: chapters come from the EPUB navigation, no PDF is written.
+
+    The rendering runs in a spawned process (see get_epub_render_pool): PyMuPDF's user style sheet is global to a
+    process and p2 forks its render workers, neither of which is safe next to the other books on p1's threads.
+    A process renders one book at a time and sets the style sheet again for every book.
+    """
+    print_status(f"Rendering EPUB file directly: {epub_path}", "info")
+    epub_hash = result_cache.file_hash(input_dir, epub_path) if use_result_cache else None
+    book_settings = get_book_cache_settings()
+    if epub_hash and book_settings:
+        cached_book = result_cache.lookup(input_dir, 'book', epub_hash, book_settings, os.path.dirname(epub_path))
+        if cached_book:
+            print_status(f"Skipping {epub_path}: unchanged since its {len(cached_book[0])} CBZ file(s) were created.", "info")
+            return
+
+    pool = get_epub_render_pool()
+    try:
+        outputs, timings = pool.submit(render_epub_in_process, epub_path).result()
+    except concurrent.futures.BrokenExecutor:
+        stop_epub_render_pool(pool)  # A render process died; the next book starts new ones
+        raise
+    instrumentation.add_stages(timings)
+    if outputs is None:
+        print_status(f"Could not lay out {epub_path}.", "error")
+        return
+    if not outputs:
+        print_status(f"Not all CBZ files could be created for {epub_path}; keeping the EPUB.", "warn")
+        return
+    if epub_hash and book_settings:
+        result_cache.record(input_dir, 'book', epub_hash, book_settings, outputs)
+    if delete_epub:
+        try:
+            os.remove(epub_path)
+            print_status(f"Removed original EPUB: {epub_path}", "info")
+        except Exception as e:
+            print_status(f"Error removing original EPUB file: {e}", "error")
+
+# --- Function: Process Book ---
+def process_book(book):
+    """Runs every step for one book in dependency order: EPUB -> PDF -> chapters/metadata JSON -> OPF cleanup."""
+    with instrumentation.book(book['name'], script='p1'):
+        pdf_path = book.get('pdf') or os.path.join(book['folder'], book['name'] + '.pdf')
+        needs_json = True
+
+        # 1. The EPUB must become a PDF before anything can read its TOC, unless it is rendered straight to CBZ.
+        #    Image-only EPUBs need neither: their images are the pages.
+        if book.get('epub') and repack_image_epubs and repack_image_epub(book['epub']):
+            needs_json = False
+        elif book.get('epub') and render_epub_directly:
+            render_epub_book(book['epub'])
+            needs_json = False
+        elif book.get('epub'):
+            needs_json = convert_epub_book(book['epub'], pdf_path)
+
+        if needs_json:
+            # The PDF is parsed at most once, by whichever of the next two steps needs it first.
+            with PdfSession(pdf_path) as session:
+                # 2. Chapters come from the PDF outline.
+                if os.path.exists(pdf_path):
+                    print_status(f"Processing PDF file: {pdf_path}", "info")
+                    with instrumentation.stage('toc_extract'):
+                        extract_toc_from_pdf(pdf_path, session)
+
+                # 3. Metadata prefers the OPF and falls back to the PDF, so it runs after both exist and before the OPF is removed.
+                with instrumentation.stage('metadata'):
+                    create_metadata_json(pdf_path, session)
+
+        # 4. Delete OPF files if configured
+        if book.get('opf') and delete_opf and os.path.exists(book['opf']):
+            try:
+                os.remove(book['opf'])
+                print_status(f"Removed OPF file: {book['opf']}", "info")
+            except Exception as e:
+                print_status(f"Error removing OPF file: {e}", "error")
+
+# --- Function: Process Book Folder ---
+def process_book_folder(job):
+    """Processes the books of one folder in turn. Returns the number of books that failed."""
+    folder_path, books = job
+    failures = 0
+    for book in books:
+        try:
+            process_book(book)
+        except Exception as e:
+            failures += 1
+            print_status(f"Error processing {os.path.join(folder_path, book['name'])}: {e}", "error")
+    return failures
+
+# --- Function: Process Books in Directory ---
+def process_books_in_directory(input_dir, on_folder_done=None):
+    """Processes all EPUB and PDF files in the specified directory.
+
+    on_folder_done(folder_path, failures) is called by the worker as soon as a folder is finished. It may block to
+    hold p1 back; convert_books.py uses it to hand every folder to p2 while p1 goes on with the next one.
+    """
+    instrumentation.configure(input_dir, log_stage_timings)
+    instrumentation.export_run_id()  # EPUBs rendered directly log from their own process under this run
+    books = discover_books(input_dir)
+
+    # Organizing first gives every root-level book its own folder, so those books can run in parallel too.
+    if run_organize_epub:
+        for book in books:
+            organize_book(book, input_dir)
+    else:
+        print_status("Skipping organizing files into subfolders as 'run_organize_epub' is False.", "info")
+
+    # Each folder is one job so no two workers touch the same folder.
+    jobs = {}
+    for book in books:
+        jobs.setdefault(book['folder'], []).append(book)
+    jobs = list(jobs.items())
+    total = len(jobs)
+    print_status(f"Found {len(books)} book(s) in {total} folder(s).", "info")
+
+    def run_job(job):
+        failures = process_book_folder(job)
+        if on_folder_done:
+            on_folder_done(job[0], failures)
+        return failures
+
+    with concurrent.futures.ThreadPoolExecutor(max_workers=max(1, min(book_workers, total))) as executor:
+        # map() yields in submission order, so progress is reported in a stable order.
+        for done, ((folder_path, _), failures) in enumerate(zip(jobs, executor.map(run_job, jobs)), start=1):
+            if failures:
+                print_status(f"[{done}/{total}] Finished {folder_path} with {failures} error(s)", "warn")
+            else:
+                print_status(f"[{done}/{total}] Finished {folder_path}", "success")
+    stop_calibre_workers()
+    stop_epub_render_pool()
+
+# --- Main Script Execution ---
+if __name__ == "__main__":
+    process_books_in_directory(input_dir)
@@ -8,16 +8,26 @@
 import os
 import sys
 import shutil
-import subprocess
 import zipfile
 import xml.etree.ElementTree as ET
 import json
 import re
+import time
 import tempfile
+import io
+import multiprocessing
+import concurrent.futures
+import collections
+import hashlib
+import threading
 from PIL import Image
 import fitz  # PyMuPDF
-from PyPDF2 import PdfReader
 import numpy as np
+import result_cache
+import page_cache
+import toc_model
+import instrumentation
+import process_runner
 
 # --- Input Directory Setup ---
 # Define input directory.
@@ -32,12 +42,36 @@ input_dir = os.getcwd()  # Default to current directory. Change if needed.
 delete_pdf = True  # Set to True to delete the original PDF after processing. False keeps it.
 delete_json = True  # Set to True to delete the JSON files after processing. False keeps it.
 crop_white_margins_enabled = False  # Set to True to crop white margins from images. False skips cropping.
+crop_white_threshold = 250  # Pixels darker than this (0-255) count as content when cropping. 255 treats anything but pure white as content.
+crop_per_chapter = False  # Set to True to crop every page of a chapter with the same box so page sizes stay consistent.
 create_comicinfo_enabled = True  # Set to True to create a ComicInfo.xml file. False skips it.
-chapter_page_filter_threshold = 8  # Threshold for filtering chapter pages if 'chapter 2' in toc is not found.
+chapter_page_filter_threshold = 8  # Threshold for filtering chapter pages if 'chapter 2' in toc is not found. Only used for chapter lists without a TOC split level (written by older versions).
 min_chapters_for_split = 3  # Minimum number of chapters to trigger chapter splitting.
 overwrite_existing_cbz = True # Set to True to overwrite existing cbz files. False skips if it exist
+use_result_cache = True  # Set to True to skip PDFs whose content and settings are unchanged since the CBZ was last made.
+use_page_cache = False  # Set to True to keep rendered pages in .book2cbz_page_cache in input_dir, so a rerun with other chapter, crop or image settings does not render the PDFs again. Needs delete_pdf = False.
+page_cache_size_mb = 2048  # Maximum size of the page cache in MB. The least recently used pages are removed beyond it.
 remove_prefix_cbz = False  # Flag to control 'V ' prefix removal for CBZ
 HighRes = False  # Set to True to convert images with higher resolution. False for standard.
+target_dpi = 0  # Render pages at this resolution (72 = standard, 150 = sharp text). 0 uses the HighRes setting.
+target_width = 0  # Render every page this many pixels wide, e.g. your e-reader's screen width (before margins are cropped). 0 uses the DPI setting.
+image_format = 'webp'  # Page image format: 'webp', 'jpeg', 'png' or 'avif' (AVIF needs a recent Pillow and a reader app that supports it).
+image_quality = 75  # Quality (1-100) of lossy page images (webp, jpeg, avif). Lower is smaller.
+image_effort = 4  # Encoder effort (0-6). Higher makes smaller files but encodes slower (WebP method; mapped for png, avif and jpeg).
+grayscale_pages = 'off'  # 'off' keeps colour, 'auto' stores pages without colour (text) in grayscale, 'always' stores every page in grayscale.
+grayscale_bits = 4  # Shades kept in grayscale pages: 8 = 256 shades, 4 = 16 shades (plenty for text, much smaller PNG files).
+cbz_compress_images = False  # Set to True to deflate page images inside the CBZ. False stores them as-is (they are already compressed).
+cbz_compresslevel = 6  # Deflate level (1-9) for compressed CBZ entries such as ComicInfo.xml.
+stream_to_cbz = True  # Set to True to write rendered pages straight into the CBZ. False writes temporary image files first.
+use_pymupdf_renderer = True  # Set to True to render pages in-process with PyMuPDF. False uses ImageMagick (magick convert).
+skip_blank_pages = False  # Set to True to leave empty pages (such as the blank separator pages in Calibre PDFs) out of the CBZ. False keeps them; they are never rendered either way.
+passthrough_scanned_pages = True  # Set to True to copy the image of a scanned page (one picture covering the page) into the CBZ unchanged instead of rendering it. Copied pages are not resized (target_dpi, target_width) or recoded. Not used while cropping white margins or with grayscale_pages = 'always'.
+magick_timeout = 600  # Seconds one ImageMagick run (one window of pages) may take before it is stopped. 0 disables the limit.
+magick_memory_limit_mb = 0  # Memory (MB) one ImageMagick run may use, Ghostscript included, before it is stopped. 0 disables the limit.
+render_workers = 1  # Number of processes rendering pages of a book in parallel (PyMuPDF only). 1 renders in this process.
+render_window_pages = 32  # Pages rendered and written out at a time, so memory use does not grow with the size of the book. 0 renders a chapter (or ImageMagick page range) at once.
+book_workers = 1  # Number of book folders converted at the same time. 1 converts one book at a time.
+log_stage_timings = True  # Set to True to append book, chapter and stage timings to .book2cbz_timings.jsonl in input_dir. False logs nothing.
 
 
 # =============================================================
@@ -72,7 +106,11 @@ def create_output_structure(input_path):
 
 # --- Function: Read Chapter Information from JSON ---
 def read_chapter_info(info_path):
-    """Reads chapter information from a JSON file."""
+    """Reads chapter information from a JSON file.
+
+    Lists written by p1 carry the TOC level they were split at ('split_level') and are used as they are. Older lists
+    have their short sections before chapter 2 merged into chapter 1 (chapter_page_filter_threshold).
+    """
     chapter_pages = []
     chapters_data = []
 
@@ -104,12 +142,14 @@ def read_chapter_info(info_path):
                     chapter_pages.append(chapter['page'])
 
             chapter_pages = list(dict.fromkeys(chapter_pages))
+            split_by_level = all(isinstance(chapter, dict) and 'split_level' in chapter for chapter in chapters_data)
 
-            if chapter_two_found and chapter_two_index > 0:
+            # Lists split at a TOC level keep every boundary; only older lists guess where chapter 1 ends.
+            if not split_by_level and chapter_two_found and chapter_two_index > 0:
                 first_chapter_page = chapter_pages[0]
                 filtered_chapter_pages = [page for page in chapter_pages[1:chapter_two_index] if page >= first_chapter_page + chapter_page_filter_threshold]
                 chapter_pages = [first_chapter_page] + filtered_chapter_pages + chapter_pages[chapter_two_index:]
-            else:
+            elif not split_by_level:
                 if len(chapter_pages) > 1:
                     first_chapter_page = chapter_pages[0]
                     filtered_chapter_pages = [page for page in chapter_pages[1:] if page >= first_chapter_page + chapter_page_filter_threshold]
@@ -121,119 +161,639 @@ def read_chapter_info(info_path):
     print_status(f"Chapter pages: {chapter_pages}", "info")
     return chapter_pages
 
-# --- Function: Process Chapters ---
-def process_chapters(pdf_path, info_path, output_folder, file_name, chapter_pages, opf_path):
-    is_root_dir = os.path.dirname(pdf_path) == input_dir
-    if is_root_dir:
-        temp_dir = tempfile.mkdtemp(dir=output_folder)
-        print_status(f"Created temporary directory: {temp_dir}", "info")
-    else:
-        temp_dir = output_folder
-
-    if len(chapter_pages) > 0:
-        print_status(f"Found {len(chapter_pages)} chapter breaks in the PDF.", "info")
-        start_page = 1
-        end_page = chapter_pages[0] - 1 if chapter_pages[0] > 1 else None
-        print_status(f"Processing Chapter 1: pages {start_page}-{end_page}", "info")
-        images_dir = os.path.join(temp_dir, "chapter_1")
-        convert_pdf_to_images(pdf_path, images_dir, start_page, end_page)
-
-        chapter_num = 1
-        metadata_file = get_metadata_json(os.path.dirname(pdf_path))
-        metadata = parse_metadata_json(metadata_file) if metadata_file else {}
-        if create_comicinfo_enabled:
-            print_status(f"Creating ComicInfo for chapter {chapter_num} with metadata: {metadata}", "info")
-            comicinfo_path = create_comicinfo(metadata, chapter_num, temp_dir)
-        else:
-            comicinfo_path = None
-        output_cbz = os.path.join(temp_dir, f"{os.path.splitext(file_name)[0]} Chapter {chapter_num}.cbz")
-        create_cbz(images_dir, output_cbz, comicinfo_path)
-
-        for i in range(1, len(chapter_pages)):
-            start_page = chapter_pages[i - 1]
-            if i < len(chapter_pages) - 1:
-                end_page = chapter_pages[i] - 1
-            else:
-                end_page = None
+# --- Function: Content Box from Mask ---
+def get_mask_box(content_mask, width, height, padding=10):
+    """Turns a 2D boolean content mask into a padded (left, top, right, bottom) crop box."""
+    non_white_rows = content_mask.any(axis=1)
+    non_white_cols = content_mask.any(axis=0)
+    if not non_white_rows.any():
+        return 0, 0, width, height
+    top = np.argmax(non_white_rows)
+    bottom = len(non_white_rows) - np.argmax(non_white_rows[::-1]) - 1
+    left = np.argmax(non_white_cols)
+    right = len(non_white_cols) - np.argmax(non_white_cols[::-1]) - 1
+    top = max(0, top - padding)
+    bottom = min(height, bottom + padding)
+    left = max(0, left - padding)
+    right = min(width, right + padding)
+    return left, top, right, bottom
 
-            chapter_num = i + 1
-            print_status(f"Processing Chapter {chapter_num}: pages {start_page}-{end_page}", "info")
-            images_dir = os.path.join(temp_dir, f"chapter_{chapter_num}")
-            convert_pdf_to_images(pdf_path, images_dir, start_page, end_page)
+# --- Function: Find Content Box ---
+def get_content_box(img, padding=10):
+    """Returns the (left, top, right, bottom) box around the non-white content of an image, plus padding."""
+    img_array = np.asarray(img.convert('L'))
+    return get_mask_box(img_array < crop_white_threshold, img.width, img.height, padding)
 
-            metadata_file = get_metadata_json(os.path.dirname(pdf_path))
-            metadata = parse_metadata_json(metadata_file) if metadata_file else {}
-            if create_comicinfo_enabled:
-                print_status(f"Creating ComicInfo for chapter {chapter_num} with metadata: {metadata}", "info")
-                comicinfo_path = create_comicinfo(metadata, chapter_num, temp_dir)
-            else:
-                comicinfo_path = None
-            output_cbz = os.path.join(temp_dir, f"{os.path.splitext(file_name)[0]} Chapter {chapter_num}.cbz")
-            create_cbz(images_dir, output_cbz, comicinfo_path)
+# --- Function: Find Chapter Content Box ---
+def get_chapter_content_box(images, padding=10):
+    """Returns one crop box covering the content of every page, from a single reduction over the stacked pages."""
+    width = max(img.width for img in images)
+    height = max(img.height for img in images)
+    stack = np.full((len(images), height, width), 255, dtype=np.uint8)
+    for index, img in enumerate(images):
+        stack[index, :img.height, :img.width] = np.asarray(img.convert('L'))
+    return get_mask_box(stack.min(axis=0) < crop_white_threshold, width, height, padding)
 
-        cleanup(images_dir=temp_dir, pdf_path=pdf_path, comicinfo_path=comicinfo_path, json_path=info_path if os.path.exists(info_path) else None)
+# --- Function: Find Chapter Content Box Page by Page ---
+def get_streamed_content_box(images, padding=10):
+    """Returns the same box as get_chapter_content_box, but looks at one page at a time, so images may be a generator."""
+    width = height = 0
+    bounds = None
+    for img in images:
+        width = max(width, img.width)
+        height = max(height, img.height)
+        content_mask = np.asarray(img.convert('L')) < crop_white_threshold
+        if not content_mask.any():
+            continue  # Blank pages do not widen the box
+        left, top, right, bottom = get_mask_box(content_mask, img.width, img.height, padding=0)
+        bounds = (left, top, right, bottom) if bounds is None else (min(bounds[0], left), min(bounds[1], top), max(bounds[2], right), max(bounds[3], bottom))
+    if bounds is None:
+        return 0, 0, width, height
+    left, top, right, bottom = bounds
+    return max(0, left - padding), max(0, top - padding), min(width, right + padding), min(height, bottom + padding)
 
-        if is_root_dir:
-            shutil.rmtree(temp_dir)
-            print_status(f"Cleaned up temporary directory: {temp_dir}", "info")
-    else:
-        print_status("No chapter breaks found in the PDF.", "warn")
+# --- Function: Crop Box for One Page ---
+def clip_box(box, img):
+    left, top, right, bottom = box
+    return left, top, min(right, img.width), min(bottom, img.height)
 
 # --- Function: Crop White Margins ---
 def crop_white_margins(image_path, padding=10):
     if crop_white_margins_enabled:
         with Image.open(image_path) as img:
-            grayscale_img = img.convert('L')
-            img_array = np.array(grayscale_img)
-            non_white_rows = np.any(img_array < 255, axis=1)
-            non_white_cols = np.any(img_array < 255, axis=0)
-            top = np.argmax(non_white_rows)
-            bottom = len(non_white_rows) - np.argmax(non_white_rows[::-1]) - 1
-            left = np.argmax(non_white_cols)
-            right = len(non_white_cols) - np.argmax(non_white_cols[::-1]) - 1
-            top = max(0, top - padding)
-            bottom = min(img.height, bottom + padding)
-            left = max(0, left - padding)
-            right = min(img.width, right + padding)
-            img_cropped = img.crop((left, top, right, bottom))
-            img_cropped.save(image_path)
-            print_status(f"Cropped white margins from: {image_path}", "info")
+            img_cropped = img.crop(get_content_box(img, padding))
+        # Re-encoded with the page image settings, so pages cropped here match pages rendered with PyMuPDF.
+        with open(image_path, 'wb') as f:
+            f.write(encode_page(img_cropped))
+        print_status(f"Cropped white margins from: {image_path}", "info")
     else:
         print_status(f"Skipping cropping white margins for: {image_path}", "info")
 
-# --- Function: Convert PDF to Images ---
-def convert_pdf_to_images(pdf_path, images_dir, start_page, end_page, high_res=False):
-    print_status(f"Converting PDF pages {start_page} to {end_page-1 if end_page else 'end'} to images...", "info")
-    os.makedirs(images_dir, exist_ok=True)
+# --- Function: Crop Chapter Image Directory ---
+def crop_chapter_images_dir(images_dir, padding=10):
+    """Crops the image files of a chapter rendered to disk, using one box per chapter when crop_per_chapter is set."""
+    image_paths = [os.path.join(images_dir, image_file) for image_file in sorted(os.listdir(images_dir))
+                   if image_file.lower().endswith(('.png', '.jpg', '.jpeg', '.webp', '.avif'))]
+    if not (crop_white_margins_enabled and crop_per_chapter and image_paths):
+        with instrumentation.stage('crop', pages=len(image_paths) if crop_white_margins_enabled else 0):
+            for image_path in image_paths:
+                crop_white_margins(image_path, padding)
+        return
+
+    with instrumentation.stage('crop', pages=len(image_paths)):
+        # Pages are opened one at a time, so a long chapter is cropped without holding all of it in memory.
+        box = get_streamed_content_box(iter_image_files(image_paths), padding)
+        for image_path in image_paths:
+            with Image.open(image_path) as img:
+                img_cropped = img.crop(clip_box(box, img))
+            with open(image_path, 'wb') as f:
+                f.write(encode_page(img_cropped))
+    print_status(f"Cropped white margins from {len(image_paths)} pages in: {images_dir}", "info")
+
+def iter_image_files(image_paths):
+    for image_path in image_paths:
+        with Image.open(image_path) as img:
+            yield img
+
+# --- Function: Page Range ---
+def get_page_indices(page_count, start_page, end_page):
+    """Translates the 1-based start/end pages of a chapter into 0-based page indices."""
+    first = start_page - 1 if start_page > 0 else 0
+    last = end_page - 2 if end_page and end_page > 1 else page_count - 1
+    return range(first, min(last, page_count - 1) + 1)
+
+# --- Function: Render Zoom ---
+def get_render_zoom(high_res=False):
+    """Returns the PyMuPDF zoom factor: target_dpi when set, else ImageMagick's output size (72 DPI, or 150 DPI resized 125% for HighRes)."""
+    if target_dpi:
+        return target_dpi / 72
+    return 150 / 72 * 1.25 if high_res else 1.0
+
+# --- Function: Render Page with PyMuPDF ---
+def render_page(doc, page_index, zoom=1.0):
+    """Renders a single PDF page onto a white background and returns it as a PIL image.
+
+    With target_width the zoom is chosen per page so the page is that wide. Pages for grayscale_pages = 'always'
+    are rendered in grayscale straight away, which also makes rendering and cropping cheaper.
+    """
+    page = doc.load_page(page_index)
+    if target_width:
+        zoom = target_width / page.rect.width
+    if grayscale_pages == 'always':
+        pix = page.get_pixmap(matrix=fitz.Matrix(zoom, zoom), colorspace=fitz.csGRAY, alpha=False)
+        return Image.frombytes("L", (pix.width, pix.height), pix.samples)
+    pix = page.get_pixmap(matrix=fitz.Matrix(zoom, zoom), alpha=False)
+    return Image.frombytes("RGB", (pix.width, pix.height), pix.samples)
+
+# --- Function: Blank Pages ---
+# Content stream operators that put something on the page: text, XObjects (images, forms), shadings, paths and inline images
+PAINT_OPERATOR_PATTERN = re.compile(rb'(?:^|[\s)\]>])(?:Tj|TJ|\'|"|Do|sh|BI|[fFSsBb]\*?)(?=[\s(<\[/]|$)')
+
+def is_blank_page(page):
+    """Returns True for a PDF page that paints nothing, judged from its content stream without rendering it.
+
+    Anything that looks like a painting operator counts as content, so a page is only called blank when it certainly is.
+    """
+    if page.first_annot is not None:
+        return False
+    return not PAINT_OPERATOR_PATTERN.search(page.read_contents())
+
+def get_blank_page(page, zoom=1.0):
+    """Returns the white image rendering the page would produce, at the same size."""
+    if target_width:
+        zoom = target_width / page.rect.width
+    size = (page.rect * fitz.Matrix(zoom, zoom)).irect
+    return Image.new('L' if grayscale_pages == 'always' else 'RGB', (size.width, size.height), 'white')
+
+# --- Function: Scanned Page Image ---
+# Embedded image formats CBZ readers show, as extracted by PyMuPDF -> file extension
+PASSTHROUGH_FORMATS = {'jpeg': '.jpg', 'png': '.png'}
+
+def get_passthrough_image(doc, page_index, coverage=0.98):
+    """Returns the image file bytes of a scanned page, or None when the page has to be rendered.
+
+    A page qualifies when it shows nothing but one unrotated, unmasked image covering the page and not reaching past
+    it (a scanned spread placed across two pages shows only half of the image on each); an invisible OCR text layer
+    is allowed. JPEG and PNG images are copied byte for byte. Other formats (JPEG 2000, JBIG2, CMYK)
+    are decoded at their own resolution and encoded in the configured image format, without re-rendering the page.
+    """
+    if not doc.is_pdf:
+        return None
+    page = doc.load_page(page_index)
+    images = page.get_images(full=True)
+    if page.rotation or len(images) != 1 or images[0][1]:  # images[0][1]: soft mask (transparency)
+        return None
+    xref = images[0][0]
+    placements = page.get_image_rects(xref, transform=True)
+    if len(placements) != 1:
+        return None
+    rect, matrix = placements[0]
+    if abs(matrix.b) > 1e-3 or abs(matrix.c) > 1e-3 or matrix.a <= 0 or matrix.d <= 0:
+        return None  # Rotated or mirrored
+    if (rect & page.rect).get_area() < coverage * page.rect.get_area() or rect.get_area() > page.rect.get_area() / coverage:
+        return None
+    if page.get_drawings() or any(span['type'] != 3 for span in page.get_texttrace()):  # type 3: invisible text
+        return None
+
+    extracted = doc.extract_image(xref)
+    if extracted.get('ext') in PASSTHROUGH_FORMATS and extracted.get('colorspace') in (1, 3):
+        return extracted['image']
+    pix = fitz.Pixmap(doc, xref)
+    if pix.alpha or pix.n not in (1, 3):
+        pix = fitz.Pixmap(fitz.csRGB, pix, 0)
+    return encode_page(Image.frombytes("L" if pix.n == 1 else "RGB", (pix.width, pix.height), pix.samples))
+
+def get_page_extension(image_bytes):
+    """Returns the file extension of an encoded page from its first bytes, so copied scans keep their own format."""
+    if image_bytes[:2] == b'\xff\xd8':
+        return '.jpg'
+    if image_bytes[:4] == b'\x89PNG':
+        return '.png'
+    if image_bytes[:4] == b'RIFF' and image_bytes[8:12] == b'WEBP':
+        return '.webp'
+    return get_image_extension()
+
+# --- Function: Image Format ---
+# image_format -> (Pillow format name, file extension)
+IMAGE_FORMATS = {
+    'webp': ('WEBP', '.webp'),
+    'jpeg': ('JPEG', '.jpg'),
+    'png': ('PNG', '.png'),
+    'avif': ('AVIF', '.avif'),
+}
+_checked_image_format = None
+
+def get_image_format():
+    """Returns the configured image format, or 'webp' (with a warning, once) when it is unknown or Pillow cannot write it."""
+    global _checked_image_format
+    if _checked_image_format is None:
+        requested = image_format.lower().replace('jpg', 'jpeg')
+        Image.init()
+        if requested in IMAGE_FORMATS and IMAGE_FORMATS[requested][0] in Image.SAVE:
+            _checked_image_format = requested
+        else:
+            print_status(f"Image format '{image_format}' is not available with this Pillow, using 'webp' instead.", "warn")
+            _checked_image_format = 'webp'
+    return _checked_image_format
+
+def get_image_extension():
+    return IMAGE_FORMATS[get_image_format()][1]
+
+# --- Function: Grayscale Pages ---
+def is_grayscale_page(img, tolerance=24, colour_share=0.001):
+    """Returns True when (almost) no pixel has colour: at most colour_share of the pixels differ by more than tolerance between channels."""
+    if img.mode == 'L':
+        return True
+    pixels = np.asarray(img.convert('RGB'))[::2, ::2].astype(np.int16)  # Every other row and column is plenty
+    spread = pixels.max(axis=2) - pixels.min(axis=2)
+    return np.count_nonzero(spread > tolerance) <= colour_share * spread.size
+
+def to_grayscale(img, image_format):
+    """Converts a page to grayscale with 2**grayscale_bits shades. PNG pages get a matching palette, so they are stored with that many bits."""
+    gray = img.convert('L')
+    if grayscale_bits >= 8:
+        return gray
+    levels = 2 ** max(1, grayscale_bits)
+    shades = (np.asarray(gray, dtype=np.uint16) * (levels - 1) + 127) // 255
+    if image_format == 'png':
+        paletted = Image.fromarray(shades.astype(np.uint8), 'P')
+        paletted.putpalette([shade * 255 // (levels - 1) for shade in range(levels) for _ in range(3)])
+        return paletted
+    return Image.fromarray((shades * 255 // (levels - 1)).astype(np.uint8), 'L')
+
+# --- Function: Encode Page ---
+def get_save_options(image_format, img):
+    """Returns the Pillow save() arguments for a page in the given format."""
+    effort = min(6, max(0, image_effort))
+    if image_format == 'jpeg':
+        return {'format': 'JPEG', 'quality': image_quality, 'optimize': effort >= 4}
+    if image_format == 'png':
+        options = {'format': 'PNG', 'compress_level': round(effort * 9 / 6)}
+        if img.mode == 'P':
+            options['bits'] = max(1, min(8, grayscale_bits))
+        return options
+    if image_format == 'avif':
+        return {'format': 'AVIF', 'quality': image_quality, 'speed': 10 - effort}
+    return {'format': 'WEBP', 'quality': image_quality, 'method': effort}
+
+ENCODED_PAGE_CACHE_SIZE = 16  # Recently encoded pages kept for reuse
+_encoded_pages = collections.OrderedDict()  # Pixel hash -> encoded bytes, most recently used last
+_encoded_pages_lock = threading.Lock()
+
+def encode_page(img):
+    """Encodes a rendered page in the configured format (and grayscale setting) and returns the file bytes.
+
+    A page with exactly the same pixels as one of the last ENCODED_PAGE_CACHE_SIZE pages (blank pages, repeated
+    ornament pages) reuses that page's bytes instead of being encoded again.
+    """
+    pixel_hash = hashlib.blake2b(f"{img.mode} {img.size}".encode(), digest_size=16)
+    pixel_hash.update(img.tobytes())
+    key = pixel_hash.digest()
+    with _encoded_pages_lock:
+        if key in _encoded_pages:
+            _encoded_pages.move_to_end(key)
+            return _encoded_pages[key]
+    image_bytes = _encode_page(img)
+    with _encoded_pages_lock:
+        _encoded_pages[key] = image_bytes
+        while len(_encoded_pages) > ENCODED_PAGE_CACHE_SIZE:
+            _encoded_pages.popitem(last=False)
+    return image_bytes
+
+def _encode_page(img):
+    image_format = get_image_format()
+    if grayscale_pages == 'always' or (grayscale_pages == 'auto' and is_grayscale_page(img)):
+        img = to_grayscale(img, image_format)
+    buffer = io.BytesIO()
+    img.save(buffer, **get_save_options(image_format, img))
+    return buffer.getvalue()
+
+# --- Function: Prepare Page ---
+def prepare_page(img, padding=10, timings=None):
+    """Crops the white margins of a freshly rendered page (when enabled) and encodes it, so each page is encoded once.
 
+    When timings is a dict, the seconds spent cropping and encoding are added to it.
+    """
+    if crop_white_margins_enabled:
+        with instrumentation.timer(timings, 'crop'):
+            img = img.crop(get_content_box(img, padding))
+    with instrumentation.timer(timings, 'encode'):
+        return encode_page(img)
+
+# --- Function: Crop and Encode a Chapter ---
+def prepare_chapter_pages(images, padding=10, box=None):
+    """Crops a whole chapter with one shared box and encodes the pages, using threads since Pillow encodes without the GIL.
+
+    box is the chapter's crop box when it was already found (for a chapter handled a window of pages at a time).
+    """
+    with instrumentation.stage('crop', pages=len(images)):
+        if box is None:
+            box = get_chapter_content_box(images, padding)
+        cropped = [img.crop(clip_box(box, img)) for img in images]
+    with instrumentation.stage('encode', pages=len(images)), concurrent.futures.ThreadPoolExecutor(max_workers=max(1, render_workers)) as executor:
+        return list(executor.map(encode_page, cropped))
+
+# --- Function: Render Worker Setup ---
+_worker_doc = None
+_worker_zoom = 1.0
+_worker_encode = True
+_worker_cache = None
+
+def _init_render_worker(pdf_path, zoom, encode, layout=None, cache=None):
+    """Opens the PDF once per worker process; every page task in that worker reuses the handle."""
+    global _worker_doc, _worker_zoom, _worker_encode, _worker_cache
+    _worker_doc = open_reflowable_document(pdf_path, layout) if layout else fitz.open(pdf_path)
+    _worker_zoom = zoom
+    _worker_encode = encode
+    _worker_cache = cache
+
+def _render_page_task(page_index):
+    return (page_index,) + render_and_prepare_page(_worker_doc, page_index, _worker_zoom, _worker_encode, _worker_cache)
+
+# --- Function: Page Cache ---
+def get_page_cache(pdf_path, zoom=1.0, layout=None):
+    """Returns where this PDF's rendered pages are cached ({'library_dir', 'source_hash', 'render_key'}), or None.
+
+    The render key covers every setting that changes the rendered pixels. Reflowable documents (EPUB) are not cached.
+    """
+    if not use_page_cache or layout:
+        return None
+    source_hash = result_cache.file_hash(input_dir, pdf_path)
+    if not source_hash:
+        return None
+    render_key = f"w{target_width}" if target_width else f"{zoom * 72:g}dpi"
+    if grayscale_pages == 'always':
+        render_key += "-gray"
+    return {'library_dir': input_dir, 'source_hash': source_hash, 'render_key': render_key}
+
+def render_page_cached(doc, page_index, zoom=1.0, cache=None, timings=None):
+    """render_page(), but reads the page from the page cache when it was rendered before, and saves slow pages otherwise."""
+    if cache is None:
+        with instrumentation.timer(timings, 'rasterize'):
+            return render_page(doc, page_index, zoom)
+    with instrumentation.timer(timings, 'page_cache_read'):
+        img = page_cache.load(cache['library_dir'], cache['source_hash'], page_index, cache['render_key'])
+    if img is None:
+        start = time.perf_counter()
+        img = render_page(doc, page_index, zoom)
+        render_seconds = time.perf_counter() - start
+        timings['rasterize'] = timings.get('rasterize', 0.0) + render_seconds
+        if render_seconds >= page_cache.MIN_RENDER_SECONDS:
+            with instrumentation.timer(timings, 'page_cache_write'):
+                page_cache.store(cache['library_dir'], cache['source_hash'], page_index, cache['render_key'], img)
+    return img
+
+# --- Function: Render and Prepare Page ---
+def render_and_prepare_page(doc, page_index, zoom=1.0, encode=True, cache=None):
+    """Renders one page and, with encode=True, crops and encodes it. Returns (page, {stage: seconds}).
+
+    Blank pages are not rendered: they become a white page of the same size, or None with skip_blank_pages.
+
+    Scanned pages are copied instead (see get_passthrough_image) when passthrough_scanned_pages is set, no margins
+    are cropped and pages are not forced to grayscale. Other pages come from the page cache when cache (see get_page_cache) has them.
+    """
+    timings = {}
+    if doc.is_pdf:
+        start = time.perf_counter()
+        page = doc.load_page(page_index)
+        if is_blank_page(page):
+            img = None if skip_blank_pages else get_blank_page(page, zoom)
+            if img is not None and encode:
+                img = prepare_page(img, timings=timings)
+            timings['blank'] = time.perf_counter() - start - sum(timings.values())
+            return img, timings
+        timings['rasterize'] = time.perf_counter() - start
+    if encode and passthrough_scanned_pages and not crop_white_margins_enabled and grayscale_pages != 'always':
+        start = time.perf_counter()
+        image_bytes = get_passthrough_image(doc, page_index)
+        if image_bytes is not None:
+            timings['passthrough'] = time.perf_counter() - start
+            return image_bytes, timings
+        timings['rasterize'] = timings.get('rasterize', 0.0) + time.perf_counter() - start
+    img = render_page_cached(doc, page_index, zoom, cache, timings)
+    return (prepare_page(img, timings=timings) if encode else img), timings
+
+# --- Function: Iterate Rendered Pages ---
+def iter_rendered_pages(pdf_path, doc, page_indices, zoom=1.0, encode=True, layout=None):
+    """Yields (page_index, page) in page order, spreading the rendering over render_workers processes.
+
+    With encode=True each page is cropped and encoded to image bytes; otherwise the rendered PIL image is yielded.
+    Reflowable documents (EPUB) need their layout so the workers paginate them exactly like doc.
+    Page times are added to the open book's stages; with several workers they are summed across the workers.
+    Workers run at most render_window_pages pages ahead of the caller, so finished pages never pile up in memory.
+    """
+    page_indices = list(page_indices)
+    cache = get_page_cache(pdf_path, zoom, layout)
+    workers = min(render_workers, len(page_indices))
+    if workers <= 1:
+        for page_index in page_indices:
+            page, timings = render_and_prepare_page(doc, page_index, zoom, encode, cache)
+            instrumentation.add_stages(timings, pages=1)
+            yield page_index, page
+        return
+
+    ahead = max(workers * 2, render_window_pages) if render_window_pages > 0 else len(page_indices)
+    print_status(f"Rendering {len(page_indices)} pages with {workers} worker processes...", "info")
+    with multiprocessing.Pool(workers, initializer=_init_render_worker, initargs=(pdf_path, zoom, encode, layout, cache)) as pool:
+        in_flight = collections.deque()
+        queued = 0
+        while queued < len(page_indices) or in_flight:
+            while queued < len(page_indices) and len(in_flight) < ahead:
+                in_flight.append(pool.apply_async(_render_page_task, (page_indices[queued],)))
+                queued += 1
+            page_index, page, timings = in_flight.popleft().get()
+            instrumentation.add_stages(timings, pages=1)
+            yield page_index, page
+
+# --- Function: Crop Box for a Long Chapter ---
+def get_window_crop_box(pdf_path, doc, page_indices, zoom=1.0, layout=None):
+    """Finds the shared crop box of a chapter longer than render_window_pages with a first rendering pass.
+
+    Such a chapter is then cropped and written a window at a time instead of being held whole until its last page.
+    Returns None for shorter chapters, which are cropped in one go.
+    """
+    if not 0 < render_window_pages < len(page_indices):
+        return None
+    print_status(f"Finding the crop box of {len(page_indices)} pages before rendering them...", "info")
+    return get_streamed_content_box(page for _, page in iter_rendered_pages(pdf_path, doc, page_indices, zoom, encode=False, layout=layout)
+                                    if page is not None)
+
+# --- Function: ImageMagick Page Windows ---
+def get_magick_windows(pdf_path, start_page, end_page):
+    """Splits a page range into ImageMagick page ranges ('first-last', 0-based) of at most render_window_pages pages.
+
+    ImageMagick reads every page of a range into memory before writing any, so long ranges are rendered in windows.
+    Returns a list of (range, number of pages before it).
+    """
+    page_range = f"{start_page-1 if start_page > 0 else 0}-{end_page-2 if end_page and end_page > 1 else 'last'}"
+    if render_window_pages <= 0:
+        return [(page_range, 0)]
+    try:
+        with fitz.open(pdf_path) as doc:
+            page_indices = get_page_indices(doc.page_count, start_page, end_page)
+    except Exception:
+        return [(page_range, 0)]  # Let ImageMagick try the whole range
+    return [(f"{page_indices[offset]}-{page_indices[min(offset + render_window_pages, len(page_indices)) - 1]}", offset)
+            for offset in range(0, len(page_indices), render_window_pages)]
+
+# --- Function: Render Pages with ImageMagick ---
+def render_pages_magick(pdf_path, images_dir, start_page, end_page, high_res=False):
+    """Renders a page range by shelling out to ImageMagick (and Ghostscript), render_window_pages pages per run."""
     command = ["magick", "convert",
                 "-background", "white", "-alpha", "remove"]
 
-    if high_res:
+    if magick_memory_limit_mb:
+        # Past these limits ImageMagick keeps its pixel cache on disk instead of being stopped by the memory limit.
+        command.extend(["-limit", "memory", f"{magick_memory_limit_mb // 2}MiB", "-limit", "map", f"{magick_memory_limit_mb // 2}MiB"])
+    if target_dpi:
+        command.extend(["-density", str(target_dpi)])
+    elif high_res:
         command.extend(["-density", "150", "-resize", "125%"])
+    if target_width:
+        command.extend(["-resize", f"{target_width}x"])
+    if grayscale_pages == 'always':
+        command.extend(["-colorspace", "Gray"])
+    command.extend(["-quality", str(image_quality)])
+    if get_image_format() == 'webp':
+        command.extend(["-define", f"webp:method={min(6, max(0, image_effort))}"])
 
-    command.extend([
-        f"{pdf_path}[{start_page-1 if start_page > 0 else 0}-{end_page-2 if end_page and end_page > 1 else 'last'}]",
-        "-gravity", "Center",
-        "-extent", "100%x100%",
-        os.path.join(images_dir, "image-%04d.webp")
-    ])
+    windows = get_magick_windows(pdf_path, start_page, end_page)
+    for page_range, scene in windows:
+        if len(windows) > 1:
+            print_status(f"Rendering pages {page_range} with ImageMagick...", "info")
+        window_command = command + [
+            f"{pdf_path}[{page_range}]",
+            "-gravity", "Center",
+            "-extent", "100%x100%",
+            "-scene", str(scene),  # Numbers the images on from the previous window
+            os.path.join(images_dir, "image-%04d" + get_image_extension())
+        ]
 
-    try:
-        result = subprocess.run(command, check=True, stdout=subprocess.PIPE, stderr=subprocess.PIPE, text=True)
-    except subprocess.CalledProcessError as e:
-        print_status(f"Error running magick convert: {e.stderr.strip()}", "error")
+        with instrumentation.stage('rasterize') as counters:
+            pages_before = len(os.listdir(images_dir))
+            job = process_runner.run_command(window_command, label='magick', timeout=magick_timeout or None,
+                                             memory_limit_mb=magick_memory_limit_mb, prefix="  magick: ")
+            counters['pages'] = len(os.listdir(images_dir)) - pages_before
+        reason = process_runner.describe_failure(job, magick_timeout, magick_memory_limit_mb)
+        if job['status'] in (process_runner.STATUS_TIMEOUT, process_runner.STATUS_MEMORY, process_runner.STATUS_NOT_FOUND):
+            # The pages are incomplete, so the book fails and keeps its PDF for the next run.
+            raise RuntimeError(f"magick convert {reason}")
+        if job['status'] != process_runner.STATUS_OK:
+            # ImageMagick also exits with an error for Ghostscript warnings, so the pages it wrote are kept.
+            print_status(f"Error running magick convert: it {reason}.", "error")
 
 #    try:
 #        subprocess.run(command, check=True)
 #    except subprocess.CalledProcessError as e:
 #        print_status(f"Error running magick convert: {e}", "error")
-    for image_file in sorted(os.listdir(images_dir)):
-        image_path = os.path.join(images_dir, image_file)
-        if image_path.lower().endswith(('.png', '.jpg', '.jpeg', '.webp')):
-            crop_white_margins(image_path)
 
-            
+# --- Function: Open Reflowable Document ---
+def open_reflowable_document(path, layout):
+    """Opens an EPUB with PyMuPDF and lays it out into fixed pages.
+
+    layout is a dict with 'width' and 'height' (points), 'font_size' and 'css' (user style sheet applied to every page).
+    """
+    if hasattr(fitz, 'mupdf'):
+        fitz.mupdf.fz_set_user_css(layout.get('css', ''))
+    doc = fitz.open(path)
+    doc.layout(width=layout['width'], height=layout['height'], fontsize=layout['font_size'])
+    return doc
+
+# --- Function: Open PDF Document ---
+def open_pdf_document(pdf_path, layout=None):
+    """Opens a PDF once for in-process rendering. Returns None when PyMuPDF is disabled or cannot read the file.
+
+    With a layout the file is opened as a reflowable book (EPUB); those can only be rendered by PyMuPDF.
+    """
+    if not use_pymupdf_renderer and not layout:
+        return None
+    try:
+        return open_reflowable_document(pdf_path, layout) if layout else fitz.open(pdf_path)
+    except Exception as e:
+        print_status(f"PyMuPDF could not open {pdf_path}: {e}", "warn")
+        return None
+
+# --- Function: Close PDF Document ---
+def close_pdf_document(doc):
+    """Closes a document opened by open_pdf_document so the PDF can be removed afterwards."""
+    if doc is not None and not doc.is_closed:
+        doc.close()
+
+# --- Function: Store Rendered Page ---
+def store_chapter_page(chapter, image_num, image_bytes):
+    """Adds one rendered page to a chapter, either streamed into its CBZ or written to its image directory."""
+    image_name = f"image-{image_num:04d}{get_page_extension(image_bytes)}"
+    with instrumentation.stage('archive' if chapter.get('stream') else 'write_images', pages=1) as counters:
+        counters['bytes'] = len(image_bytes)
+        if chapter.get('stream'):
+            if chapter.get('cbz') is None:
+                chapter['cbz'] = open_cbz_stream(chapter['output_cbz'])
+            write_cbz_entry(chapter['cbz'], image_name, data=image_bytes)
+        else:
+            with open(os.path.join(chapter['images_dir'], image_name), 'wb') as f:
+                f.write(image_bytes)
+
+# --- Function: Render Chapters in a Single Pass ---
+def render_chapters_single_pass(doc, chapters, high_res=False, on_chapter_rendered=None, layout=None):
+    """Renders the document front-to-back once, routing every page into each chapter that contains it."""
+    zoom = get_render_zoom(high_res)
+    for chapter in chapters:
+        if not chapter.get('stream'):
+            os.makedirs(chapter['images_dir'], exist_ok=True)
+        chapter['page_indices'] = get_page_indices(doc.page_count, chapter['start_page'], chapter['end_page'])
+    # Chapter ranges never overlap, so each page's chapter is found by binary search over the chapter starts.
+    page_index = toc_model.build_page_index([(chapter['page_indices'].start, chapter['page_indices'].stop, chapter)
+                                             for chapter in chapters if chapter['page_indices']])
+    pages_to_render = sorted(page for chapter in chapters for page in chapter['page_indices'])
+
+    for chapter in chapters:
+        if not chapter['page_indices'] and on_chapter_rendered:
+            on_chapter_rendered(chapter)
+
+    # A shared crop box needs every page of the chapter, so those pages are held until the chapter is complete.
+    # Chapters longer than render_window_pages get their box from a first pass and are written a window at a time.
+    chapter_crop = crop_white_margins_enabled and crop_per_chapter
+    if chapter_crop:
+        for chapter in chapters:
+            chapter['crop_box'] = get_window_crop_box(doc.name, doc, chapter['page_indices'], zoom, layout=layout)
+    for page_num, page in iter_rendered_pages(doc.name, doc, pages_to_render, zoom, encode=not chapter_crop, layout=layout):
+        chapter = toc_model.find_in_page_index(page_index, page_num)
+        chapter.setdefault('started', time.perf_counter())
+        image_num = page_num - chapter['page_indices'].start
+        chapter_done = page_num == chapter['page_indices'][-1]
+        if page is not None and chapter_crop:
+            chapter.setdefault('pending_pages', []).append((image_num, page))
+        elif page is not None:
+            store_chapter_page(chapter, image_num, page)
+        # page is None for a blank page left out (skip_blank_pages)
+        if chapter.get('pending_pages') and (chapter_done or (chapter['crop_box'] and len(chapter['pending_pages']) >= render_window_pages)):
+            pending_nums, pending_images = zip(*chapter.pop('pending_pages'))
+            for pending_num, image_bytes in zip(pending_nums, prepare_chapter_pages(pending_images, box=chapter['crop_box'])):
+                store_chapter_page(chapter, pending_num, image_bytes)
+        if chapter_done and on_chapter_rendered:
+            on_chapter_rendered(chapter)
+
+# --- Function: Render Chapters ---
+def render_chapters(pdf_path, chapters, high_res=False, doc=None, on_chapter_rendered=None, layout=None):
+    """Renders the images for every chapter. Each chapter is a dict with 'start_page', 'end_page' and 'images_dir'.
+
+    With PyMuPDF the PDF is rendered once and pages are routed to their chapters; on_chapter_rendered is
+    called as soon as a chapter's last page is written. Chapters with 'stream' set get their pages written
+    into an open CBZ ('cbz') instead of 'images_dir'. ImageMagick renders chapter by chapter to disk.
+    Reflowable documents opened with a layout have no ImageMagick fallback; their unfinished chapters are dropped.
+    """
+    finished = []
+
+    def chapter_rendered(chapter):
+        finished.append(chapter)
+        if on_chapter_rendered:
+            on_chapter_rendered(chapter)
+
+    if doc is not None:
+        print_status(f"Rendering {len(chapters)} chapter(s) from {pdf_path} in a single pass...", "info")
+        try:
+            render_chapters_single_pass(doc, chapters, high_res=high_res, on_chapter_rendered=chapter_rendered, layout=layout)
+        except Exception as e:
+            print_status(f"PyMuPDF rendering failed for {pdf_path}: {e}. Falling back to ImageMagick.", "warn")
+
+    for chapter in chapters:
+        if any(chapter is done for done in finished):
+            continue
+        # ImageMagick can only write files, so a half-streamed chapter is discarded and rendered to disk.
+        if chapter.get('cbz') is not None:
+            abort_cbz_stream(chapter.pop('cbz'), chapter['output_cbz'])
+        if os.path.isdir(chapter['images_dir']):
+            shutil.rmtree(chapter['images_dir'])
+        if layout:
+            print_status(f"Could not render {chapter['label']} of {pdf_path}.", "error")
+            continue
+        chapter['stream'] = False
+        chapter['started'] = time.perf_counter()
+        os.makedirs(chapter['images_dir'], exist_ok=True)
+        render_pages_magick(pdf_path, chapter['images_dir'], chapter['start_page'], chapter['end_page'], high_res=high_res)
+        crop_chapter_images_dir(chapter['images_dir'])
+        chapter_rendered(chapter)
+
 # --- Function: Create ComicInfo.xml ---
 def create_comicinfo(metadata, chapter_num, output_dir):
     comicinfo = f"""<?xml version="1.0" encoding="UTF-8"?>
@@ -305,42 +865,82 @@ def parse_metadata_json(metadata_file):
         print_status(f"Error: Unicode decoding error in {metadata_file}: {e}", "error")
         return {}
 
+# --- Function: CBZ Entry Compression ---
+def get_cbz_compression(arcname):
+    """Returns (compress_type, compresslevel) for a CBZ entry. Images are already entropy-coded, so they are stored."""
+    if arcname.lower().endswith(('.webp', '.jpg', '.jpeg', '.png', '.gif', '.avif')) and not cbz_compress_images:
+        return zipfile.ZIP_STORED, None
+    return zipfile.ZIP_DEFLATED, cbz_compresslevel
+
+# --- Function: Write CBZ Entry ---
+def write_cbz_entry(cbz, arcname, data=None, path=None):
+    """Adds a file (path) or in-memory bytes (data) to an open CBZ using the per-entry compression policy."""
+    compress_type, compresslevel = get_cbz_compression(arcname)
+    if path is not None:
+        cbz.write(path, arcname, compress_type=compress_type, compresslevel=compresslevel)
+    else:
+        cbz.writestr(arcname, data, compress_type=compress_type, compresslevel=compresslevel)
+
 # --- Function: Create CBZ Archive ---
 def create_cbz(images_dir, output_cbz, comicinfo_path):
     if not overwrite_existing_cbz and os.path.exists(output_cbz):
         print_status(f"CBZ file already exists: {output_cbz}. Skipping creation.", "warn")
         return
 
-    with zipfile.ZipFile(output_cbz, 'w', zipfile.ZIP_DEFLATED) as cbz:
+    with instrumentation.stage('archive') as counters, zipfile.ZipFile(output_cbz, 'w', zipfile.ZIP_STORED) as cbz:
         for image_file in sorted(os.listdir(images_dir)):
-            cbz.write(os.path.join(images_dir, image_file), image_file)
+            image_path = os.path.join(images_dir, image_file)
+            write_cbz_entry(cbz, image_file, path=image_path)
+            counters['pages'] += 1
+            counters['bytes'] += os.path.getsize(image_path)
         if comicinfo_path and os.path.exists(comicinfo_path):
-            cbz.write(comicinfo_path, "ComicInfo.xml")
+            write_cbz_entry(cbz, "ComicInfo.xml", path=comicinfo_path)
     print_status(f"Created CBZ archive: {output_cbz}", "success")
 
+# --- Function: Open CBZ Stream ---
+def open_cbz_stream(output_cbz):
+    """Opens a CBZ for page-by-page writing. Pages go to a '.part' file that finish_cbz_stream renames."""
+    return zipfile.ZipFile(output_cbz + '.part', 'w', zipfile.ZIP_STORED)
+
+# --- Function: Finish CBZ Stream ---
+def finish_cbz_stream(cbz, output_cbz, comicinfo_path):
+    with instrumentation.stage('archive'):
+        if comicinfo_path and os.path.exists(comicinfo_path):
+            write_cbz_entry(cbz, "ComicInfo.xml", path=comicinfo_path)
+        cbz.close()
+        os.replace(output_cbz + '.part', output_cbz)
+    print_status(f"Created CBZ archive: {output_cbz}", "success")
+
+# --- Function: Abort CBZ Stream ---
+def abort_cbz_stream(cbz, output_cbz):
+    cbz.close()
+    if os.path.exists(output_cbz + '.part'):
+        os.remove(output_cbz + '.part')
+
 # --- Function: Cleanup ---
 def cleanup(images_dir=None, pdf_path=None, comicinfo_path=None, json_path=None, metadata_path=None):
-    if images_dir and os.path.exists(images_dir) and os.path.isdir(images_dir):
-        shutil.rmtree(images_dir)
-        print_status(f"Cleaned up image directory: {images_dir}", "info")
-    if comicinfo_path and os.path.exists(comicinfo_path) and os.path.isfile(comicinfo_path):
-        os.remove(comicinfo_path)
-        print_status(f"Removed ComicInfo.xml: {comicinfo_path}", "info")
+    with instrumentation.stage('cleanup'):
+        if images_dir and os.path.exists(images_dir) and os.path.isdir(images_dir):
+            shutil.rmtree(images_dir)
+            print_status(f"Cleaned up image directory: {images_dir}", "info")
+        if comicinfo_path and os.path.exists(comicinfo_path) and os.path.isfile(comicinfo_path):
+            os.remove(comicinfo_path)
+            print_status(f"Removed ComicInfo.xml: {comicinfo_path}", "info")
 
-    try:
-        if delete_json and metadata_path and os.path.exists(metadata_path):
-            os.remove(metadata_path)
-            print_status(f"Removed metadata: {metadata_path}", "info")
-    except Exception as e:
-        print_status(f"Error during metadata cleanup: {e}", "error")
+        try:
+            if delete_json and metadata_path and os.path.exists(metadata_path):
+                os.remove(metadata_path)
+                print_status(f"Removed metadata: {metadata_path}", "info")
+        except Exception as e:
+            print_status(f"Error during metadata cleanup: {e}", "error")
 
-    if delete_pdf and pdf_path and os.path.exists(pdf_path) and os.path.isfile(pdf_path):
-        os.remove(pdf_path)
-        print_status(f"Removed PDF: {pdf_path}", "info")
+        if delete_pdf and pdf_path and os.path.exists(pdf_path) and os.path.isfile(pdf_path):
+            os.remove(pdf_path)
+            print_status(f"Removed PDF: {pdf_path}", "info")
 
-    if delete_json and json_path and os.path.exists(json_path):
-        os.remove(json_path)
-        print_status(f"Removed Chapter JSON: {json_path}", "info")
+        if delete_json and json_path and os.path.exists(json_path):
+            os.remove(json_path)
+            print_status(f"Removed Chapter JSON: {json_path}", "info")
 
 # --- Function: Cleanup CBZ Filename ---
 def cleanup_cbz_filename(cbz_path):
@@ -359,91 +959,234 @@ def cleanup_cbz_filename(cbz_path):
             return cbz_path
     return cbz_path
 
+# --- Function: Result Cache Settings ---
+def get_result_cache_settings(info_path=None, metadata_path=None):
+    """Returns the settings (and input JSON hashes) that change the CBZ output. Cached results are reused only when all match."""
+    settings = {
+        'HighRes': HighRes,
+        'target_dpi': target_dpi,
+        'target_width': target_width,
+        'image_format': get_image_format(),
+        'image_quality': image_quality,
+        'image_effort': image_effort,
+        'grayscale_pages': grayscale_pages,
+        'grayscale_bits': grayscale_bits,
+        'passthrough_scanned_pages': passthrough_scanned_pages,
+        'skip_blank_pages': skip_blank_pages,
+        'use_pymupdf_renderer': use_pymupdf_renderer,
+        'crop_white_margins_enabled': crop_white_margins_enabled,
+        'crop_white_threshold': crop_white_threshold,
+        'crop_per_chapter': crop_per_chapter,
+        'create_comicinfo_enabled': create_comicinfo_enabled,
+        'chapter_page_filter_threshold': chapter_page_filter_threshold,
+        'min_chapters_for_split': min_chapters_for_split,
+        'cbz_compress_images': cbz_compress_images,
+        'cbz_compresslevel': cbz_compresslevel,
+    }
+    if info_path is not None:
+        settings['chapters_json'] = result_cache.file_hash(input_dir, info_path) if os.path.exists(info_path) else None
+        settings['metadata_json'] = result_cache.file_hash(input_dir, metadata_path) if metadata_path else None
+    return settings
+
+# --- Function: Record Result ---
+def record_result(source_hash, cache_settings, outputs):
+    """Saves the CBZs made from a PDF. When p1 made the PDF from an EPUB, the result is also saved for that EPUB."""
+    result_cache.record(input_dir, 'pdf_to_cbz', source_hash, cache_settings, outputs)
+    origin = result_cache.find_by_output(input_dir, 'epub_to_pdf', source_hash)
+    if origin:
+        epub_hash, extra = origin
+        book_settings = {'p1': extra.get('p1_settings'), 'p2': get_result_cache_settings()}
+        result_cache.record(input_dir, 'book', epub_hash, book_settings, outputs)
+
+# --- Function: Process PDF ---
+def process_pdf(pdf_path, layout=None, doc=None):
+    """Converts one PDF into a single CBZ or one CBZ per chapter, rendering the document once.
+
+    With a layout, pdf_path is a reflowable book (EPUB) that p1 renders directly; doc may be passed in when the
+    caller already opened it. The source file is then left for the caller to remove. Returns the book's CBZ paths,
+    or an empty list when not all of them could be made.
+    """
+    folder_path, file_name = os.path.split(pdf_path)
+    book_name = os.path.splitext(file_name)[0]
+    # With a layout the book was handed over by p1, whose record of it is open in the parent process.
+    with instrumentation.book(book_name, script='p2', nested=bool(layout)) as book_record:
+        info_path = os.path.join(folder_path, book_name + ' chapters.json')
+        output_folder = create_output_structure(pdf_path)
+
+        source_hash = None
+        if use_result_cache and not layout:
+            source_hash = result_cache.file_hash(input_dir, pdf_path)
+            cache_settings = get_result_cache_settings(info_path, get_metadata_json(pdf_path))
+            cached = result_cache.lookup(input_dir, 'pdf_to_cbz', source_hash, cache_settings, output_folder)
+            if cached:
+                print_status(f"Skipping {pdf_path}: unchanged since its {len(cached[0])} CBZ file(s) were created.", "info")
+                book_record['cached'] = True
+                cleanup(pdf_path=pdf_path, json_path=info_path if os.path.exists(info_path) else None, metadata_path=get_metadata_json(pdf_path))
+                return cached[0]
+
+        # Books in the root of input_dir share it with other books, so their images go to a private work directory.
+        is_root_dir = os.path.dirname(pdf_path) == input_dir
+        work_dir = tempfile.mkdtemp(dir=output_folder) if is_root_dir else output_folder
+
+        chapter_pages = []
+        if os.path.exists(info_path):
+            print_status(f"Reading chapter info from: {info_path}", "info")
+            chapter_pages = read_chapter_info(info_path)
+        else:
+            print_status(f"No chapter info found. Converting entire PDF to CBZ: {pdf_path}", "warn")
+
+        if len(chapter_pages) >= min_chapters_for_split:
+            chapters = [{
+                'number': i + 1,
+                'start_page': chapter_pages[i],
+                'end_page': chapter_pages[i + 1],
+                'images_dir': os.path.join(work_dir, f"chapter_{i+1}"),
+                'output_cbz': os.path.join(output_folder, f"{book_name} Chapter {i+1}.cbz"),
+                'label': f"chapter {i + 1}",
+            } for i in range(len(chapter_pages) - 1)]
+        else:
+            chapters = [{
+                'number': 1,  # Assuming single CBZ for whole PDF
+                'start_page': 0,
+                'end_page': 9999,
+                'images_dir': os.path.join(work_dir, "whole_pdf"),
+                'output_cbz': os.path.join(output_folder, f"{book_name}.cbz"),
+                'label': "whole PDF",
+            }]
+
+        # Fetch and parse metadata once for every CBZ of this book
+        metadata_file = get_metadata_json(pdf_path)
+        metadata = parse_metadata_json(metadata_file) if metadata_file else {}
+
+        expected_outputs = [chapter['output_cbz'] for chapter in chapters]
+        if not overwrite_existing_cbz:
+            for chapter in [chapter for chapter in chapters if os.path.exists(chapter['output_cbz'])]:
+                print_status(f"CBZ file already exists: {chapter['output_cbz']}. Skipping creation.", "warn")
+                chapters.remove(chapter)
+
+        for chapter in chapters:
+            chapter['stream'] = stream_to_cbz
+
+        def write_chapter_cbz(chapter):
+            if create_comicinfo_enabled:
+                if not sys.platform.startswith('win'):
+                    print_status(f"Creating ComicInfo for {chapter['label']} with metadata: {metadata}", "info")
+                comicinfo_path = create_comicinfo(metadata, chapter['number'], work_dir)
+            else:
+                comicinfo_path = None
+            if chapter['stream']:
+                cbz = chapter.pop('cbz', None) or open_cbz_stream(chapter['output_cbz'])
+                finish_cbz_stream(cbz, chapter['output_cbz'], comicinfo_path)
+            else:
+                create_cbz(chapter['images_dir'], chapter['output_cbz'], comicinfo_path)
+                cleanup(chapter['images_dir'])
+            instrumentation.record('chapter', chapter['label'], time.perf_counter() - chapter.get('started', time.perf_counter()),
+                                   pages=len(chapter['page_indices']) if 'page_indices' in chapter else None, bytes=instrumentation.file_size(chapter['output_cbz']))
+
+        owns_doc = doc is None
+        if owns_doc:
+            doc = open_pdf_document(pdf_path, layout)
+        book_record['pages'] = doc.page_count if doc is not None else None
+        try:
+            render_chapters(pdf_path, chapters, high_res=HighRes, doc=doc, on_chapter_rendered=write_chapter_cbz, layout=layout)
+        except BaseException:
+            # The book failed: its half-written chapters go, its PDF and JSON files stay for the next run.
+            for chapter in chapters:
+                if chapter.get('cbz') is not None:
+                    abort_cbz_stream(chapter.pop('cbz'), chapter['output_cbz'])
+                cleanup(chapter['images_dir'])
+            raise
+        finally:
+            if owns_doc:
+                close_pdf_document(doc)
+            cleanup(comicinfo_path=os.path.join(work_dir, 'ComicInfo.xml'))
+            if is_root_dir:
+                shutil.rmtree(work_dir)
+                print_status(f"Cleaned up temporary directory: {work_dir}", "info")
+        if use_page_cache:
+            page_cache.trim(input_dir, page_cache_size_mb * 1024 * 1024)
+
+        complete = all(os.path.exists(output) for output in expected_outputs)
+        book_record['bytes'] = sum(instrumentation.file_size(output) for output in expected_outputs)
+        book_record['complete'] = complete
+        if source_hash and complete:
+            record_result(source_hash, cache_settings, expected_outputs)
+
+        cleanup(pdf_path=None if layout else pdf_path, json_path=info_path if os.path.exists(info_path) else None, metadata_path=get_metadata_json(pdf_path))
+        return expected_outputs if complete else []
+
+# --- Function: Find Book Jobs ---
+def find_pdf_jobs(input_dir):
+    """Walks input_dir once and groups the PDFs by folder. Each folder is one job so no two workers share a folder."""
+    jobs = []
+    for folder_path, _, file_names in os.walk(input_dir):
+        pdf_paths = [os.path.join(folder_path, file_name) for file_name in file_names if file_name.lower().endswith('.pdf')]
+        if pdf_paths:
+            jobs.append((folder_path, pdf_paths))
+    return jobs
+
+# --- Function: Folder Job ---
+def get_pdf_job(folder_path):
+    """Returns the job (see find_pdf_jobs) for the PDFs directly inside one folder, or None when there are none."""
+    try:
+        file_names = sorted(os.listdir(folder_path))
+    except OSError:
+        return None
+    pdf_paths = [os.path.join(folder_path, file_name) for file_name in file_names
+                 if file_name.lower().endswith('.pdf') and os.path.isfile(os.path.join(folder_path, file_name))]
+    return (folder_path, pdf_paths) if pdf_paths else None
+
+# --- Function: Process PDF Folder ---
+def process_pdf_folder(job):
+    """Converts every PDF of one folder in turn. Returns the number of PDFs that failed."""
+    folder_path, pdf_paths = job
+    instrumentation.configure(input_dir, log_stage_timings)
+    failures = 0
+    for pdf_path in pdf_paths:
+        try:
+            process_pdf(pdf_path)
+        except Exception as e:
+            failures += 1
+            print_status(f"Error converting {pdf_path}: {e}", "error")
+    return failures
+
 # --- Main Function ---
 def main():
     print_status(f"Starting the process with input directory: {input_dir}", "info")
+    jobs = find_pdf_jobs(input_dir)
+    total = len(jobs)
+    print_status(f"Found {sum(len(pdf_paths) for _, pdf_paths in jobs)} PDF(s) in {total} folder(s).", "info")
+
+    if book_workers > 1 and total > 1:
+        executor = concurrent.futures.ProcessPoolExecutor(max_workers=min(book_workers, total))
+        results = executor.map(process_pdf_folder, jobs)
+    else:
+        executor = None
+        results = map(process_pdf_folder, jobs)
+
+    try:
+        # Results arrive in discovery order, so progress is reported in a stable order.
+        for done, ((folder_path, _), failures) in enumerate(zip(jobs, results), start=1):
+            if failures:
+                print_status(f"[{done}/{total}] Finished {folder_path} with {failures} error(s)", "warn")
+            else:
+                print_status(f"[{done}/{total}] Finished {folder_path}", "success")
+    finally:
+        if executor:
+            executor.shutdown()
+
+# --- Function: Remove CBZ Prefixes ---
+def remove_cbz_prefixes(input_dir):
+    print_status("Scanning for CBZ files to clean...", "info")
     for folder_path, _, file_names in os.walk(input_dir):
         for file_name in file_names:
-            if file_name.lower().endswith('.pdf'):
-                pdf_path = os.path.join(folder_path, file_name)
-                info_path = os.path.join(folder_path, os.path.splitext(file_name)[0] + ' chapters.json')
-                output_folder = create_output_structure(pdf_path)
-
-                if os.path.exists(info_path):
-                    print_status(f"Reading chapter info from: {info_path}", "info")
-                    chapter_pages = read_chapter_info(info_path)
-                    if len(chapter_pages) >= min_chapters_for_split:
-                        for i in range(len(chapter_pages) - 1):
-                            start_page, end_page = chapter_pages[i], chapter_pages[i + 1]
-                            images_dir = os.path.join(output_folder, f"chapter_{i+1}")
-                            convert_pdf_to_images(pdf_path, images_dir, start_page, end_page, high_res=HighRes)
-
-                            # Fetch and parse metadata PER CHAPTER
-                            metadata_file = get_metadata_json(pdf_path)
-                            metadata = parse_metadata_json(metadata_file) if metadata_file else {}
-                            if create_comicinfo_enabled:
-                                if not sys.platform.startswith('win'):
-                                    print_status(f"Creating ComicInfo for chapter {i + 1} with metadata: {metadata}", "info")
-                                comicinfo_path = create_comicinfo(metadata, i + 1, output_folder)
-                            else:
-                                comicinfo_path = None
-                            output_cbz = os.path.join(output_folder, f"{os.path.splitext(file_name)[0]} Chapter {i+1}.cbz")
-                            create_cbz(images_dir, output_cbz, comicinfo_path)
-                            cleanup(images_dir)
-                        cleanup(pdf_path=pdf_path, comicinfo_path=os.path.join(output_folder, 'ComicInfo.xml'), json_path=info_path if os.path.exists(info_path) else None, metadata_path=get_metadata_json(pdf_path))
-                    else:
-                        images_dir = os.path.join(output_folder, "whole_pdf")
-                        os.makedirs(images_dir, exist_ok=True)
-                        convert_pdf_to_images(pdf_path, images_dir, 0, 9999, high_res=HighRes)
-
-                        # Fetch and parse metadata for the whole PDF
-                        metadata_file = get_metadata_json(pdf_path)
-                        metadata = parse_metadata_json(metadata_file) if metadata_file else {}
-                        if create_comicinfo_enabled:
-                            if not sys.platform.startswith('win'):
-                                print_status(f"Creating ComicInfo for whole PDF with metadata: {metadata}", "info")
-                            comicinfo_path = create_comicinfo(metadata, 1, output_folder) # Assuming single CBZ for whole PDF
-                        else:
-                            comicinfo_path = None
-                        output_cbz = os.path.join(output_folder, f"{os.path.splitext(file_name)[0]}.cbz")
-                        create_cbz(images_dir, output_cbz, comicinfo_path)
-                        cleanup(images_dir)
-                        cleanup(pdf_path=pdf_path, comicinfo_path=os.path.join(output_folder, 'ComicInfo.xml'), json_path=info_path if os.path.exists(info_path) else None, metadata_path=get_metadata_json(pdf_path))
-                else:
-                    print_status(f"No chapter info found. Converting entire PDF to CBZ: {pdf_path}", "warn")
-                    images_dir = os.path.join(output_folder, "whole_pdf")
-                    os.makedirs(images_dir, exist_ok=True)
-                    convert_pdf_to_images(pdf_path, images_dir, 0, 9999, high_res=HighRes)
-
-                    # Fetch and parse metadata for the whole PDF
-                    metadata_file = get_metadata_json(pdf_path)
-                    metadata = parse_metadata_json(metadata_file) if metadata_file else {}
-                    if create_comicinfo_enabled:
-                        if not sys.platform.startswith('win'):
-                            print_status(f"Creating ComicInfo for whole PDF with metadata: {metadata}", "info")
-                        comicinfo_path = create_comicinfo(metadata, 1, output_folder) # Assuming single CBZ for whole PDF
-                    else:
-                        comicinfo_path = None
-                    output_cbz = os.path.join(output_folder, f"{os.path.splitext(file_name)[0]}.cbz")
-                    create_cbz(images_dir, output_cbz, comicinfo_path)
-                    cleanup(images_dir)
-                    cleanup(pdf_path=pdf_path, comicinfo_path=os.path.join(output_folder, 'ComicInfo.xml'), json_path=None, metadata_path=get_metadata_json(pdf_path))
-
-                if os.path.dirname(pdf_path) == input_dir:
-                    shutil.rmtree(output_folder)
-                    print_status(f"Cleaned up temporary directory: {output_folder}", "info")
-                if delete_pdf and pdf_path and os.path.exists(pdf_path) and os.path.isfile(pdf_path):
-                    os.remove(pdf_path)
-                    print_status(f"Removed PDF: {pdf_path}", "info")
+            if file_name.lower().endswith('.cbz') and file_name.startswith("V "):
+                cbz_path = os.path.join(folder_path, file_name)
+                cleanup_cbz_filename(cbz_path)
+    print_status("CBZ filename cleanup complete.", "success")
 
 if __name__ == "__main__":
     main()
 
     if remove_prefix_cbz:
-        print_status("Scanning for CBZ files to clean...", "info")
-        for folder_path, _, file_names in os.walk(input_dir):
-            for file_name in file_names:
-                if file_name.lower().endswith('.cbz') and file_name.startswith("V "):
-                    cbz_path = os.path.join(folder_path, file_name)
-                    cleanup_cbz_filename(cbz_path)
-        print_status("CBZ filename cleanup complete.", "success")
+        remove_cbz_prefixes(input_dir)
@@ -0,0 +1,90 @@
+# /////////////////////////////////////////////////////////////////////////
+# //                                                                     //
+# //            Book 2 CBZ Converter by KenWeTech                        //
+# //                 Page render cache (used by p2)                      //
+# //                                                                     //
+# /////////////////////////////////////////////////////////////////////////
+
+# =============================================================
+# =             Don't Make Any Changes Here                   =
+# =============================================================
+
+# Keeps the rendered pixels of PDF pages on disk, so changing how pages are split into chapters, cropped or
+# encoded does not render the PDF again. A page is stored losslessly under the SHA-256 of its PDF, its page
+# number and how it was rendered (resolution, width, colour), so any change to the PDF or the render settings
+# simply misses. Only pages that were slow to render are stored: a plain text page renders about as fast as
+# it can be read back. Reading a page marks it as recently used; trim() removes the least recently used pages
+# once the cache is larger than its size limit. The folder is safe to delete at any time.
+
+import os
+import uuid
+from PIL import Image
+
+CACHE_DIR_NAME = '.book2cbz_page_cache'
+MIN_RENDER_SECONDS = 0.03  # Pages rendered faster than this are not worth storing
+# PackBits TIFF reads back several times faster than PNG at a similar size for text pages
+PAGE_FORMAT = {'format': 'TIFF', 'compression': 'packbits'}
+PAGE_EXTENSION = '.tiff'
+
+# --- Function: Page Path ---
+def get_page_path(library_dir, source_hash, page_index, render_key):
+    """Returns where a page is cached. Pages are spread over subfolders by the first characters of the PDF hash."""
+    return os.path.join(library_dir, CACHE_DIR_NAME, source_hash[:2], f"{source_hash}-{page_index}-{render_key}{PAGE_EXTENSION}")
+
+# --- Function: Load Page ---
+def load(library_dir, source_hash, page_index, render_key):
+    """Returns the cached page as a PIL image, or None when it is not cached (or cannot be read)."""
+    page_path = get_page_path(library_dir, source_hash, page_index, render_key)
+    try:
+        with Image.open(page_path) as img:
+            img.load()
+        os.utime(page_path)  # Marks the page as recently used for trim()
+        return img
+    except (OSError, ValueError):
+        return None
+
+# --- Function: Store Page ---
+def store(library_dir, source_hash, page_index, render_key, img):
+    """Saves a rendered page. Written to a temporary name first, so parallel workers never read half a file."""
+    page_path = get_page_path(library_dir, source_hash, page_index, render_key)
+    temp_path = f"{page_path}.{uuid.uuid4().hex[:8]}.tmp"
+    try:
+        os.makedirs(os.path.dirname(page_path), exist_ok=True)
+        img.save(temp_path, **PAGE_FORMAT)
+        os.replace(temp_path, page_path)
+        return True
+    except OSError:
+        if os.path.exists(temp_path):
+            os.remove(temp_path)
+        return False
+
+# --- Function: Trim Cache ---
+def trim(library_dir, max_bytes):
+    """Removes the least recently used pages until the cache takes at most max_bytes. Returns the number removed."""
+    pages = []
+    total = 0
+    cache_dir = os.path.join(library_dir, CACHE_DIR_NAME)
+    try:
+        subfolders = [entry.path for entry in os.scandir(cache_dir) if entry.is_dir()]
+    except OSError:
+        return 0
+    for subfolder in subfolders:
+        try:
+            for entry in os.scandir(subfolder):
+                stat = entry.stat()
+                pages.append((stat.st_mtime, stat.st_size, entry.path))
+                total += stat.st_size
+        except OSError:
+            continue  # Removed by another process in the meantime
+
+    removed = 0
+    for _, size, page_path in sorted(pages):
+        if total <= max_bytes:
+            break
+        try:
+            os.remove(page_path)
+            removed += 1
+        except OSError:
+            pass
+        total -= size
+    return removed
@@ -0,0 +1,200 @@
+# /////////////////////////////////////////////////////////////////////////
+# //                                                                     //
+# //            Book 2 CBZ Converter by KenWeTech                        //
+# //                 Subprocess runner (shared by p1, p2 and convert)    //
+# //                                                                     //
+# /////////////////////////////////////////////////////////////////////////
+
+# =============================================================
+# =             Don't Make Any Changes Here                   =
+# =============================================================
+
+# Runs external programs (ebook-convert, magick, the p1/p2 scripts) without buffering their output: every line is
+# passed on as it arrives and only the last lines are kept for error reports.
+# A watchdog stops the whole process tree when a job runs longer than its time limit or its processes together use
+# more memory than allowed, so one bad book cannot stall a library run.
+# Every job is written to the timing log (see instrumentation.py) with its status, so failed books can be found
+# and are converted again on the next run.
+# Memory limits need psutil or Linux (/proc); elsewhere they are ignored.
+
+import os
+import sys
+import time
+import signal
+import subprocess
+import threading
+import collections
+import instrumentation
+
+try:
+    import psutil  # Optional: memory use and process trees on every platform
+except ImportError:
+    psutil = None
+
+OUTPUT_TAIL_LINES = 200  # Lines of output kept for error messages and logs
+WATCH_INTERVAL = 0.5  # Seconds between time and memory checks
+
+# Job statuses. Anything but STATUS_OK means the job's output should not be trusted.
+STATUS_OK = 'ok'
+STATUS_FAILED = 'failed'  # Non-zero exit code
+STATUS_TIMEOUT = 'timeout'
+STATUS_MEMORY = 'memory'
+STATUS_NOT_FOUND = 'not_found'  # The program is not installed
+
+# --- Function: Start Process Group ---
+def get_group_kwargs():
+    """Popen arguments that start the job in its own process group, so the whole tree can be stopped together."""
+    if sys.platform.startswith('win'):
+        return {'creationflags': subprocess.CREATE_NEW_PROCESS_GROUP}
+    return {'start_new_session': True}
+
+# --- Function: Process Tree ---
+def _linux_group_pids(pgid):
+    pids = []
+    for entry in os.listdir('/proc'):
+        if not entry.isdigit():
+            continue
+        try:
+            with open(f'/proc/{entry}/stat', 'rb') as f:
+                # Fields after the command name (which may contain spaces): state, ppid, pgrp, ...
+                fields = f.read().rsplit(b')', 1)[1].split()
+            if int(fields[2]) == pgid:
+                pids.append(int(entry))
+        except (OSError, IndexError, ValueError):
+            continue
+    return pids
+
+def get_tree_memory(process):
+    """Returns the resident memory in bytes of a process and its children, or None when it cannot be measured."""
+    if psutil is not None:
+        try:
+            parent = psutil.Process(process.pid)
+            total = 0
+            for member in [parent] + parent.children(recursive=True):
+                try:
+                    total += member.memory_info().rss
+                except psutil.Error:
+                    pass
+            return total
+        except psutil.Error:
+            return None
+    if sys.platform.startswith('linux'):
+        total = 0
+        for pid in _linux_group_pids(process.pid):
+            try:
+                with open(f'/proc/{pid}/statm') as f:
+                    total += int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+            except (OSError, IndexError, ValueError):
+                pass
+        return total
+    return None
+
+# --- Function: Kill Process Tree ---
+def kill_process_tree(process):
+    """Kills a process started with get_group_kwargs() together with everything it started."""
+    if psutil is not None:
+        try:
+            for child in psutil.Process(process.pid).children(recursive=True):
+                try:
+                    child.kill()
+                except psutil.Error:
+                    pass
+        except psutil.Error:
+            pass
+    if sys.platform.startswith('win'):
+        subprocess.run(['taskkill', '/F', '/T', '/PID', str(process.pid)], capture_output=True)
+    else:
+        try:
+            os.killpg(process.pid, signal.SIGKILL)  # The job leads its own process group
+        except OSError:
+            pass
+    try:
+        process.kill()
+    except OSError:
+        pass
+    process.wait()
+
+# --- Function: Watch Job ---
+def _watch(process, job, timeout, memory_limit, finished):
+    """Stops the job when it runs too long or uses too much memory. Runs in its own thread until finished is set."""
+    deadline = time.monotonic() + timeout if timeout else None
+    while not finished.wait(WATCH_INTERVAL):
+        if deadline and time.monotonic() > deadline:
+            job['status'] = STATUS_TIMEOUT
+        elif memory_limit:
+            memory = get_tree_memory(process)
+            if memory is not None:
+                job['peak_memory_mb'] = max(job['peak_memory_mb'], round(memory / 1024 / 1024))
+                if memory > memory_limit:
+                    job['status'] = STATUS_MEMORY
+        if job['status']:
+            kill_process_tree(process)
+            return
+
+# --- Function: Run Command ---
+def run_command(command, label=None, timeout=None, memory_limit_mb=0, echo=True, prefix='', cwd=None, env=None):
+    """Runs a command, printing its output (stdout and stderr together) line by line as it arrives.
+
+    timeout is in seconds and memory_limit_mb covers the process and all its children; 0 or None means no limit.
+    When a limit is hit the whole process tree is killed. Returns a dict with 'status' (STATUS_*), 'returncode',
+    'output' (the last OUTPUT_TAIL_LINES lines), 'duration_s' and 'peak_memory_mb'.
+    """
+    job = {'status': None, 'returncode': None, 'output': '', 'duration_s': 0.0, 'peak_memory_mb': 0}
+    tail = collections.deque(maxlen=OUTPUT_TAIL_LINES)
+    start = time.perf_counter()
+    try:
+        process = subprocess.Popen(command, stdout=subprocess.PIPE, stderr=subprocess.STDOUT, stdin=subprocess.DEVNULL,
+                                   text=True, encoding='utf-8', errors='replace', bufsize=1, cwd=cwd, env=env,
+                                   **get_group_kwargs())
+    except FileNotFoundError as e:
+        job['status'] = STATUS_NOT_FOUND
+        job['output'] = str(e)
+        record_job(job, label or command[0])
+        return job
+
+    finished = threading.Event()
+    watchdog = None
+    if timeout or memory_limit_mb:
+        watchdog = threading.Thread(target=_watch, args=(process, job, timeout, memory_limit_mb * 1024 * 1024, finished), daemon=True)
+        watchdog.start()
+    try:
+        for line in process.stdout:
+            line = line.rstrip('\r\n')
+            tail.append(line)
+            if echo:
+                print(prefix + line, flush=True)
+        process.wait()
+    except BaseException:
+        # Ctrl+C does not reach a job in its own process group, so it is stopped here.
+        kill_process_tree(process)
+        raise
+    finally:
+        finished.set()
+        if watchdog:
+            watchdog.join()
+        process.stdout.close()
+
+    job['returncode'] = process.returncode
+    if not job['status']:
+        job['status'] = STATUS_OK if process.returncode == 0 else STATUS_FAILED
+    job['output'] = '\n'.join(tail)
+    job['duration_s'] = time.perf_counter() - start
+    record_job(job, label or command[0])
+    return job
+
+# --- Function: Record Job ---
+def record_job(job, label):
+    """Writes a job's status to the timing log, e.g. for jobs run some other way (the persistent Calibre worker)."""
+    instrumentation.record('job', label, job['duration_s'], status=job['status'], returncode=job['returncode'],
+                           peak_memory_mb=job['peak_memory_mb'] or None)
+
+# --- Function: Describe Job ---
+def describe_failure(job, timeout=None, memory_limit_mb=0):
+    """Returns a short reason for a job that did not finish with STATUS_OK."""
+    if job['status'] == STATUS_TIMEOUT:
+        return f"took longer than {timeout} seconds and was stopped"
+    if job['status'] == STATUS_MEMORY:
+        return f"used more than {memory_limit_mb} MB of memory and was stopped"
+    if job['status'] == STATUS_NOT_FOUND:
+        return f"could not be started ({job['output']})"
+    return f"exited with code {job['returncode']}"
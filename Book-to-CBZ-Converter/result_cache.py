@@ -0,0 +1,127 @@
+# /////////////////////////////////////////////////////////////////////////
+# //                                                                     //
+# //            Book 2 CBZ Converter by KenWeTech                        //
+# //                 Result cache (shared by p1 and p2)                  //
+# //                                                                     //
+# /////////////////////////////////////////////////////////////////////////
+
+# =============================================================
+# =             Don't Make Any Changes Here                   =
+# =============================================================
+
+# Remembers what each conversion step produced so unchanged books are skipped on the next run.
+# Entries are keyed on the SHA-256 of the source file plus the settings that affect the output,
+# so changing a setting only invalidates the books converted with the old value. The cache is a
+# single SQLite file in the library root and is safe to delete at any time.
+
+import os
+import json
+import time
+import sqlite3
+import hashlib
+import contextlib
+
+CACHE_FILE_NAME = '.book2cbz_cache.sqlite'
+
+# --- Function: Connect to Cache ---
+def connect(library_dir):
+    """Opens (and creates if needed) the cache database in the library root."""
+    conn = sqlite3.connect(os.path.join(library_dir, CACHE_FILE_NAME), timeout=60)
+    conn.execute("""CREATE TABLE IF NOT EXISTS files (
+        path TEXT PRIMARY KEY, size INTEGER, mtime_ns INTEGER, sha256 TEXT)""")
+    conn.execute("""CREATE TABLE IF NOT EXISTS results (
+        stage TEXT, source_hash TEXT, settings TEXT, outputs TEXT, output_hash TEXT, extra TEXT, updated REAL,
+        PRIMARY KEY (stage, source_hash, settings))""")
+    conn.execute("CREATE INDEX IF NOT EXISTS results_output_hash ON results (stage, output_hash)")
+    return conn
+
+@contextlib.contextmanager
+def _session(library_dir):
+    """Connection for one short transaction; committed and closed on exit so parallel workers never hold it open."""
+    conn = connect(library_dir)
+    try:
+        with conn:
+            yield conn
+    finally:
+        conn.close()
+
+# --- Function: Settings Key ---
+def settings_key(settings):
+    """Serializes settings in a stable order so equal settings always produce the same key."""
+    return json.dumps(settings, sort_keys=True, ensure_ascii=False)
+
+# --- Function: Hash File ---
+def file_hash(library_dir, path):
+    """Returns the SHA-256 of a file. The hash is only recomputed when the file's size or modification time changed."""
+    try:
+        stat = os.stat(path)
+        with _session(library_dir) as conn:
+            row = conn.execute("SELECT size, mtime_ns, sha256 FROM files WHERE path = ?", (os.path.abspath(path),)).fetchone()
+            if row and row[0] == stat.st_size and row[1] == stat.st_mtime_ns:
+                return row[2]
+
+        digest = hashlib.sha256()
+        with open(path, 'rb') as f:
+            for block in iter(lambda: f.read(1024 * 1024), b''):
+                digest.update(block)
+        sha256 = digest.hexdigest()
+
+        with _session(library_dir) as conn:
+            conn.execute("INSERT OR REPLACE INTO files VALUES (?, ?, ?, ?)",
+                         (os.path.abspath(path), stat.st_size, stat.st_mtime_ns, sha256))
+        return sha256
+    except (OSError, sqlite3.Error):
+        return None
+
+# --- Function: Look Up Result ---
+def lookup(library_dir, stage, source_hash, settings, output_dir=None):
+    """Returns (outputs, extra) for a cached result whose outputs all still exist, otherwise None.
+
+    With output_dir the outputs must also be in that folder, so a copy of the same book elsewhere is not skipped.
+    """
+    if not source_hash:
+        return None
+    try:
+        with _session(library_dir) as conn:
+            row = conn.execute("SELECT outputs, extra FROM results WHERE stage = ? AND source_hash = ? AND settings = ?",
+                               (stage, source_hash, settings_key(settings))).fetchone()
+    except sqlite3.Error:
+        return None
+    if not row:
+        return None
+    outputs = [os.path.join(library_dir, output) for output in json.loads(row[0])]
+    if not all(os.path.exists(output) for output in outputs):
+        return None
+    if output_dir and any(os.path.dirname(os.path.abspath(output)) != os.path.abspath(output_dir) for output in outputs):
+        return None
+    return outputs, json.loads(row[1]) if row[1] else {}
+
+# --- Function: Find Result by Output ---
+def find_by_output(library_dir, stage, output_hash):
+    """Returns (source_hash, extra) of the result that produced a file with the given hash, otherwise None."""
+    if not output_hash:
+        return None
+    try:
+        with _session(library_dir) as conn:
+            row = conn.execute("SELECT source_hash, extra FROM results WHERE stage = ? AND output_hash = ? ORDER BY updated DESC",
+                               (stage, output_hash)).fetchone()
+    except sqlite3.Error:
+        return None
+    if not row:
+        return None
+    return row[0], json.loads(row[1]) if row[1] else {}
+
+# --- Function: Record Result ---
+def record(library_dir, stage, source_hash, settings, outputs, output_hash=None, extra=None):
+    """Stores the outputs produced from a source file with the given settings. Returns True when saved."""
+    if not source_hash:
+        return False
+    relative_outputs = [os.path.relpath(output, library_dir) for output in outputs]
+    try:
+        with _session(library_dir) as conn:
+            conn.execute("INSERT OR REPLACE INTO results VALUES (?, ?, ?, ?, ?, ?, ?)",
+                         (stage, source_hash, settings_key(settings), json.dumps(relative_outputs, ensure_ascii=False),
+                          output_hash, json.dumps(extra, ensure_ascii=False) if extra else None, time.time()))
+        return True
+    except sqlite3.Error:
+        return False
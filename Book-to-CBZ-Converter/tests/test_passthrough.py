@@ -0,0 +1,52 @@
+# /////////////////////////////////////////////////////////////////////////
+# //                                                                     //
+# //            Book 2 CBZ Converter by KenWeTech                        //
+# //            Tests: scanned page passthrough                          //
+# //                                                                     //
+# /////////////////////////////////////////////////////////////////////////
+
+# Run with: python -m pytest tests
+
+import io
+import os
+import sys
+
+from PIL import Image
+import fitz  # PyMuPDF
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import p2_create_cbz as p2
+
+PAGE_WIDTH, PAGE_HEIGHT = 400, 500
+
+def make_jpeg(width, height):
+    buffer = io.BytesIO()
+    Image.new('RGB', (width, height), (200, 30, 30)).save(buffer, 'JPEG')
+    return buffer.getvalue()
+
+# --- Fixture: Scanned Book ---
+def make_scanned_pdf(path, placements, image):
+    """Writes one page per placement rect, each showing the same image at that rect."""
+    doc = fitz.open()
+    for rect in placements:
+        page = doc.new_page(width=PAGE_WIDTH, height=PAGE_HEIGHT)
+        page.insert_image(fitz.Rect(rect), stream=image)
+    doc.save(path)
+    doc.close()
+    return path
+
+def test_full_page_scan_is_copied(tmp_path):
+    image = make_jpeg(800, 1000)
+    pdf_path = make_scanned_pdf(str(tmp_path / 'scan.pdf'), [(0, 0, PAGE_WIDTH, PAGE_HEIGHT)], image)
+    with fitz.open(pdf_path) as doc:
+        assert p2.get_passthrough_image(doc, 0) == image
+
+def test_spread_across_two_pages_is_rendered(tmp_path):
+    # One 800x500 spread: its left half on page 1, its right half on page 2.
+    spread = make_jpeg(800, 500)
+    pdf_path = make_scanned_pdf(str(tmp_path / 'spread.pdf'),
+                                [(0, 0, 2 * PAGE_WIDTH, PAGE_HEIGHT), (-PAGE_WIDTH, 0, PAGE_WIDTH, PAGE_HEIGHT)], spread)
+    with fitz.open(pdf_path) as doc:
+        assert p2.get_passthrough_image(doc, 0) is None
+        assert p2.get_passthrough_image(doc, 1) is None
@@ -0,0 +1,80 @@
+# /////////////////////////////////////////////////////////////////////////
+# //                                                                     //
+# //            Book 2 CBZ Converter by KenWeTech                        //
+# //                 Table of contents model (shared by p1 and p2)       //
+# //                                                                     //
+# /////////////////////////////////////////////////////////////////////////
+
+# =============================================================
+# =             Don't Make Any Changes Here                   =
+# =============================================================
+
+# Turns a flat outline, as read from a PDF or EPUB, into a tree of entries that know their page ranges.
+# p1 uses the tree to pick the level chapters are split at (parts, chapters, ...).
+# p2 uses a sorted page index to find the chapter of every rendered page with a binary search.
+# Pages are 1-based and every 'end_page' is exclusive, the same convention as the chapters JSON.
+
+import bisect
+
+# --- Function: Build TOC Tree ---
+def build_toc_tree(outline, page_count):
+    """Builds the TOC tree from (level, title, page) entries in document order.
+
+    Each node is a dict with 'title', 'level', 'page', 'end_page' and 'children'. A node ends where the next
+    node of the same or a higher level starts; the last ones end after the last page.
+    """
+    roots = []
+    stack = []
+    for level, title, page in outline:
+        node = {'title': title, 'level': level, 'page': page, 'end_page': None, 'children': []}
+        while stack and stack[-1]['level'] >= level:
+            stack.pop()
+        (stack[-1]['children'] if stack else roots).append(node)
+        stack.append(node)
+    _set_end_pages(roots, page_count + 1)
+    return roots
+
+def _set_end_pages(nodes, end_page):
+    for node, next_node in zip(nodes, nodes[1:] + [None]):
+        node['end_page'] = max(node['page'], next_node['page'] if next_node else end_page)
+        _set_end_pages(node['children'], node['end_page'])
+
+# --- Function: Iterate TOC ---
+def iter_toc(nodes):
+    """Yields every node of the tree, parents before their children."""
+    for node in nodes:
+        yield node
+        yield from iter_toc(node['children'])
+
+# --- Function: Split Entries ---
+def get_split_entries(nodes, split_level=1):
+    """Returns the entries a book is split at, in document order.
+
+    Those are the nodes at split_level plus shallower nodes without children at that level (a prologue next to
+    parts, for example), so the whole book stays covered. Pages of a parent before its first child (a part's
+    title page) go to that first child.
+    """
+    entries = []
+    for node in nodes:
+        children = get_split_entries(node['children'], split_level) if node['level'] < split_level else []
+        if children:
+            children[0] = dict(children[0], page=min(node['page'], children[0]['page']))
+            entries.extend(children)
+        else:
+            entries.append(node)
+    return entries
+
+# --- Function: Build Page Index ---
+def build_page_index(ranges):
+    """Sorts non-overlapping (start, end, item) ranges into an index for find_in_page_index."""
+    ranges = sorted(ranges, key=lambda page_range: page_range[0])
+    return [page_range[0] for page_range in ranges], ranges
+
+# --- Function: Find in Page Index ---
+def find_in_page_index(page_index, page):
+    """Returns the item whose range contains page (start <= page < end), or None."""
+    starts, ranges = page_index
+    position = bisect.bisect_right(starts, page) - 1
+    if position >= 0 and page < ranges[position][1]:
+        return ranges[position][2]
+    return None